@@ -1,3 +1,9 @@
 from .version import __version__, __versiondate__
 from .school_pop import *
-from .school_interventions import *
\ No newline at end of file
+from .pop_store import *
+from .school_results import *
+from .school_interventions import *
+from .school_system import *
+from .school_branches import *
+from .results_sink import *
+from .sim_pool import *
@@ -0,0 +1,261 @@
+'''
+Directory-based population store. Rather than one gzipped pickle of the whole
+People object, each attribute is saved as its own .npy file and each contact
+layer is saved in CSR form (edges sorted by p1, with an index pointer per person).
+The arrays are loaded with memory mapping, so many processes loading the same
+population share the operating system's page cache instead of each holding a
+private unpickled copy. The mapped arrays also stay shared when a sim is pickled
+to a worker process; see StorePeople.
+
+Layout of a store:
+
+    meta.json                      : population size, layer keys, school types, and format version
+    people/<key>.npy               : per-person arrays (age, sex, school_id, school_type_code, school_role)
+    schools/{ids,indptr,uids}.npy  : members of each school, in CSR form
+    contacts/<layer>/{indptr,indices,beta}.npy : edges of each layer, in CSR form with indices giving p2
+
+Example:
+
+    store = cvsch.convert_popfile('inputs/kc_synthpops_clustered_225000_withstaff_seed0.ppl')
+    people = cvsch.load_pop_store(store)
+    sim = cv.Sim(pars, popfile=people, load_pop=True)
+'''
+
+import os
+import copy
+import json
+import numpy as np
+import sciris as sc
+import covasim as cv
+from .school_pop import school_type_keys
+
+__all__ = ['store_path', 'school_arrays', 'save_pop_store', 'load_pop_store', 'convert_popfile', 'StorePeople']
+
+store_version = 1 # Increment if the layout changes
+person_keys = ['age', 'sex', 'school_id', 'school_type_code', 'school_role']
+layer_files = {'p2':'indices', 'beta':'beta'} # File name of each mapped column of a layer
+
+
+def store_path(popfile):
+    ''' The store directory that convert_popfile() makes for a .ppl file, e.g. "seed0.ppl" -> "seed0.store" '''
+    return os.path.splitext(popfile)[0] + '.store'
+
+
+def school_arrays(people):
+    '''
+    The typed school arrays of a People object, as made by make_population(). Older
+    populations store school_id as an object array with None, the role flags as lists,
+    and no type codes; these are converted.
+    '''
+    pop_size = len(people)
+    if hasattr(people, 'school_role'):
+        return dict(school_id=np.asarray(people.school_id, dtype=np.int32),
+                    school_type_code=np.asarray(people.school_type_code, dtype=np.int8),
+                    school_role=np.asarray(people.school_role, dtype=np.int8))
+
+    school_id = np.array([-1 if sid is None else sid for sid in people.school_id], dtype=np.int32)
+    role = np.select([np.asarray(people.teacher_flag, dtype=bool), np.asarray(people.student_flag, dtype=bool), np.asarray(people.staff_flag, dtype=bool)], [1, 0, 2], default=-1)
+    type_of_school = np.full(max(school_id.max(), 0)+1, -1, dtype=np.int8) # Type code of each school ID
+    for t,stype in enumerate(school_type_keys):
+        type_of_school[people.school_types.get(stype, [])] = t
+    in_school = school_id >= 0
+    school_type_code = np.where(in_school, type_of_school[np.maximum(school_id, 0)], -1).astype(np.int8)
+    school_role = np.where(in_school, role, -1).astype(np.int8)
+    if pop_size and (school_type_code[in_school] < 0).any():
+        raise ValueError('Some people are in a school that is not listed in school_types')
+    return dict(school_id=school_id, school_type_code=school_type_code, school_role=school_role)
+
+
+def save_pop_store(people, folder):
+    '''
+    Save a People object, as made by make_population(), as a population store.
+
+    Only what make_population() creates is saved: ages, sexes, contacts, and schools.
+    The metadata file is written last, so an interrupted save is never loaded.
+
+    Args:
+        people (People): the population to save
+        folder (str): the directory to save it to; created if needed
+
+    Returns:
+        The folder
+    '''
+    for sub in ['people', 'schools', 'contacts']:
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    meta_file = os.path.join(folder, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    # People
+    arrays = dict(age=np.asarray(people.age), sex=np.asarray(people.sex))
+    arrays.update(school_arrays(people))
+    for key in person_keys:
+        np.save(os.path.join(folder, 'people', f'{key}.npy'), arrays[key])
+
+    # Schools
+    ids = np.array(list(people.schools.keys()), dtype=np.int32)
+    rosters = [np.asarray(people.schools[sid], dtype=np.int64) for sid in people.schools]
+    indptr = np.concatenate([[0], np.cumsum([len(r) for r in rosters])]).astype(np.int64)
+    uids = np.concatenate(rosters) if rosters else np.empty(0, dtype=np.int64)
+    for key,arr in dict(ids=ids, indptr=indptr, uids=uids).items():
+        np.save(os.path.join(folder, 'schools', f'{key}.npy'), arr)
+
+    # Contacts, sorted by p1; the sort is stable, so a layer already in p1 order is stored as is
+    pop_size = len(people)
+    for lkey,layer in people.contacts.items():
+        lfolder = os.path.join(folder, 'contacts', lkey)
+        os.makedirs(lfolder, exist_ok=True)
+        order = np.argsort(layer['p1'], kind='stable')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(layer['p1'], minlength=pop_size))]).astype(np.int64)
+        np.save(os.path.join(lfolder, 'indptr.npy'), indptr)
+        np.save(os.path.join(lfolder, 'indices.npy'), layer['p2'][order])
+        np.save(os.path.join(lfolder, 'beta.npy'), layer['beta'][order])
+
+    meta = dict(
+        version      = store_version,
+        pop_size     = pop_size,
+        layer_keys   = list(people.contacts.keys()),
+        school_types = {stype:[int(sid) for sid in sids] for stype,sids in people.school_types.items()},
+    )
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    return folder
+
+
+class StorePeople(cv.People):
+    '''
+    People loaded from a population store. When the people are pickled, e.g. to send
+    a sim to a MultiSim worker, or deep copied, mapped arrays that are still as
+    loaded are replaced by references to their files and mapped again on the other
+    side, so every process and every copy shares the same pages. Arrays that a sim
+    has replaced, e.g. a layer after clipping edges, are pickled as usual.
+
+    Since the mapping is copy-on-write, an array changed in place is not carried over
+    by pickling; covasim and this package only ever replace these arrays.
+    '''
+
+    def __getstate__(self):
+        ''' Replace mapped arrays that are still as loaded by their locations in the store '''
+        state = self.__dict__.copy()
+        mapped = state.pop('_mapped', {})
+        contacts = state['contacts'] = copy.copy(self.contacts)
+        refs = []
+        for loc,arr in mapped.items():
+            if loc[0] == 'people' and state.get(loc[1]) is arr:
+                state[loc[1]] = None
+                refs.append(loc)
+            elif loc[0] == 'contacts' and loc[1] in contacts and contacts[loc[1]].get(loc[2]) is arr:
+                if contacts[loc[1]] is self.contacts[loc[1]]:
+                    contacts[loc[1]] = copy.copy(contacts[loc[1]]) # Don't modify the original layer
+                contacts[loc[1]][loc[2]] = None
+                refs.append(loc)
+        state['_mapped_refs'] = refs
+        return state
+
+    def __setstate__(self, state):
+        ''' Map the arrays replaced by __getstate__() again '''
+        refs = state.pop('_mapped_refs', [])
+        self.__dict__.update(state)
+        self._mapped = {}
+        for loc in refs:
+            arr = map_array(self._store_folder, loc)
+            if loc[0] == 'people':
+                setattr(self, loc[1], arr)
+            else:
+                self.contacts[loc[1]][loc[2]] = arr
+            self._mapped[loc] = arr
+        return
+
+
+def map_array(folder, loc, mmap=True):
+    ''' Load one array of a store, given its location: ('people', key) or ('contacts', layer key, 'p2' or 'beta') '''
+    if loc[0] == 'people':
+        path = os.path.join(folder, 'people', f'{loc[1]}.npy')
+    else:
+        path = os.path.join(folder, 'contacts', loc[1], f'{layer_files[loc[2]]}.npy')
+    if not mmap:
+        return np.load(path)
+    return np.load(path, mmap_mode='c').view(np.ndarray) # A plain array, but still backed by the (copy-on-write) mapping
+
+
+def load_pop_store(folder, mmap=True):
+    '''
+    Load a population store as a People object, ready to be passed to cv.Sim(popfile=...).
+
+    With memory mapping, the per-person arrays and the p2 and beta arrays of each
+    layer are mapped copy-on-write; p1 and the flags are computed, so they are
+    always in memory.
+
+    Args:
+        folder (str): the store directory
+        mmap (bool): whether to memory-map the arrays, rather than read them into memory
+
+    Returns:
+        A StorePeople object with the same ages, sexes, contacts, and school attributes as the saved population
+    '''
+    meta_file = os.path.join(folder, 'meta.json')
+    if not os.path.exists(meta_file):
+        raise FileNotFoundError(f'No population store found in "{folder}" (missing meta.json); convert one with convert_popfile()')
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta['version'] != store_version:
+        raise ValueError(f'Population store "{folder}" has version {meta["version"]}, but version {store_version} is required; please reconvert it')
+
+    pop_size = meta['pop_size']
+    mapped = {}
+    for key in person_keys:
+        mapped[('people', key)] = map_array(folder, ('people', key), mmap=mmap)
+    for lkey in meta['layer_keys']:
+        for col in layer_files:
+            mapped[('contacts', lkey, col)] = map_array(folder, ('contacts', lkey, col), mmap=mmap)
+
+    # Contacts, with p1 expanded from the index pointer
+    contacts = {}
+    for lkey in meta['layer_keys']:
+        indptr = np.load(os.path.join(folder, 'contacts', lkey, 'indptr.npy'))
+        p1 = np.repeat(np.arange(pop_size, dtype=cv.defaults.default_int), np.diff(indptr))
+        contacts[lkey] = cv.Layer(p1=p1, p2=mapped[('contacts', lkey, 'p2')], beta=mapped[('contacts', lkey, 'beta')])
+
+    # Schools
+    ids, indptr, uids = [np.load(os.path.join(folder, 'schools', f'{key}.npy')) for key in ['ids', 'indptr', 'uids']]
+    schools = {int(sid):uids[indptr[k]:indptr[k+1]] for k,sid in enumerate(ids)}
+
+    arrays = {key:mapped[('people', key)] for key in person_keys}
+    role = arrays['school_role']
+    people_pars = dict(
+        pop_size   = pop_size,
+        beta_layer = {lkey:1.0 for lkey in meta['layer_keys']},
+        beta       = 1.0,
+    )
+    people = StorePeople(people_pars, strict=False, schools=schools, school_types=meta['school_types'],
+                         student_flag=(role == 0), teacher_flag=(role == 1), staff_flag=(role == 2), **arrays)
+    for lkey,layer in contacts.items():
+        people.contacts[lkey] = layer # Set directly, since People.add_contacts() would copy the arrays
+    people._store_folder = os.path.abspath(folder)
+    people._mapped = mapped if mmap else {}
+    return people
+
+
+def convert_popfile(popfile, folder=None, overwrite=False):
+    '''
+    Convert a population saved with sc.saveobj(), e.g. by make_population(), to a population store.
+
+    Args:
+        popfile (str): the .ppl file to convert
+        folder (str): where to save the store (default: see store_path())
+        overwrite (bool): whether to replace an existing store
+
+    Returns:
+        The folder
+    '''
+    if folder is None:
+        folder = store_path(popfile)
+    if os.path.exists(os.path.join(folder, 'meta.json')) and not overwrite:
+        print(f'Population store "{folder}" already exists, skipping')
+        return folder
+    T = sc.tic()
+    people = cv.load(popfile)
+    save_pop_store(people, folder)
+    sc.toc(T, label=f'Converted "{popfile}" to "{folder}"')
+    return folder
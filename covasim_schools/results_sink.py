@@ -0,0 +1,235 @@
+'''
+Write summary rows for each finished sim to a partitioned Parquet dataset, so
+results can be read back as a table without loading the sims themselves. There
+are two tables, each a folder of Parquet files partitioned by the keys the scenario
+scripts set on each sim (key1 = scenario, key2 = testing, key3 = sensitivity) and
+the random seed:
+
+    <folder>/summary/key1=<key1>/key2=<key2>/key3=<key3>/seed=<seed>/part.parquet
+    <folder>/schools/key1=<key1>/key2=<key2>/key3=<key3>/seed=<seed>/part.parquet
+
+The summary table has one row per sim: the metrics from the supplied function,
+e.g. evaluate_sim() in calibrate_model.py, and the totals from gather_stats() in
+sim.school_results, e.g. "in_person_teachers+staff". The schools table has one row
+per school (or a single row with stats_level='district'), from SchoolResults.to_df(),
+plus the value of each metric on any days given to the sink, e.g. the first school day.
+Partition values are URI-encoded, since the testing keys contain characters such as
+"/". A sim that is run again overwrites its own files. For sims that were saved
+without a sink, collect_results() builds the same tables from the sims themselves.
+
+Requires pyarrow, e.g. from the "results" extra: pip install -e .[results]
+
+Example:
+
+    sink = cvsch.ResultsSink('results', metrics=evaluate_sim, days={'d1':'2020-11-02'})
+    sink.add(sim) # As each sim finishes
+    df = cvsch.load_results('results', columns=['key1', 'key2', 'cases_end'])
+    schools = cvsch.load_results('results', table='schools', columns=['key1', 'infectious_stay_at_school_students_d1'])
+'''
+
+import os
+import urllib.parse
+import numpy as np
+import sciris as sc
+from .school_results import SchoolResults
+
+__all__ = ['partition_keys', 'summary_row', 'school_rows', 'ResultsSink', 'load_results', 'collect_results']
+
+partition_keys = ['key1', 'key2', 'key3', 'seed']
+tables = ['summary', 'schools']
+
+
+def sim_keys(sim):
+    ''' The partition values of a sim; keys the sim does not have are "None" '''
+    keys = {key:str(getattr(sim, key, None)) for key in partition_keys[:-1]}
+    keys['seed'] = int(sim['rand_seed'])
+    return keys
+
+
+def summary_row(sim, metrics=None):
+    '''
+    The summary of one sim, as a flat dict: the metrics, the population size and
+    scale, then the totals of sim.school_results, as "<key>_<group>".
+
+    Args:
+        sim (Sim): a finished sim with a schools_manager
+        metrics (func): function of the sim returning a dict of metrics, e.g. evaluate_sim()
+    '''
+    row = {}
+    if metrics is not None:
+        row.update(metrics(sim))
+    row['pop_size'] = sim['pop_size']
+    row['pop_scale'] = sim['pop_scale']
+    res = getattr(sim, 'school_results', None)
+    if res is not None:
+        row['n_schools'] = res.n_schools
+        row['n_school_days'] = res.n_school_days
+        for test,n in res.n_tested.items():
+            row[f'n_tested_{test}'] = n
+        for key in res.shared_keys:
+            for group,value in res[key].items():
+                row[f'{key}_{group}'] = value
+    for key,value in row.items():
+        if isinstance(value, np.generic):
+            row[key] = value.item()
+    return row
+
+
+def school_rows(sim, days=None):
+    '''
+    The per-school table of one sim, from SchoolResults.to_df(), or None if the sim
+    has no school statistics. Sims saved before SchoolResults, whose school_stats
+    is a dict of per-school dicts, are converted first.
+
+    Args:
+        sim (Sim): a finished sim with a schools_manager
+        days (dict): labels to dates; each metric and group on that day is added, e.g. "infectious_students_d1"
+    '''
+    stats = getattr(sim, 'school_stats', None)
+    if stats is None:
+        return None
+    if isinstance(stats, dict):
+        stats = SchoolResults.from_dict(stats)
+    return stats.to_df(days={label:sim.day(day) for label,day in (days or {}).items()})
+
+
+class ResultsSink(sc.prettyobj):
+    '''
+    Write the rows for each sim to the partitioned dataset in a folder. Each sim
+    is written to its own files, so separate processes can add sims at the same
+    time, and the sink can be passed to parallel workers.
+
+    Args:
+        folder (str): the folder of the dataset
+        metrics (func): function of the sim returning a dict of metrics for the summary table, e.g. evaluate_sim()
+        schools (bool): whether to write the per-school table
+        days (dict): labels to dates; the per-school table also gets each metric and group on that day, e.g. "infectious_students_d1"
+    '''
+
+    def __init__(self, folder, metrics=None, schools=True, days=None):
+        self.folder = folder
+        self.metrics = metrics
+        self.schools = schools
+        self.days = days or {}
+        return
+
+
+    def part_path(self, table, keys):
+        ''' The file for a table and partition '''
+        parts = [f'{key}={urllib.parse.quote(str(keys[key]), safe="")}' for key in partition_keys]
+        return os.path.join(self.folder, table, *parts, 'part.parquet')
+
+
+    def add(self, sim):
+        ''' Write the rows of a finished sim; returns the summary row '''
+        import pandas as pd # Imported here since only needed for this
+        keys = sim_keys(sim)
+        row = summary_row(sim, metrics=self.metrics)
+        self.write('summary', keys, pd.DataFrame([row]))
+        schools = school_rows(sim, days=self.days) if self.schools else None
+        if schools is not None:
+            self.write('schools', keys, schools)
+        return row
+
+
+    def write(self, table, keys, df):
+        ''' Write a dataframe, without the partition columns, to its partition '''
+        import pyarrow as pa # Imported here since optional
+        import pyarrow.parquet as pq
+        path = self.part_path(table, keys)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpfile = os.path.join(os.path.dirname(path), '.part.parquet.tmp') # Hidden files are skipped when reading
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmpfile)
+        os.replace(tmpfile, path) # So readers never see a partial file
+        return path
+
+
+def load_results(folder, table='summary', columns=None, filters=None):
+    '''
+    Read a table written by ResultsSink as a dataframe. Only the requested columns
+    and partitions are read.
+
+    Args:
+        folder (str): the folder of the dataset
+        table (str): 'summary' or 'schools'
+        columns (list): the columns to read, including partition keys (default: all)
+        filters (list): pyarrow filters, e.g. [('key1', '==', 'as_normal')]
+
+    Returns:
+        A pandas dataframe, with the partition keys as columns
+    '''
+    import pyarrow as pa # Imported here since optional
+    import pyarrow.dataset as ds
+    if table not in tables:
+        raise ValueError(f'Table must be one of {tables}, not "{table}"')
+    schema = pa.schema([(key, pa.string()) for key in partition_keys[:-1]] + [('seed', pa.int64())])
+    partitioning = ds.partitioning(schema, flavor='hive')
+    dataset = ds.dataset(os.path.join(folder, table), format='parquet', partitioning=partitioning)
+    return dataset.to_table(columns=columns, filter=filter_expression(filters)).to_pandas()
+
+
+def collect_results(sims, table='summary', columns=None, filters=None, metrics=None, days=None):
+    '''
+    Build a table from sims in memory, e.g. loaded from a .sims file saved without a
+    sink, with the same rows and columns that ResultsSink writes and load_results()
+    reads.
+
+    Args:
+        sims (list): the finished sims
+        table (str): 'summary' or 'schools'
+        columns (list): the columns to keep, including partition keys (default: all)
+        filters (list): filters as for load_results(), e.g. [('type', 'in', ['es', 'ms', 'hs'])]
+        metrics (func): as for ResultsSink, e.g. evaluate_sim(); only used for the summary table
+        days (dict): as for ResultsSink; only used for the schools table
+
+    Returns:
+        A pandas dataframe, with the partition keys as columns
+    '''
+    import pandas as pd # Imported here since only needed for this
+    if table not in tables:
+        raise ValueError(f'Table must be one of {tables}, not "{table}"')
+    frames = []
+    for sim in sims:
+        df = pd.DataFrame([summary_row(sim, metrics=metrics)]) if table == 'summary' else school_rows(sim, days=days)
+        if df is not None:
+            for key,value in sim_keys(sim).items():
+                df[key] = value
+            frames.append(df)
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=partition_keys)
+    for column, op, value in (filters or []):
+        check_op(op)
+        df = df[filter_ops[op](df[column], value)]
+    if columns is not None:
+        df = df[columns]
+    return df.reset_index(drop=True)
+
+
+filter_ops = { # The same operators apply to pyarrow fields and pandas columns
+    '==': lambda field,value: field == value,
+    '!=': lambda field,value: field != value,
+    '<':  lambda field,value: field < value,
+    '<=': lambda field,value: field <= value,
+    '>':  lambda field,value: field > value,
+    '>=': lambda field,value: field >= value,
+    'in': lambda field,value: field.isin(value),
+}
+
+
+def check_op(op):
+    ''' Raise an error if a filter operator is not supported '''
+    if op not in filter_ops:
+        raise ValueError(f'Filter operator must be one of {list(filter_ops.keys())}, not "{op}"')
+    return
+
+
+def filter_expression(filters):
+    ''' Combine (column, op, value) filters into one pyarrow expression, or None '''
+    if not filters:
+        return None
+    import pyarrow.dataset as ds # Imported here since optional
+    expression = None
+    for column, op, value in filters:
+        check_op(op)
+        term = filter_ops[op](ds.field(column), value)
+        expression = term if expression is None else expression & term
+    return expression
@@ -0,0 +1,116 @@
+'''
+Run several school scenarios from one shared start. Until the first school opens
+or the first school test is due, every scenario gives the same sim: schools are
+closed, so the school layers are empty and the schools manager draws no random
+numbers. run_branches() therefore runs that shared prefix once, with the schools
+held closed by close_schools(), and then copies the sim at the divergence day and
+continues each copy with its own schools_manager.
+
+Each branch is statistically equivalent to running its scenario from the start.
+It is not identical draw for draw, since the random stream is reset when each
+branch resumes: all branches of one sim use the same random numbers from the
+divergence day on.
+
+Example:
+
+    base_sim = cs.create_sim(pars)
+    managers = {'Normal':cvsch.schools_manager(normal), 'Hybrid':cvsch.schools_manager(hybrid)}
+    sims = cvsch.run_branches(base_sim, managers)
+'''
+
+import sciris as sc
+import covasim as cv
+from .school_interventions import SchoolScenario, TestingCalendar
+
+__all__ = ['divergence_day', 'close_schools', 'run_branches']
+
+
+def divergence_day(sim, scenarios):
+    '''
+    The first day on which any of the scenarios opens a school or has a test due,
+    i.e. the first day on which the scenarios can differ from a sim with all schools
+    closed. Days outside the sim are ignored.
+
+    Args:
+        sim (Sim): the simulation object, initialized (used for its dates)
+        scenarios (list): the scenarios, each a dict of school type to parameters (including testing), or None
+
+    Returns:
+        The day, or sim.npts if no scenario opens a school or tests during the sim
+    '''
+    days = [sim.npts]
+    for scenario in scenarios:
+        scenario = SchoolScenario(scenario)
+        active = {stype:spec for stype,spec in scenario.items() if spec is not None}
+        for spec in active.values():
+            start = sim.day(spec['start_day'])
+            if 0 <= start < sim.npts:
+                days.append(start)
+        calendar = TestingCalendar({stype:spec['testing'] for stype,spec in active.items()}, sim)
+        days += [t for t,due in enumerate(calendar.due) if due][:1]
+    return min(days)
+
+
+class close_schools(cv.Intervention):
+    '''
+    Keep all schools closed, by setting the 's' layer aside when the sim is
+    initialized. release() restores the layer, so a schools_manager can be added
+    part-way through the sim; see run_branches().
+    '''
+
+    def initialize(self, sim):
+        self.layer = sim.people.contacts['s']
+        sim.people.contacts['s'] = cv.Layer()
+        self.initialized = True
+        return
+
+    def apply(self, sim):
+        pass
+
+    def release(self, sim):
+        ''' Restore the 's' layer and remove this intervention from the sim '''
+        sim.people.contacts['s'] = self.layer
+        sim['interventions'] = [interv for interv in sim['interventions'] if interv is not self]
+        return
+
+
+def run_branches(base_sim, managers, day=None, keep_people=False, verbose=True):
+    '''
+    Run one sim per schools manager, sharing the days before the divergence day.
+
+    Args:
+        base_sim (Sim): the sim to branch from, without a schools manager; it is not modified
+        managers (dict): label to the schools_manager (not yet initialized) for each branch
+        day (int/str): the day to branch on (default: the divergence day of the managers' scenarios); may be earlier, but not later, than the divergence day
+        keep_people (bool): whether to keep the people of each finished branch
+        verbose (bool): whether to print progress
+
+    Returns:
+        A dict of label to finished sim; each sim also has its label in sim.label
+    '''
+    base = sc.dcp(base_sim)
+    base['interventions'] += [close_schools()]
+    base.initialize()
+    first = divergence_day(base, [manager.scenario for manager in managers.values()])
+    if day is None:
+        day = first
+    elif base.day(day) > first:
+        raise ValueError(f'Cannot branch on day {base.day(day)}, after the divergence day {first}: schools would open or tests would be due before the branches start')
+    day = min(base.day(day), base.npts-1) # Each manager must run at least the last day, to gather its statistics
+    if verbose:
+        print(f'Running the shared prefix up to day {day} of {base.npts-1}, then {len(managers)} branches')
+    if day > 0:
+        base.run(until=day)
+
+    sims = {}
+    for label, manager in managers.items():
+        sim = sc.dcp(base)
+        sim.label = label
+        [interv for interv in sim['interventions'] if isinstance(interv, close_schools)][0].release(sim)
+        sim['interventions'] += [manager]
+        manager.initialize(sim)
+        sim.run()
+        if not keep_people:
+            sim.shrink(in_place=True)
+        sims[label] = sim
+    return sims
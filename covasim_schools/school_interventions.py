@@ -2,15 +2,19 @@
 Main file implementing school-based interventions.  The user interface is handled
 by the schools_manager() intervention. This primarily uses the School class, of
 which there is one instance per school. SchoolTesting orchestrates testing within
-a school, while SchoolStats records results. The remaining functions are contact
-managers, which handle different cohorting options (and school days).
+a school, while SchoolStats records results, which are collected into a columnar
+SchoolResults object in sim.school_stats at the end of the sim. The remaining functions are contact
+managers, which handle different cohorting options (and school days). Alternatively,
+schools_manager(engine='system') runs all schools at once with the vectorized
+SchoolSystem in school_system.py.
 '''
 
 import covasim as cv
 import numpy as np
 import sciris as sc
+from .school_results import SchoolResults
 
-__all__ = ['schools_manager', 'SchoolScenario', 'School', 'SchoolTesting', 'SchoolStats', 'int2key']
+__all__ = ['schools_manager', 'SchoolScenario', 'School', 'AbsenceLedger', 'TestingCalendar', 'SchoolTesting', 'SchoolStats', 'int2key', 'partition_school_layer', 'merge_layers', 'antigen_test']
 
 
 def int2key(x):
@@ -18,6 +22,59 @@ def int2key(x):
     return 's' + str(x)
 
 
+def find_positions(sorted_uids, order, uids):
+    '''
+    Find where uids sit in an array of a school's uids, given that array in sorted
+    form along with the argsort that produced it.
+
+    Returns:
+        The positions of the uids that were found, and a boolean mask over uids of which were found
+    '''
+    uids = np.asarray(uids, dtype=sorted_uids.dtype)
+    if len(uids) == 0 or len(sorted_uids) == 0:
+        return np.empty(0, dtype=np.int64), np.zeros(len(uids), dtype=bool)
+    idx = np.minimum(np.searchsorted(sorted_uids, uids), len(sorted_uids)-1)
+    found = sorted_uids[idx] == uids
+    return order[idx[found]], found
+
+
+def partition_school_layer(layer, schools, school_ids, pop_size):
+    '''
+    Split the 's' layer into one layer per school. Every edge is labeled with
+    the first school in school_ids that either of its endpoints belongs to,
+    and the per-school layers are then cut from a single stable sort on that
+    label. Edges touching none of the listed schools are dropped. The result is
+    identical to removing each school's edges from the layer in turn.
+
+    Args:
+        layer      (Layer) : the original 's' layer
+        schools    (dict)  : school ID to the uids in that school, i.e. people.schools
+        school_ids (list)  : IDs of the schools to extract, in processing order
+        pop_size   (int)   : number of people in the population
+
+    Returns:
+        A dict from school ID to the Layer for that school
+    '''
+
+    # Label each person with the position of their school in school_ids; the loop runs backwards so the first school wins
+    n_schools = len(school_ids)
+    person_school = np.full(pop_size, n_schools, dtype=np.int64)
+    for ind in range(n_schools-1, -1, -1):
+        person_school[np.asarray(schools[school_ids[ind]], dtype=np.int64)] = ind
+
+    # Label each edge, then group edges by school while preserving their original order
+    edge_school = np.minimum(person_school[layer['p1']], person_school[layer['p2']])
+    order = np.argsort(edge_school, kind='stable')
+    bounds = np.searchsorted(edge_school[order], np.arange(n_schools+1))
+
+    layers = {}
+    for ind, school_id in enumerate(school_ids):
+        inds = order[bounds[ind]:bounds[ind+1]]
+        layers[school_id] = cv.Layer(**{key:layer[key][inds] for key in layer.meta_keys()})
+
+    return layers
+
+
 class schools_manager(cv.Intervention):
     '''
     This is the front end to the Schools class intervention.  Not much here,
@@ -63,66 +120,228 @@ class schools_manager(cv.Intervention):
                 'sensitivity': 1,
                 'delay': 1,
             }
+
+    Other options:
+
+        copy_layers (bool): if True, each school deep copies its layer every day and
+            pops absent individuals from the copy, rather than masking the edges of an
+            unchanged base layer (the default); both give the same layers
+        engine (str): 'schools' (default) to run each school as its own School object,
+            or 'system' to run all schools at once in a vectorized SchoolSystem; the
+            two are statistically equivalent but use different random draws, and the
+            'system' engine ignores verbose and copy_layers
+        layer_mode (str): how school edges are passed to covasim: 'school' (default)
+            for one layer per school (e.g. 's5'), 'type' for one layer per school type
+            (e.g. 's_es'), or 'single' for one layer ('s_all') with beta_s folded into
+            each edge's beta; statistics are still kept per school in all cases
+        batch_testing (bool): if True, each test due on a day is run for all schools of
+            that type with a single covasim test call, which is faster with frequent
+            testing; if False (default), each school tests its own people. The two are
+            statistically equivalent, but batching draws the random numbers in a
+            different order, so seeded results differ from unbatched runs (the 'system'
+            engine always batches)
+        stats_level (str): which statistics to record in sim.school_stats: 'school' (default)
+            for each school, 'district' for a single row summed over all schools (sim.school_results
+            is unchanged), or 'none' for no statistics, in which case sim.school_stats and
+            sim.school_results are None
+        stats_freq (str): 'day' (default) to record statistics for each day, or 'week' to
+            record their sums over each week
     '''
 
-    def __init__(self, scenario, **kwargs):
+    def __init__(self, scenario, copy_layers=False, engine='schools', layer_mode='school', batch_testing=False,
+                 stats_level='school', stats_freq='day', **kwargs):
         super().__init__(**kwargs) # Initialize the Intervention object
         self._store_args() # Store the input arguments so that intervention can be recreated
 
         # Store arguments
         self.scenario = SchoolScenario(scenario)
+        self.copy_layers = copy_layers
+        self.engine = engine
+        if engine not in ['schools', 'system']:
+            raise ValueError(f'Engine must be "schools" or "system", not "{engine}"')
+        self.batch_testing = batch_testing
+        self.stats_level = stats_level
+        if stats_level not in ['none', 'district', 'school']:
+            raise ValueError(f'Stats level must be "none", "district", or "school", not "{stats_level}"')
+        self.stats_freq = stats_freq
+        if stats_freq not in ['day', 'week']:
+            raise ValueError(f'Stats frequency must be "day" or "week", not "{stats_freq}"')
+        self.layer_mode = layer_mode
+        if layer_mode not in ['school', 'type', 'single']:
+            raise ValueError(f'Layer mode must be "school", "type", or "single", not "{layer_mode}"')
         self.schools = []
+        self.system = None
         return
 
     def initialize(self, sim):
         # Create schools, stealing 's' edges into the School class instances upon *initialize*
         self.school_types = sim.people.school_types # Dict with keys of school types (e.g. 'es') and values of list of school ids (e.g. [1,5])
-
-        sdf = sim.people.contacts['s'].to_df()
-        sim.school_stats = {}
-
+        # Determine which schools will open, in the order they are processed
+        open_schools = []
         for school_type, scids in self.school_types.items():
-            for school_id in scids:
-                uids = sim.people.schools[school_id] # Dict with keys of school_id and values of uids in that school
+            if self.scenario[school_type] is not None:
+                for school_id in scids:
+                    open_schools.append((school_type, school_id))
+
+        # Compile the testing schedule once, to be shared by all schools
+        self.calendar = TestingCalendar({stype:scen['testing'] for stype,scen in self.scenario.items() if scen is not None}, sim)
+
+        # Extract the 's'-layer associated with each school in a single pass
+        school_layers = partition_school_layer(sim.people.contacts['s'], sim.people.schools, [school_id for _,school_id in open_schools], len(sim.people))
+        self.sids = [int2key(school_id) for _,school_id in open_schools]
+        self.layer_keys = [self.layer_key(school_type, school_id) for school_type, school_id in open_schools] # Layer that each school's edges go into
+
+        # Create the results object that schools record their statistics in, and the row that each school adds to
+        school_types = [school_type for school_type,_ in open_schools]
+        scenarios = {school_type:self.scenario[school_type] for school_type in dict.fromkeys(school_types)}
+        if self.stats_level == 'school':
+            self.results = SchoolResults(self.sids, school_types, sim.npts, scenarios, freq=self.stats_freq)
+            self.results_rows = np.arange(len(open_schools))
+        elif self.stats_level == 'district':
+            self.results = SchoolResults(['district'], ['all'], sim.npts, scenarios, freq=self.stats_freq)
+            self.results_rows = np.zeros(len(open_schools), dtype=np.int64)
+        else:
+            self.results = None
+            self.results_rows = np.zeros(len(open_schools), dtype=np.int64)
+        sim.school_stats = self.results
+
+        for k, ((school_type, school_id), lkey) in enumerate(zip(open_schools, self.layer_keys)):
+            uids = sim.people.schools[school_id] # Dict with keys of school_id and values of uids in that school
+            sid = int2key(school_id)
+
+            # With a single layer, beta_s differs between edges so is applied to each edge rather than to the layer
+            beta_s = self.scenario[school_type]['beta_s']
+            if self.layer_mode == 'single':
+                school_layers[school_id]['beta'] *= beta_s
+                beta_s = 1.0
+
+            if self.engine == 'schools':
+                sch = School(sim, school_id, school_type, uids, school_layers[school_id], copy_layers=self.copy_layers, calendar=self.calendar, batch_testing=self.batch_testing,
+                             results=self.results, results_row=self.results_rows[k], record_stats=self.results is not None, **self.scenario[school_type])
+                self.schools.append(sch)
+
+            # Configure the new layer
+            sim['beta_layer'][lkey] = beta_s
+            sim['iso_factor'][lkey] = sim['iso_factor']['s']
+            sim['quar_factor'][lkey] = sim['quar_factor']['s']
+
+        if self.engine == 'system':
+            from .school_system import SchoolSystem # Imported here since school_system imports from this module
+            self.system = SchoolSystem(sim, [school_type for school_type,_ in open_schools], [school_id for _,school_id in open_schools], school_layers, self.scenario, self.calendar,
+                                      layer_keys=self.layer_keys, results=self.results, results_rows=self.results_rows)
+
+        # Delete remaining entries in sim.people.contacts['s'], these were associated with schools that will not open, e.g. pk and uv
+        sim.people.contacts['s'] = cv.Layer()
 
-                if self.scenario[school_type] is not None:
+        # If starting part-way through the sim, e.g. in run_branches(), catch up on who would have been sent home so far
+        if sim.t:
+            self.send_home_diagnosed(sim)
 
-                    stats = {
-                        'type':         school_type,
-                        'scenario':     self.scenario[school_type],
-                    }
-                    sim.school_stats[int2key(school_id)] = stats
+        self.initialized = True
 
-                    # Extract 's'-layer associated with this school
-                    rows = (sdf['p1'].isin(uids)) | (sdf['p2'].isin(uids))
-                    s_subset = sdf.loc[ rows ]
-                    sdf = sdf.loc[ ~rows ] # Remove rows from the 's' contacts
-                    this_school_layer = cv.Layer().from_df(s_subset)
+    def send_home_diagnosed(self, sim):
+        '''
+        Send home everyone diagnosed before today, until the end of their quarantine
+        period. Before a school opens, and before any testing, this is all that a
+        school does each day, so this gives the same absences as having run from the
+        start of the sim.
+        '''
+        date_diagnosed = sim.people.date_diagnosed
+        for school in self.schools:
+            uids = school.uids[date_diagnosed[school.uids] < sim.t]
+            school.absences.send_home(uids, (date_diagnosed[uids] + sim['quar_period']).astype(np.int32))
+        if self.system is not None:
+            dx = date_diagnosed[self.system.uids] < sim.t
+            self.system.release_day[dx] = date_diagnosed[self.system.uids][dx] + sim['quar_period']
+        return
 
-                    sch = School(sim, school_id, school_type, uids, this_school_layer, **self.scenario[school_type])
-                    self.schools.append(sch)
+    def layer_key(self, school_type, school_id):
+        ''' The key of the contact layer used for this school, depending on the layer mode '''
+        if self.layer_mode == 'type':
+            return f's_{school_type}'
+        elif self.layer_mode == 'single':
+            return 's_all'
+        return int2key(school_id)
 
-                    # Configure the new layer
-                    sim['beta_layer'][sch.sid] = self.scenario[school_type]['beta_s']
-                    sim['iso_factor'][sch.sid] = sim['iso_factor']['s']
-                    sim['quar_factor'][sch.sid] = sim['quar_factor']['s']
+    def test_schools(self, sim):
+        '''
+        Conduct the testing due today in all schools, with one covasim test call per
+        test rather than one per school. Results are split back to each school for
+        n_tested accounting and, for antigen positives, sending people home.
+        '''
+        t = sim.t
+        due = self.calendar.due[t]
+        if not due:
+            return
 
-        # Delete remaining entries in sim.people.contacts['s'], these were associated with schools that will not open, e.g. pk and uv
-        sim.people.contacts['s'] = cv.Layer()
+        ppl = sim.people
+        for stype, test_inds in due.items():
+            schools = [school for school in self.schools if school.stype == stype]
+            if not schools:
+                continue
+            for i in test_inds:
+                test = self.calendar.tests[stype][i]
+                uids = np.concatenate([school.testing.test_uids[i] for school in schools])
+                school_inds = np.repeat(np.arange(len(schools)), [len(school.testing.test_uids[i]) for school in schools])
+
+                # Test a random subset of those not yet diagnosed
+                undiagnosed = ~ppl.diagnosed[uids]
+                uids, school_inds = uids[undiagnosed], school_inds[undiagnosed]
+                tested = cv.n_binomial(test['coverage'], len(uids))
+                uids, school_inds = uids[tested], school_inds[tested]
+                n_tested = np.bincount(school_inds, minlength=len(schools))
+
+                for school, n in zip(schools, n_tested):
+                    if school.verbose: print(sim.t, f'School {school.sid} of type {school.stype} is testing {n} today')
 
-        self.initialized = True
+                if test['is_antigen']:
+                    for school, n in zip(schools, n_tested):
+                        school.testing.n_tested['Antigen'] += n
+                    ag_pos_uids = antigen_test(uids, sim=sim, sym7d_sens=test['symp7d_sensitivity'], other_sens=test['other_sensitivity'], specificity=test['specificity'])
+                    order = np.argsort(uids, kind='stable')
+                    ag_school_inds = school_inds[order[np.searchsorted(uids[order], ag_pos_uids)]]
+
+                    followed_up = cv.n_binomial(test['PCR_followup_perc'], len(ag_pos_uids))
+                    ppl.test(ag_pos_uids[followed_up], test_sensitivity=1.0, test_delay=test['PCR_followup_delay'])
+                    n_followed_up = np.bincount(ag_school_inds[followed_up], minlength=len(schools))
+                    iso_days = np.where(followed_up, t+test['PCR_followup_delay'], t+sim.pars['quar_period']).astype(np.int32)
+                    for k in np.unique(ag_school_inds):
+                        schools[k].testing.n_tested['PCR'] += n_followed_up[k] # Also add follow-up PCR tests
+                        this_school = ag_school_inds == k
+                        schools[k].absences.send_home(ag_pos_uids[this_school], iso_days[this_school])
+                else:
+                    for school, n in zip(schools, n_tested):
+                        school.testing.n_tested['PCR'] += n
+                    ppl.test(uids, test_sensitivity=test['sensitivity'], test_delay=test['delay'])
+                    # N.B. No false positives for PCR
+        return
 
     def apply(self, sim):
-        for school in self.schools:
-            layer = school.update(sim)
-            sim.people.contacts[school.sid] = layer
+        if self.system is not None:
+            sim.people.contacts.update(self.system.update(sim))
+        if self.batch_testing and self.schools:
+            self.test_schools(sim)
+        if self.layer_mode == 'school':
+            for school in self.schools:
+                layer = school.update(sim)
+                sim.people.contacts[school.sid] = layer
+        elif self.schools:
+            layers = {}
+            for school, lkey in zip(self.schools, self.layer_keys):
+                layers.setdefault(lkey, []).append(school.update(sim))
+            for lkey, layer_list in layers.items():
+                sim.people.contacts[lkey] = merge_layers(layer_list)
 
         if sim.t == sim.npts-1:
             # Only needed on final time step:
+            if self.system is not None:
+                self.system.finalize()
             for school in self.schools:
-                sim.school_stats[school.sid].update(school.get_stats())
+                if school.stats is not None:
+                    school.stats.finalize()
             self.gather_stats(sim)
             self.schools = [] # Huge space savings if user saves this simulation due to python junk collection
+            self.system = None
 
 
     def gather_stats(self, sim):
@@ -133,24 +352,27 @@ class schools_manager(cv.Intervention):
             return sc.objdict({'students':0, 'teachers':0, 'staff':0, 'teachers+staff':0, 'all':0})
 
         # Keys to copy over/sum over from each school
-        shared_keys = ['num', 'infectious', 'infectious_arrive_at_school', 'infectious_stay_at_school', 'newly_exposed', 'scheduled', 'in_person']
+        shared_keys = ['num'] + SchoolResults.metrics
+
+        stats = sim.school_stats
+        if stats is None: # No statistics were recorded
+            sim.school_results = None
+            return None
 
         res = sc.objdict()
         res.shared_keys = shared_keys # Store this here for ease of later use
-        res.n_schools = len(self.schools)
-        res.n_school_days = sim.school_stats[self.schools[0].sid]['num_school_days'] # Should be the same for all schools
-        res.n_tested = sc.objdict({'PCR': 0, 'Antigen': 0})
+        res.n_schools = len(self.sids)
+        res.n_school_days = stats.meta['num_school_days'][0] # Should be the same for all schools
+        res.n_tested = sc.objdict({key:stats.meta[f'n_tested_{key}'].sum() for key in SchoolResults.tests})
         for key in shared_keys:
             res[key] = standard_res()
 
         # Count the stats
-        for school in self.schools:
-            stats = sim.school_stats[school.sid]
-            for group in ['students', 'teachers', 'staff']:
-                for key in shared_keys:
-                    res[key][group] += np.sum(stats[key][group]) # Main results
-            for key in res.n_tested.keys(): # Count tests
-                res.n_tested[key] += stats['n_tested'][key]
+        totals = stats.totals().sum(axis=0) # Sum over schools and time
+        for g,group in enumerate(SchoolResults.groups):
+            res['num'][group] = stats.meta[f'num_{group}'].sum()
+            for m,key in enumerate(SchoolResults.metrics):
+                res[key][group] = totals[m,g] # Main results
 
         # Compute combined keys
         for key in shared_keys:
@@ -163,6 +385,16 @@ class schools_manager(cv.Intervention):
 
 
 
+def merge_layers(layers):
+    ''' Concatenate the edges of several layers into a single layer '''
+    layers = [layer for layer in layers if len(layer)]
+    if len(layers) == 0:
+        return cv.Layer()
+    elif len(layers) == 1:
+        return layers[0]
+    return cv.Layer(**{key:np.concatenate([layer[key] for layer in layers]) for key in layers[0].meta_keys()})
+
+
 class SchoolScenario(cv.FlexDict):
     '''
     Lightweight class for ensuring the scenarios are specified correctly. See
@@ -260,12 +492,47 @@ class SchoolScenario(cv.FlexDict):
 
 
 
+class AbsenceLedger(sc.prettyobj):
+    '''
+    Keeps track of who in a school is at home, and until when. Release days are
+    stored in an int32 array aligned with the school's uids, with -1 meaning that
+    the person has not been sent home. A person is at home on day t if their
+    release day is t or later; sending someone home again overwrites their
+    release day.
+    '''
+
+    def __init__(self, uids):
+        self.uids = uids
+        self.order = np.argsort(uids, kind='stable') # Positions of the uids in sorted order, used for lookups
+        self.sorted_uids = uids[self.order]
+        self.release_day = np.full(len(uids), -1, dtype=np.int32)
+        return
+
+    def send_home(self, uids, release_day):
+        ''' Send people home until the release day (a scalar, or an array aligned with uids) '''
+        pos, found = find_positions(self.sorted_uids, self.order, uids)
+        if np.ndim(release_day):
+            release_day = np.asarray(release_day)[found]
+        self.release_day[pos] = release_day
+        return
+
+    def at_home(self, t):
+        ''' Boolean mask, aligned with the school's uids, of who is at home on day t '''
+        return self.release_day >= t
+
+    def uids_at_home(self, t):
+        ''' Sorted array of the uids of people who are at home on day t '''
+        return self.sorted_uids[self.at_home(t)[self.order]]
+
+
+
 class School(sc.prettyobj):
     ''' Represents a single school; handle the layer updates and coordinating testing and other tasks '''
 
     def __init__(self, sim, school_id, school_type, uids, layer,
                 start_day, screen_prob, screen2pcr, test_prob, trace_prob, quar_prob,
-                schedule, beta_s, ili_prob, testing, verbose=False, **kwargs):
+                schedule, beta_s, ili_prob, testing, verbose=False, copy_layers=False, calendar=None, batch_testing=False,
+                results=None, results_row=0, record_stats=True, **kwargs):
         '''
         Initialize the School
 
@@ -284,6 +551,13 @@ class School(sc.prettyobj):
         beta_s       (float)        : beta for this school
         ili_prob     (float)        : Daily probability of ILI
         testing      (struct)       : List of dictionaries of parameters for SchoolTesting
+        verbose      (bool)         : Whether to print details of what the school is doing
+        copy_layers  (bool)         : Whether the contact manager copies its layer each day, rather than masking it
+        calendar     (TestingCalendar) : Testing schedule shared between schools; if None, one is made from testing
+        batch_testing (bool)        : Whether testing is done for all schools at once by schools_manager.test_schools(), rather than in update()
+        results      (SchoolResults) : Results object to record statistics in; if None, the school gets its own
+        results_row  (int)          : Row of results that this school's statistics are added to
+        record_stats (bool)         : Whether to record statistics at all
         '''
 
         self.sid = int2key(school_id) # Convert to an string
@@ -299,27 +573,28 @@ class School(sc.prettyobj):
         self.beta_s = beta_s # Not currently used here, but rather in the school_intervention
         self.ili_prob = ili_prob
         self.verbose = verbose
+        self.batch_testing = batch_testing
 
-        # TODO: these flags should have been arrays in population.py, but weren't.  Convert here for performance.
+        # Populations made by make_population() already have boolean arrays, but older saved populations have lists
         sim.people.student_flag = np.array(sim.people.student_flag, dtype=bool)
         sim.people.teacher_flag = np.array(sim.people.teacher_flag, dtype=bool)
         sim.people.staff_flag = np.array(sim.people.staff_flag, dtype=bool)
 
         self.is_open = False # Schools start closed
 
-        self.uids_at_home = {} # Dict from uid to release date
+        self.absences = AbsenceLedger(self.uids) # Release day for each person sent home
 
         if self.schedule.lower() == 'hybrid':
-            self.ct_mgr = HybridContactManager(sim, self.uids, layer)
+            self.ct_mgr = HybridContactManager(sim, self.uids, layer, copy_layers=copy_layers)
         elif self.schedule.lower() == 'full':
-            self.ct_mgr = FullTimeContactManager(sim, self.uids, layer)
+            self.ct_mgr = FullTimeContactManager(sim, self.uids, layer, copy_layers=copy_layers)
         elif self.schedule.lower() == 'remote':
-            self.ct_mgr = RemoteContactManager(sim, self.uids, layer)
+            self.ct_mgr = RemoteContactManager(sim, self.uids, layer, copy_layers=copy_layers)
         else:
             print(f'Warning: Unrecognized schedule ({self.schedule}) passed to School class.')
 
-        self.stats = SchoolStats(self, sim)
-        self.testing = SchoolTesting(self, testing, sim)
+        self.stats = SchoolStats(self, sim, results=results, row=results_row) if record_stats else None
+        self.testing = SchoolTesting(self, testing, sim, calendar=calendar)
         self.empty_layer = cv.Layer() # Cache an empty layer
         return
 
@@ -354,8 +629,9 @@ class School(sc.prettyobj):
         ''' Process the day, return the school layer '''
 
         # Even if a school is not yet open, consider testing in the population
-        ids_to_iso = self.testing.update(sim)
-        self.uids_at_home.update(ids_to_iso)
+        if not self.batch_testing:
+            iso_uids, iso_days = self.testing.update(sim)
+            self.absences.send_home(iso_uids, iso_days)
 
         # Look for newly diagnosed people (by PCR)
         newly_dx_inds = cv.itrue(sim.people.date_diagnosed[self.uids] == sim.t, self.uids) # Diagnosed this time step, time to trace
@@ -363,17 +639,14 @@ class School(sc.prettyobj):
         if self.verbose and len(newly_dx_inds)>0: print(sim.t, f'School {self.sid} has {len(newly_dx_inds)} newly diagnosed: {newly_dx_inds}', [sim.people.date_exposed[u] for u in newly_dx_inds], 'recovering', [sim.people.date_recovered[u] for u in newly_dx_inds])
 
         # Isolate newly diagnosed individuals - could happen before school starts
-        for uid in newly_dx_inds:
-            self.uids_at_home[uid] = sim.t + sim.pars['quar_period'] # Can come back after quarantine period
-
-        # If any individuals are done with quarantine, return them to school
-        self.uids_at_home = {uid:date for uid,date in self.uids_at_home.items() if date >= sim.t} # >= or =?
+        self.absences.send_home(newly_dx_inds, sim.t + sim.pars['quar_period']) # Can come back after quarantine period
 
         # Check if school is open
         if not self.is_open:
             if sim.t == self.start_day:
                 if self.verbose:
-                    print(sim.t, self.sid, f'School {self.sid} is opening today with {len(self.uids_at_home)} at home: {self.uids_at_home}')
+                    uids_at_home = self.absences.uids_at_home(sim.t)
+                    print(sim.t, self.sid, f'School {self.sid} is opening today with {len(uids_at_home)} at home: {uids_at_home}')
 
                     infectious_uids = cv.itrue(sim.people.infectious[self.uids], self.uids)
                     print(sim.t, self.sid, 'Infectious:', len(cv.true(sim.people.infectious[self.uids])) * sim.rescale_vec[sim.t], len(infectious_uids) )
@@ -395,13 +668,12 @@ class School(sc.prettyobj):
             uids_to_quar = cv.binomial_filter(self.quar_prob, uids_reached_by_tracing)
 
             # Quarantine school contacts
-            for uid in uids_to_quar:
-                self.uids_at_home[uid] = sim.t + sim.pars['quar_period'] # Can come back after quarantine period
+            self.absences.send_home(uids_to_quar, sim.t + sim.pars['quar_period']) # Can come back after quarantine period
 
             # N.B. Not intentionally testing those in quarantine other than what covasim already does
 
         # Determine who will arrive at school (used in screen() and stats.update())
-        self.uids_arriving_at_school = np.setdiff1d(self.scheduled_uids, np.fromiter(self.uids_at_home.keys(), dtype=int))
+        self.uids_arriving_at_school = np.setdiff1d(self.scheduled_uids, self.absences.uids_at_home(sim.t))
 
         # Perform symptom screening
         screen_pos_ids = self.screen(sim)
@@ -414,21 +686,19 @@ class School(sc.prettyobj):
             self.testing.n_tested['PCR'] += len(uids_to_test) # Ugly, move all testing in to the SchoolTesting class!
 
             # Send the screen positives home - quar_period if no PCR and otherwise the time to the PCR
-            for uid in uids_to_test:
-                self.uids_at_home[uid] = sim.t + self.screen2pcr # Can come back after PCR results are in
-
-            for uid in np.setdiff1d(screen_pos_ids, uids_to_test):
-                self.uids_at_home[uid] = sim.t + sim.pars['quar_period'] # Can come back after quarantine period
+            self.absences.send_home(uids_to_test, sim.t + self.screen2pcr) # Can come back after PCR results are in
+            self.absences.send_home(np.setdiff1d(screen_pos_ids, uids_to_test), sim.t + sim.pars['quar_period']) # Can come back after quarantine period
 
 
         # Determine (for tracking, mostly) who has arrived at school and passed symptom screening
-        uids_at_home_array = np.fromiter(self.uids_at_home.keys(), dtype=int)
+        uids_at_home_array = self.absences.uids_at_home(sim.t)
         self.uids_passed_screening = np.setdiff1d(self.scheduled_uids, uids_at_home_array)
 
         # Remove individuals at home from the network
         self.ct_mgr.remove_individuals(uids_at_home_array)
 
-        self.stats.update(sim)
+        if self.stats is not None:
+            self.stats.update(sim)
         # if sim.t == sim.npts-1:
         #     self.stats.finalize()
 
@@ -442,101 +712,126 @@ class School(sc.prettyobj):
 
 
 
+def antigen_test(inds, sym7d_sens=1.0, other_sens=1.0, specificity=1, loss_prob=0.0, sim=None):
+    '''
+    Adapted from the test() method on sim.people to do antigen testing. Main change is that sensitivity is now broken into those symptomatic in the past week and others.
+
+    The state of the people tested is gathered once, the probability of a positive
+    result is computed for each of them, and a single draw decides who is positive.
+    Infectious people who have not been diagnosed test positive with the sensitivity
+    for their group (and are not lost to follow-up); everyone else tests positive
+    with probability 1-specificity.
+
+    Args:
+        inds: indices of who to test
+        sym7d_sens (float): probability of a true positive in a recently symptomatic individual (7d)
+        other_sens (float): probability of a true positive in others
+        specificity (float): probability of a true negative in those not infectious
+        loss_prob (float): probability of loss to follow-up
+        sim (Sim): the simulation object
+
+    Returns:
+        Sorted array of the uids who tested positive
+    '''
+
+    ppl = sim.people
+    t = sim.t
+
+    inds = np.unique(inds)
+    # Antigen tests don't count towards stats (yet), and do not set date_diagnosed, which would interfere with later PCR
+
+    is_infectious_not_dx = ppl.infectious[inds] & ~ppl.diagnosed[inds]
+    recently_symp = is_infectious_not_dx & ppl.symptomatic[inds] & (t - ppl.date_symptomatic[inds] < 7)
+
+    prob = np.where(recently_symp, sym7d_sens, other_sens) * (1.0 - loss_prob) # Higher sensitivity for <7 days
+    prob = np.where(is_infectious_not_dx, prob, 1.0 - specificity) # False positives
+    return inds[cv.binomial_arr(prob)]
+
+
+
+class TestingCalendar(sc.prettyobj):
+    '''
+    The testing schedule for a sim, compiled once and shared by all schools. For
+    each school type, tests holds the list of test specifications; due holds, for
+    each day, a dict from school type to the indices of the tests due that day,
+    and is empty on days without testing.
+
+    Args:
+        testing (dict): school type to the list of tests for that type, e.g. {'es': [test_pars]}
+        sim (Sim): the simulation object
+    '''
+
+    def __init__(self, testing, sim):
+        self.tests = {}
+        self.due = [{} for t in range(sim.npts)]
+        for stype, tests in testing.items():
+            self.tests[stype] = sc.dcp(sc.promotetolist(tests))
+            for i,test in enumerate(self.tests[stype]):
+                if 'is_antigen' not in test:
+                    test['is_antigen'] = False
+
+                # Determine from test start_day and repeat which sim times to test on
+                start_t = sim.day(test['start_date'])
+                if test['repeat'] == None:
+                    t_vec = [start_t] # Easy - one time test
+                else:
+                    t_vec = range(start_t, sim.pars['n_days'], test['repeat'])
+                for t in t_vec:
+                    if 0 <= t < sim.npts:
+                        self.due[t].setdefault(stype, []).append(i)
+        return
+
+    def tests_due(self, t, stype):
+        ''' Return the list of (index, test) pairs due for this school type on day t '''
+        return [(i, self.tests[stype][i]) for i in self.due[t].get(stype, [])]
+
+
+
 class SchoolTesting(sc.prettyobj):
     '''
-    Conduct testing in school students and staff.
+    Conduct testing in school students and staff. The schedule and test
+    specifications come from a TestingCalendar shared between schools; only
+    the uids to test are stored per school.
 
     N.B. screening with follow-up testing is handled in the School class.
     '''
 
-    def __init__(self, school, testing, sim):
-        ''' Initialize testing. '''
+    def __init__(self, school, testing, sim, calendar=None):
+        ''' Initialize testing; a calendar for this school's type is created if none is supplied '''
 
         self.school = school
-        self.testing = [] if testing is None else sc.dcp(testing)
-
-        for test in self.testing:
-            if 'is_antigen' not in test:
-                test['is_antigen'] = False
+        if calendar is None:
+            calendar = TestingCalendar({school.stype: [] if testing is None else testing}, sim)
+        self.calendar = calendar
+        self.testing = calendar.tests.get(school.stype, [])
 
         self.n_tested = { 'PCR': 0, 'Antigen': 0 }
 
+        # Determine uids to include in each test
+        self.test_uids = []
+        ppl = sim.people
         for test in self.testing:
-            # Determine from test start_day and repeat which sim times to test on
-            start_t = sim.day(test['start_date'])
-            if test['repeat'] == None:
-                # Easy - one time test
-                test['t_vec'] = [start_t]
-            else:
-                test['t_vec'] = list(range(start_t, sim.pars['n_days'], test['repeat']))
-
-            # Determine uids to include
             uids = []
-            ppl = sim.people
             if 'students' in test['groups']:
                 uids.append( cv.itruei(ppl.student_flag, self.school.uids) )
             if 'staff' in test['groups']:
                 uids.append( cv.itruei(ppl.staff_flag, self.school.uids) )
             if 'teachers' in test['groups']:
                 uids.append( cv.itruei(ppl.teacher_flag, self.school.uids) )
-            test['uids'] = np.concatenate(uids)
+            self.test_uids.append(np.concatenate(uids))
 
 
     def antigen_test(self, inds, sym7d_sens=1.0, other_sens=1.0, specificity=1, loss_prob=0.0, sim=None):
-        '''
-        Adapted from the test() method on sim.people to do antigen testing. Main change is that sensitivity is now broken into those symptomatic in the past week and others.
-
-        Args:
-            inds: indices of who to test
-            sym7d_sens (float): probability of a true positive in a recently symptomatic individual (7d)
-            other_sens (float): probability of a true positive in others
-            loss_prob (float): probability of loss to follow-up
-            delay (int): number of days before test results are ready
-        '''
-
-        ppl = sim.people
-        t = sim.t
-
-        inds = np.unique(inds)
-        # Antigen tests don't count towards stats (yet)
-        #ppl.tested[inds] = True
-        #ppl.date_tested[inds] = t # Only keep the last time they tested
-        #ppl.date_results[inds] = t + delay # Keep date when next results will be returned
-
-        is_infectious_not_dx = cv.itruei(ppl.infectious * ~ppl.diagnosed, inds)
-        symp = cv.itruei(ppl.symptomatic, is_infectious_not_dx)
-        recently_symp_inds = symp[t-ppl.date_symptomatic[symp] < 7]
-
-        other_inds = np.setdiff1d(is_infectious_not_dx, recently_symp_inds)
-
-        is_inf_pos = np.concatenate((
-            cv.binomial_filter(sym7d_sens, recently_symp_inds), # Higher sensitivity for <7 days
-            cv.binomial_filter(other_sens, other_inds)          # Lower sensitivity of otheres
-        ))
-
-        not_lost           = cv.n_binomial(1.0-loss_prob, len(is_inf_pos))
-        true_positive_uids = is_inf_pos[not_lost]
-
-        # Store the date the person will be diagnosed, as well as the date they took the test which will come back positive
-        # Not for antigen tests?  date_diagnosed would interfere with later PCR.
-        #ppl.date_diagnosed[true_positive_uids] = t + delay
-        #ppl.date_pos_test[true_positive_uids] = t
-
-        # False positivies
-        if specificity < 1:
-            non_infectious_uids = np.setdiff1d(inds, is_infectious_not_dx)
-            false_positive_uids = cv.binomial_filter(1-specificity, non_infectious_uids)
-        else:
-            false_positive_uids = np.empty(0, dtype=np.int64)
-
-        # At low prevalence, true_positive_uids will likely outnumber false_positive_uids
-        return np.concatenate((true_positive_uids, false_positive_uids))
+        ''' Antigen test the people in inds; see antigen_test() '''
+        return antigen_test(inds, sym7d_sens=sym7d_sens, other_sens=other_sens, specificity=specificity, loss_prob=loss_prob, sim=sim)
 
 
     def update(self, sim):
         '''
         Check for testing today and conduct tests if needed.
-        True positives return via date_diagnosed, false positives are returned via this function.
+        True positives return via date_diagnosed, while antigen positives (including
+        false positives) are returned via this function as an array of uids to send
+        home and an array of the days on which they can return.
 
         Fields include:
             * 'start_date': '2020-08-29',
@@ -551,117 +846,123 @@ class SchoolTesting(sc.prettyobj):
         # false_positive_uids = []
         ppl = sim.people
         t = sim.t
-        ids_to_iso = {}
-        for test in self.testing:
-            if sim.t in test['t_vec']:
-                undiagnosed_uids = cv.ifalsei(ppl.diagnosed, test['uids'])
-                uids_to_test = cv.binomial_filter(test['coverage'], undiagnosed_uids)
-
-                if self.school.verbose: print(sim.t, f'School {self.school.sid} of type {self.school.stype} is testing {len(uids_to_test)} today')
-
-                if test['is_antigen']:
-                    self.n_tested['Antigen'] += len(uids_to_test)
-                    ag_pos_uids = self.antigen_test(uids_to_test, sim=sim, sym7d_sens=test['symp7d_sensitivity'], other_sens=test['other_sensitivity'], specificity=test['specificity'])
-
-                    pcr_fu_uids = cv.binomial_filter(test['PCR_followup_perc'], ag_pos_uids)
-                    ppl.test(pcr_fu_uids, test_sensitivity=1.0, test_delay=test['PCR_followup_delay'])
-                    #sim.results['new_tests'][t] += len(pcr_fu_uids)
-                    self.n_tested['PCR'] += len(pcr_fu_uids) # Also add follow-up PCR tests
-
-                    ids_to_iso = {uid:t+test['PCR_followup_delay'] for uid in pcr_fu_uids}
-                    non_pcr_uids = np.setdiff1d(ag_pos_uids, pcr_fu_uids)
-                    ids_to_iso.update({uid:t+sim.pars['quar_period'] for uid in non_pcr_uids})
-                else:
-                    self.n_tested['PCR'] += len(uids_to_test)
-                    ppl.test(uids_to_test, test_sensitivity=test['sensitivity'], test_delay=test['delay'])
-                    #sim.results['new_tests'][t] += len(uids_to_test)
-                    # N.B. No false positives for PCR
+        tests_due = self.calendar.tests_due(t, self.school.stype)
+        if not tests_due:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+        iso_uids = []
+        iso_days = []
+        for i, test in tests_due:
+            undiagnosed_uids = cv.ifalsei(ppl.diagnosed, self.test_uids[i])
+            uids_to_test = cv.binomial_filter(test['coverage'], undiagnosed_uids)
+
+            if self.school.verbose: print(sim.t, f'School {self.school.sid} of type {self.school.stype} is testing {len(uids_to_test)} today')
+
+            if test['is_antigen']:
+                self.n_tested['Antigen'] += len(uids_to_test)
+                ag_pos_uids = self.antigen_test(uids_to_test, sim=sim, sym7d_sens=test['symp7d_sensitivity'], other_sens=test['other_sensitivity'], specificity=test['specificity'])
+
+                pcr_fu_uids = cv.binomial_filter(test['PCR_followup_perc'], ag_pos_uids)
+                ppl.test(pcr_fu_uids, test_sensitivity=1.0, test_delay=test['PCR_followup_delay'])
+                #sim.results['new_tests'][t] += len(pcr_fu_uids)
+                self.n_tested['PCR'] += len(pcr_fu_uids) # Also add follow-up PCR tests
+
+                non_pcr_uids = np.setdiff1d(ag_pos_uids, pcr_fu_uids)
+                iso_uids += [pcr_fu_uids, non_pcr_uids]
+                iso_days += [np.full(len(pcr_fu_uids), t+test['PCR_followup_delay']), np.full(len(non_pcr_uids), t+sim.pars['quar_period'])]
+            else:
+                self.n_tested['PCR'] += len(uids_to_test)
+                ppl.test(uids_to_test, test_sensitivity=test['sensitivity'], test_delay=test['delay'])
+                #sim.results['new_tests'][t] += len(uids_to_test)
+                # N.B. No false positives for PCR
 
-        return ids_to_iso
+        if len(iso_uids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        return np.concatenate(iso_uids).astype(np.int64), np.concatenate(iso_days).astype(np.int32)
 
 
 
 class SchoolStats(sc.prettyobj):
-    ''' Reporter for tracking statistics associated with a school '''
+    '''
+    Reporter for tracking statistics associated with a school. The uids and
+    membership masks of each group are computed once, and each statistic is a
+    view into a row of a preallocated SchoolResults array, so daily updates only
+    count within the school. Counts are added to the row, so several schools can
+    share one (e.g. for district-level statistics); if no results object is
+    supplied, the school gets a row of its own.
+    '''
 
-    def __init__(self, school, sim):
+    def __init__(self, school, sim, results=None, row=0):
         self.school = school
-
-        zero_vec = [0] * sim.npts
+        if results is None:
+            results = SchoolResults([school.sid], [school.stype], sim.npts, {})
+        self.results = results
+        self.row = row
 
         ppl = sim.people
         pop_scale = sim.pars['pop_scale']
-        student_uids = cv.itruei(ppl.student_flag, self.school.uids)
-        teacher_uids = cv.itruei(ppl.teacher_flag, self.school.uids)
-        staff_uids = cv.itruei(ppl.staff_flag, self.school.uids)
+        uids = self.school.uids
+        self.groups = ['students', 'teachers', 'staff']
+        flags = [ppl.student_flag, ppl.teacher_flag, ppl.staff_flag]
+
+        # Membership of each group, as a mask aligned with the school's uids and as an array of uids
+        self.group_masks = {group:np.array(flag, dtype=bool)[uids] for group,flag in zip(self.groups, flags)}
+        self.group_uids = {group:uids[mask] for group,mask in self.group_masks.items()}
 
         self.num_school_days = 0
 
-        self.num = {
-            'students':   len(student_uids) * pop_scale,
-            'teachers':   len(teacher_uids) * pop_scale,
-            'staff':      len(staff_uids) * pop_scale,
-        }
+        self.num = {group:len(self.group_uids[group]) * pop_scale for group in self.groups}
+
+        # Results arrays, as views into the row of the results object
+        for m,metric in enumerate(results.metrics):
+            setattr(self, metric, {group:results.data[row,m,g,:] for g,group in enumerate(results.groups)})
 
-        # Initialize results arrays
-        base_result = {key:sc.dcp(zero_vec) for key in ['students', 'teachers', 'staff']}
-        self.infectious = sc.dcp(base_result)
-        self.infectious_arrive_at_school = sc.dcp(base_result)
-        self.infectious_stay_at_school = sc.dcp(base_result)
-        self.newly_exposed = sc.dcp(base_result)
-        self.scheduled = sc.dcp(base_result)
-        self.in_person = sc.dcp(base_result)
+
+    def count(self, uids, include=None):
+        ''' Count the uids (optionally only those where include is True) in each group '''
+        absences = self.school.absences
+        pos, found = find_positions(absences.sorted_uids, absences.order, uids)
+        if include is not None:
+            pos = pos[include[found]]
+        return {group:np.count_nonzero(mask[pos]) for group,mask in self.group_masks.items()}
 
 
     def update(self, sim):
         ''' Called on each day to update school statistics '''
 
         t = sim.t
+        b = self.results.bin(t)
         ppl = sim.people
         rescale = sim.rescale_vec[t]
 
         if self.school.ct_mgr.school_day:
             self.num_school_days += 1
 
-        student_uids = cv.itruei(ppl.student_flag, self.school.uids)
-        teacher_uids = cv.itruei(ppl.teacher_flag, self.school.uids)
-        staff_uids = cv.itruei(ppl.staff_flag, self.school.uids)
-
-        infectious_ids = {}
-        for group, ids in zip(['students', 'teachers', 'staff'], [student_uids, teacher_uids, staff_uids]):
-            infectious_ids[group] = cv.true(ppl.infectious[ids])
-            self.infectious[group][t] = len(infectious_ids[group]) * rescale
-            self.newly_exposed[group][t] = len(cv.true(ppl.date_exposed[ids] == t-1)) * rescale
-            self.scheduled[group][t] = len(np.intersect1d(self.school.scheduled_uids, ids)) * rescale # Scheduled
-            self.in_person[group][t] = len(np.intersect1d(self.school.uids_passed_screening, ids)) * rescale # Post-screening
-
-        # Tracing statistics to compare against previous work:
-        # if len(self.school.uids_arriving_at_school) > 0:
-        #     school_infectious = cv.itrue(ppl.infectious[self.school.uids_arriving_at_school], self.school.uids_arriving_at_school)
-        # else:
-        #     school_infectious = np.empty(0, dtype='int64')
-
-        # Options here: (TODO - avoid code replication)
+        for group, ids in self.group_uids.items():
+            self.infectious[group][b] += np.count_nonzero(ppl.infectious[ids]) * rescale
+            self.newly_exposed[group][b] += np.count_nonzero(ppl.date_exposed[ids] == t-1) * rescale
+
+        # Options here:
         # 1. Use ids of students who arrived as school (pre-screening): self.school.uids_arriving_at_school (pre-screening)
         # 2. Use ids of students who passed screening: self.school.uids_passed_screening
         # First "infectious_arrive_at_school" assumes there is a transmission risk even pre-screening (e.g. bus)
-
-        n_students_at_school = len(cv.itruei(ppl.student_flag * ppl.infectious, self.school.uids_arriving_at_school))
-        n_teachers_at_school = len(cv.itruei(ppl.teacher_flag * ppl.infectious, self.school.uids_arriving_at_school))
-        n_staff_at_school    = len(cv.itruei(ppl.staff_flag * ppl.infectious, self.school.uids_arriving_at_school))
-        for group, count in zip(['students', 'teachers', 'staff'], [n_students_at_school, n_teachers_at_school, n_staff_at_school]):
-            self.infectious_arrive_at_school[group][t] = count * rescale
-
         # Second "infectious_stay_at_school" effectively assumes "screen-positive" kids would be kept home from school in the first place
-        n_students_passedscreening = len(cv.itruei(ppl.student_flag * ppl.infectious, self.school.uids_passed_screening))
-        n_teachers_passedscreening = len(cv.itruei(ppl.teacher_flag * ppl.infectious, self.school.uids_passed_screening))
-        n_staff_passedscreening    = len(cv.itruei(ppl.staff_flag * ppl.infectious, self.school.uids_passed_screening))
-        for group, count in zip(['students', 'teachers', 'staff'], [n_students_passedscreening, n_teachers_passedscreening, n_staff_passedscreening]):
-            self.infectious_stay_at_school[group][t] = count * rescale
+        arriving = self.school.uids_arriving_at_school
+        passed = self.school.uids_passed_screening
+        counts = {
+            'scheduled': self.count(self.school.scheduled_uids), # Scheduled
+            'in_person': self.count(passed), # Post-screening
+            'infectious_arrive_at_school': self.count(arriving, ppl.infectious[arriving]),
+            'infectious_stay_at_school': self.count(passed, ppl.infectious[passed]),
+        }
+        for key, group_counts in counts.items():
+            for group, count in group_counts.items():
+                getattr(self, key)[group][b] += count * rescale
 
-    # def finalize(self):
-    #     ''' Called once on the final time step '''
-    #     return
+    def finalize(self):
+        ''' Called once on the final time step to add the school's sizes and test counts to the results '''
+        self.results.add_meta(self.row, self.num, self.num_school_days, self.school.testing.n_tested)
+        return
 
 
     def get(self):
@@ -681,42 +982,144 @@ class SchoolStats(sc.prettyobj):
 
 
 
+class ContactIndex(sc.prettyobj):
+    '''
+    Compressed-sparse-row neighbor index of a school's contacts, built once when
+    the school is initialized. Rows are positions in the school's uids (plus one
+    extra row for people from outside the school) and the stored neighbors are
+    uids, with duplicate pairs removed. Finding the contacts of a batch of people
+    is then a gather over the row offsets, so it costs in proportion to their
+    degree rather than to the size of the layer.
+    '''
+
+    def __init__(self, p1_pos, p2_pos, p1, p2, n):
+        src = np.concatenate((p1_pos, p2_pos)) # Contacts are bidirectional
+        dst = np.concatenate((p2, p1))
+
+        # Sort by row and remove duplicate pairs
+        order = np.lexsort((dst, src))
+        src = src[order]
+        dst = dst[order]
+        keep = np.ones(len(src), dtype=bool)
+        keep[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+
+        self.neighbors = dst[keep]
+        self.indptr = np.zeros(n+2, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(src[keep], minlength=n+1))
+        return
+
+    def find_contacts(self, pos):
+        ''' Return the sorted, unique uids of the contacts of the people at these positions '''
+        starts = self.indptr[pos]
+        counts = self.indptr[pos+1] - starts
+        total = counts.sum()
+        if total == 0:
+            return np.empty(0, dtype=self.neighbors.dtype)
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total) # Index of each neighbor in self.neighbors
+        return np.unique(self.neighbors[offsets])
+
+    def rows(self):
+        ''' The row (position) of each stored neighbor '''
+        return np.repeat(np.arange(len(self.indptr)-1), np.diff(self.indptr))
+
+    def remove(self, drop):
+        ''' Remove the stored neighbors where drop is True, in place '''
+        rows = self.rows()[~drop]
+        self.neighbors = self.neighbors[~drop]
+        self.indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(self.indptr)-1))
+        return
+
+
+
 class ContactManager(sc.prettyobj):
-    ''' Base class for the contact managers below '''
+    '''
+    Base class for the contact managers below. By default the base layer is
+    never modified: each day's layer is built by masking its edges with who is
+    present, so only the active edges are allocated. With copy_layers=True, the
+    base layer is instead deep copied each day and absent individuals are popped
+    from the copy.
+    '''
 
-    def __init__(self, uids, layer):
+    def __init__(self, uids, layer, copy_layers=False):
         self.uids = uids
         self.base_layer = layer
+        self.copy_layers = copy_layers
         self.school_day = False
+
+        # Position of each edge's endpoints in uids, used to mask edges by who is present
+        self.order = np.argsort(uids, kind='stable')
+        self.sorted_uids = uids[self.order]
+        self.p1_pos = self.positions(layer['p1'])
+        self.p2_pos = self.positions(layer['p2'])
+        self.edge_mask = np.zeros(len(layer), dtype=bool)
+        self.empty_layer = cv.Layer()
+        self.contact_index = self.make_index(np.ones(len(layer), dtype=bool))
         return
 
+    def make_index(self, edge_mask):
+        ''' Build the contact tracing index from the edges in edge_mask '''
+        layer = self.base_layer
+        return ContactIndex(self.p1_pos[edge_mask], self.p2_pos[edge_mask], layer['p1'][edge_mask], layer['p2'][edge_mask], len(self.uids))
+
+    def positions(self, uids):
+        ''' Positions of uids in this school; people from outside the school map to an extra slot after the last position '''
+        pos, found = find_positions(self.sorted_uids, self.order, uids)
+        output = np.full(len(found), len(self.uids), dtype=np.int64)
+        output[found] = pos
+        return output
+
     def begin_day(self, date):
         ''' Called at the beginning of each day to configure the school layer -- implemented by each manager '''
         raise NotImplementedError()
 
+    def start_layer(self, edge_mask):
+        ''' Start the day's layer from the edges in edge_mask, which is not modified '''
+        if self.copy_layers:
+            if edge_mask.all():
+                self.layer = sc.dcp(self.base_layer)
+            elif edge_mask.any():
+                self.layer = cv.Layer(**{key:self.base_layer[key][edge_mask] for key in self.base_layer.meta_keys()})
+            else:
+                self.layer = cv.Layer() # Empty
+        else:
+            self.edge_mask = edge_mask.copy()
+        return
+
     def find_contacts(self, uids):
-        ''' Finds contacts of individuals listed in uids, including those who are absent from school -- implemented by each manager '''
-        raise NotImplementedError()
+        ''' Finds contacts of individuals listed in uids, including those who are absent from school '''
+        return self.contact_index.find_contacts(find_positions(self.sorted_uids, self.order, uids)[0])
 
     def remove_individuals(self, uids):
         ''' Remove one or more individual from the contact network '''
-        rows = np.concatenate((
-            np.isin(self.layer['p1'], uids).nonzero()[0],
-            np.isin(self.layer['p2'], uids).nonzero()[0]))
-        self.layer.pop_inds(rows)
+        if self.copy_layers:
+            rows = np.concatenate((
+                np.isin(self.layer['p1'], uids).nonzero()[0],
+                np.isin(self.layer['p2'], uids).nonzero()[0]))
+            self.layer.pop_inds(rows)
+        else:
+            present = np.ones(len(self.uids)+1, dtype=bool) # The extra slot is for people from outside the school, who are never removed
+            present[find_positions(self.sorted_uids, self.order, uids)[0]] = False
+            self.edge_mask &= present[self.p1_pos] & present[self.p2_pos]
         return
 
     def get_layer(self):
         ''' Return the layer '''
-        return self.layer
+        if self.copy_layers:
+            return self.layer
+        elif not self.edge_mask.any():
+            return self.empty_layer
+        else:
+            return cv.Layer(**{key:self.base_layer[key][self.edge_mask] for key in self.base_layer.meta_keys()})
 
 
 
 class FullTimeContactManager(ContactManager):
     ''' Contact manager for regular 5-day-per-week school '''
 
-    def __init__(self, sim, uids, layer):
-        super().__init__(uids, layer)
+    def __init__(self, sim, uids, layer, copy_layers=False):
+        super().__init__(uids, layer, copy_layers=copy_layers)
+        self.all_edges = np.ones(len(layer), dtype=bool)
+        self.no_edges = np.zeros(len(layer), dtype=bool)
         self.schedule = {
             'Monday':    'all',
             'Tuesday':   'all',
@@ -737,28 +1140,25 @@ class FullTimeContactManager(ContactManager):
         # Could modify layer based on group
         if group == 'all':
             # Start with the original layer, will remove uids at home later
-            self.layer = sc.dcp(self.base_layer) # needed?
+            self.start_layer(self.all_edges)
             uids = self.uids
         else:
-            self.layer = cv.Layer() # Empty
+            self.start_layer(self.no_edges) # Empty
             uids = np.empty(0, dtype='int64')
         return uids # Everyone is scheduled for school today, unless it's a weekend
 
-    def find_contacts(self, uids):
-        ''' Finds contacts of individuals listed in uids, including those who are absent from school '''
-        return self.base_layer.find_contacts(uids)
-
 
 
 class HybridContactManager(ContactManager):
     ''' Contact manager for hybrid school '''
 
-    def __init__(self, sim, uids, layer):
-        super().__init__(uids, layer)
+    def __init__(self, sim, uids, layer, copy_layers=False):
+        super().__init__(uids, layer, copy_layers=copy_layers)
         self.students = cv.itruei(sim.people.student_flag, self.uids)
         self.staff = cv.itruei(sim.people.staff_flag, self.uids)
         self.teachers = cv.itruei(sim.people.teacher_flag, self.uids)
         self.A_base_layer, self.B_base_layer = self.split_layer()
+        self.no_edges = np.zeros(len(layer), dtype=bool)
         self.schedule = {
             'Monday':    'A',
             'Tuesday':   'A',
@@ -777,17 +1177,20 @@ class HybridContactManager(ContactManager):
         self.A_group = np.concatenate((self.A_students, self.teachers, self.staff))
         self.B_group = np.concatenate((self.B_students, self.teachers, self.staff))
 
-        A_layer = sc.dcp(self.base_layer)   # start with the full layer
-        rows = np.concatenate((             # find all edges with a vertex in group B students
-                np.isin(A_layer['p1'], self.B_students).nonzero()[0],
-                np.isin(A_layer['p2'], self.B_students).nonzero()[0]))
-        A_layer.pop_inds(rows)              # remove these edges from layer A
+        p1 = self.base_layer['p1']
+        p2 = self.base_layer['p2']
+        self.A_edges = ~(np.isin(p1, self.B_students) | np.isin(p2, self.B_students)) # Remove all edges with a vertex in group B students from layer A
+        self.B_edges = ~(np.isin(p1, self.A_students) | np.isin(p2, self.A_students)) # Remove all edges with a vertex in group A students from layer B
+
+        A_layer = cv.Layer(**{key:self.base_layer[key][self.A_edges] for key in self.base_layer.meta_keys()})
+        B_layer = cv.Layer(**{key:self.base_layer[key][self.B_edges] for key in self.base_layer.meta_keys()})
 
-        B_layer = sc.dcp(self.base_layer)   # start with the full layer
-        rows = np.concatenate((             # find all edges with a vertex in group A students
-                np.isin(B_layer['p1'], self.A_students).nonzero()[0],
-                np.isin(B_layer['p2'], self.A_students).nonzero()[0]))
-        B_layer.pop_inds(rows)              # remove these edges from layer B
+        # Contacts are traced in both sublayers, so drop the edges in neither -- between an A and a B student -- from the base index
+        cohort = np.zeros(len(self.uids)+1, dtype=np.int8) # 1 for A students, 2 for B students, 0 otherwise and for people from outside the school
+        cohort[self.positions(self.A_students)] = 1
+        cohort[self.positions(self.B_students)] = 2
+        index = self.contact_index
+        index.remove(cohort[index.rows()]*cohort[self.positions(index.neighbors)] == 2)
 
         return A_layer, B_layer
 
@@ -799,35 +1202,24 @@ class HybridContactManager(ContactManager):
 
         # Could modify layer based on group
         if group == 'A':
-            self.layer = sc.dcp(self.A_base_layer) # needed?
+            self.start_layer(self.A_edges)
             uids = self.A_group
         elif group == 'B':
-            self.layer = sc.dcp(self.B_base_layer) # needed?
+            self.start_layer(self.B_edges)
             uids = self.B_group
         else:
             uids = np.empty(0, dtype='int64')
-            self.layer = cv.Layer() # Empty
+            self.start_layer(self.no_edges) # Empty
 
         return uids # Hybrid scheduling
 
-    def find_contacts(self, uids):
-        ''' Finds contacts of individuals listed in uids, including those who are absent from school.
-            Look in A_base_layer as well as B_base_layer for uids and return contacts.
-            Join together contacts of A-students in A-layer with B-students in B-layer
-        '''
-        contacts = np.concatenate((
-            self.A_base_layer.find_contacts(uids),
-            self.B_base_layer.find_contacts(uids) ))
-        return contacts
-
 
 
 class RemoteContactManager(ContactManager):
     ''' Contact manager for remote school '''
 
-    def __init__(self, sim, uids, layer):
-        super().__init__(uids, layer)
-        self.base_layer = cv.Layer() # Empty base layer (ignore the passed-in layer)
+    def __init__(self, sim, uids, layer, copy_layers=False):
+        super().__init__(uids, cv.Layer(), copy_layers=copy_layers) # Empty base layer (ignore the passed-in layer)
         return
 
     def begin_day(self, date):
@@ -840,6 +1232,10 @@ class RemoteContactManager(ContactManager):
         ''' No individuals to remove, so just return '''
         return
 
+    def get_layer(self):
+        ''' Always empty '''
+        return self.layer
+
     def find_contacts(self, uids):
         ''' No contacts because remote, return empty list '''
         return np.empty(0, dtype='int64')
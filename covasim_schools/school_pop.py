@@ -8,6 +8,76 @@ import sciris as sc
 import covasim as cv
 import synthpops as sp
 
+# Codes used in the school_type_code and school_role arrays of the population; people not in a school have code -1
+school_type_keys = ['pk', 'es', 'ms', 'hs', 'uv']
+school_role_keys = ['student', 'teacher', 'staff']
+
+
+def school_columns(population, pop_size):
+    '''
+    Extract the school membership of each person from a SynthPops population.
+
+    A single pass over the population pulls out the school ID, type, and role of
+    each person in a school; everything else is done with array operations. A person with more
+    than one role takes the first of teacher, student, and staff.
+
+    Args:
+        population (dict): SynthPops population, as returned by sp.make_population()
+        pop_size (int): number of people
+
+    Returns:
+        A dict with the following entries, to be passed to cv.People():
+
+            - school_id (int32 array): school of each person, or -1 if none
+            - school_type_code (int8 array): index of each person's school type in school_type_keys, or -1
+            - school_role (int8 array): index of each person's role in school_role_keys, or -1
+            - student_flag, teacher_flag, staff_flag (bool arrays): whether each person has that role
+            - schools (dict): school ID to an array of the uids in that school, in order of first appearance
+            - school_types (dict): school type to a list of the IDs of schools of that type
+    '''
+
+    # The only loop: pull out the school, type, and role of each person in a school
+    type_codes = {stype:k for k,stype in enumerate(school_type_keys)}
+    rows = [(uid, p['scid'], type_codes.get(p['sc_type'], -1), 1 if p['sc_teacher'] is not None else 0 if p['sc_student'] is not None else 2 if p['sc_staff'] is not None else -1)
+            for uid,p in population.items() if p['scid'] is not None]
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 4)
+    if (rows[:,2] < 0).any():
+        unknown = {p['sc_type'] for p in population.values() if p['scid'] is not None} - set(school_type_keys)
+        raise ValueError(f'Unknown school types {unknown}: must be one of {school_type_keys}')
+
+    # Scatter into arrays indexed by uid
+    members = rows[:,0]
+    school_id = np.full(pop_size, -1, dtype=np.int32)
+    school_id[members] = rows[:,1]
+    school_type_code = np.full(pop_size, -1, dtype=np.int8)
+    school_type_code[members] = rows[:,2]
+    school_role = np.full(pop_size, -1, dtype=np.int8)
+    school_role[members] = rows[:,3]
+
+    # Group the members of each school, keeping the schools in order of first appearance
+    members = np.flatnonzero(school_id >= 0) # int64, as expected by covasim functions taking uids
+    ids, first, inverse = np.unique(school_id[members], return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(ids)))[:-1]
+    rosters = np.split(members[np.argsort(inverse, kind='stable')], bounds)
+    schools = {int(ids[k]):rosters[k] for k in order}
+    school_types = {key:[] for key in school_type_keys}
+    for k in order:
+        school_types[school_type_keys[school_type_code[members[first[k]]]]].append(int(ids[k]))
+
+    cols = dict(
+        school_id        = school_id,
+        school_type_code = school_type_code,
+        school_role      = school_role,
+        student_flag     = school_role == 0,
+        teacher_flag     = school_role == 1,
+        staff_flag       = school_role == 2,
+        schools          = schools,
+        school_types     = school_types,
+    )
+    return cols
+
+
 def make_population(pop_size, rand_seed=1, max_pop_seeds=None, do_save=True, popfile=None, cohorting=True, n_brackets=20, community_contacts=20,**kwargs):
     '''
     Generate the synthpops population.
@@ -79,41 +149,11 @@ def make_population(pop_size, rand_seed=1, max_pop_seeds=None, do_save=True, pop
 
     # Convert to a popdict
     popdict = cv.make_synthpop(population=sc.dcp(population), community_contacts=community_contacts)
-    school_ids = [None] * int(pop_size)
-    teacher_flag = [False] * int(pop_size)
-    staff_flag = [False] * int(pop_size)
-    student_flag = [False] * int(pop_size)
-    school_types = {'pk': [], 'es': [], 'ms': [], 'hs': [], 'uv': []}
-    school_type_by_person = [None] * int(pop_size)
-    schools = dict()
-
-    for uid,person in population.items():
-        if person['scid'] is not None:
-            school_ids[uid] = person['scid']
-            school_type_by_person[uid] = person['sc_type']
-            if person['scid'] not in school_types[person['sc_type']]:
-                school_types[person['sc_type']].append(person['scid'])
-            if person['scid'] in schools:
-                schools[person['scid']].append(uid)
-            else:
-                schools[person['scid']] = [uid]
-            if person['sc_teacher'] is not None:
-                teacher_flag[uid] = True
-            elif person['sc_student'] is not None:
-                student_flag[uid] = True
-            elif person['sc_staff'] is not None:
-                staff_flag[uid] = True
-
-    popdict['school_id'] = np.array(school_ids)
-    popdict['schools'] = schools
-    popdict['teacher_flag'] = teacher_flag
-    popdict['student_flag'] = student_flag
-    popdict['staff_flag'] = staff_flag
-    popdict['school_types'] = school_types
-    popdict['school_type_by_person'] = school_type_by_person
-
-    assert sum(popdict['teacher_flag']), 'Uh-oh, no teachers were found: as a school analysis this is treated as an error'
-    assert sum(popdict['student_flag']), 'Uh-oh, no students were found: as a school analysis this is treated as an error'
+    school_cols = school_columns(population, int(pop_size))
+    popdict.update(school_cols)
+
+    assert popdict['teacher_flag'].any(), 'Uh-oh, no teachers were found: as a school analysis this is treated as an error'
+    assert popdict['student_flag'].any(), 'Uh-oh, no students were found: as a school analysis this is treated as an error'
 
     # Actually create the people
     people_pars = dict(
@@ -122,10 +162,7 @@ def make_population(pop_size, rand_seed=1, max_pop_seeds=None, do_save=True, pop
         beta = 1.0, # TODO: this is required for plotting (people.plot()), but shouldn't be
     )
     people = cv.People(people_pars, strict=False, uid=popdict['uid'], age=popdict['age'], sex=popdict['sex'],
-                          contacts=popdict['contacts'], school_id=popdict['school_id'],
-                          schools=popdict['schools'], school_types=popdict['school_types'],
-                          student_flag=popdict['student_flag'], teacher_flag=popdict['teacher_flag'],
-                          staff_flag=popdict['staff_flag'], school_type_by_person=popdict['school_type_by_person'])
+                          contacts=popdict['contacts'], **school_cols)
 
     if do_save:
         print(f'Saving to "{popfile}"...')
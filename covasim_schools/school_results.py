@@ -0,0 +1,185 @@
+'''
+Columnar storage of per-school statistics. SchoolResults holds every school's
+daily time series in one float32 array, a small metadata table with one row per
+school, and one copy of the scenario for each school type. It is what
+schools_manager stores in sim.school_stats, and it can still be used like the
+original dict of per-school dicts, e.g. "for sid,stats in sim.school_stats.items()".
+
+The rows need not be individual schools: with schools_manager(stats_level='district')
+there is a single row, 'district', that all schools add to. Likewise the time axis
+can hold days or, with stats_freq='week', weeks, in which case each entry is the sum
+over the days of that week.
+'''
+
+import numpy as np
+import sciris as sc
+
+__all__ = ['SchoolResults']
+
+
+class SchoolResults(sc.prettyobj):
+    '''
+    Statistics for all schools in a sim.
+
+    Attributes:
+        data      (array) : float32 array of shape (n_rows, n_metrics, n_groups, n_bins), with one bin per day or week
+        meta      (dict)  : metadata table, as a dict of arrays with one entry per row (see meta_keys)
+        scenarios (dict)  : the scenario for each school type present
+
+    Args:
+        sids      (list) : the key of each row, usually a school, e.g. 's5'
+        types     (list) : the type of each row, e.g. 'es'
+        npts      (int)  : the number of time points in the sim
+        scenarios (dict) : school type to the scenario for that type
+        freq      (str)  : 'day' (default) for one entry per day, or 'week' for one per week
+
+    Example:
+
+        res = sim.school_stats
+        df = res.to_df() # One row per school, with totals of each metric and group
+        inf = res.get('infectious', 'students') # Array of shape (n_schools, npts)
+    '''
+
+    metrics = ['infectious', 'infectious_arrive_at_school', 'infectious_stay_at_school', 'newly_exposed', 'scheduled', 'in_person']
+    groups = ['students', 'teachers', 'staff']
+    tests = ['PCR', 'Antigen']
+    meta_keys = ['sid', 'type'] + [f'num_{group}' for group in groups] + ['num_school_days'] + [f'n_tested_{test}' for test in tests]
+
+    def __init__(self, sids, types, npts, scenarios, freq='day'):
+        if freq not in ['day', 'week']:
+            raise ValueError(f'Frequency must be "day" or "week", not "{freq}"')
+        self.freq = freq
+        self.days_per_bin = 7 if freq == 'week' else 1
+        self.sids = list(sids)
+        self.index = {sid:k for k,sid in enumerate(self.sids)}
+        n_bins = int(np.ceil(npts/self.days_per_bin))
+        self.data = np.zeros((len(self.sids), len(self.metrics), len(self.groups), n_bins), dtype=np.float32)
+        self.meta = sc.objdict()
+        self.meta['sid'] = np.array(self.sids, dtype=str)
+        self.meta['type'] = np.array(types, dtype=str)
+        for group in self.groups:
+            self.meta[f'num_{group}'] = np.zeros(len(self.sids))
+        self.meta['num_school_days'] = np.zeros(len(self.sids), dtype=np.int64)
+        for test in self.tests:
+            self.meta[f'n_tested_{test}'] = np.zeros(len(self.sids), dtype=np.int64)
+        self.scenarios = dict(scenarios)
+        return
+
+
+    @classmethod
+    def from_dict(cls, school_stats):
+        '''
+        Convert the original format of sim.school_stats, a dict of school key to that
+        school's statistics, e.g. from a sim saved before SchoolResults, with one row
+        per school and daily time series.
+        '''
+        sids = list(school_stats.keys())
+        npts = next((len(stats['infectious']['students']) for stats in school_stats.values()), 0)
+        scenarios = {stats['type']:stats['scenario'] for stats in school_stats.values()}
+        res = cls(sids, [school_stats[sid]['type'] for sid in sids], npts, scenarios)
+        for sid,stats in school_stats.items():
+            res.set_school(sid, stats)
+        return res
+
+
+    def bin(self, t):
+        ''' Index along the time axis of data for day t '''
+        return t // self.days_per_bin
+
+
+    def add(self, rows, metric, t, values):
+        ''' Add values, of shape (len(rows), n_groups), to a metric on day t; rows may repeat '''
+        np.add.at(self.data[:, metric, :, self.bin(t)], rows, values)
+        return
+
+
+    def add_meta(self, row, num, num_school_days, n_tested):
+        ''' Add the sizes and tests of a school to a row; the row keeps the most school days of any school added '''
+        for group in self.groups:
+            self.meta[f'num_{group}'][row] += num[group]
+        self.meta['num_school_days'][row] = max(self.meta['num_school_days'][row], num_school_days)
+        for test in self.tests:
+            self.meta[f'n_tested_{test}'][row] += n_tested[test]
+        return
+
+
+    def set_school(self, sid, stats):
+        ''' Store the statistics of one school, as returned by SchoolStats.get() '''
+        k = self.index[sid]
+        for m,metric in enumerate(self.metrics):
+            for g,group in enumerate(self.groups):
+                self.data[k,m,g,:] = stats[metric][group]
+        for group in self.groups:
+            self.meta[f'num_{group}'][k] = stats['num'][group]
+        self.meta['num_school_days'][k] = stats['num_school_days']
+        for test in self.tests:
+            self.meta[f'n_tested_{test}'][k] = stats['n_tested'][test]
+        return
+
+
+    def get(self, metric, group=None):
+        ''' Time series of a metric for one group, or summed over groups, as an array of shape (n_schools, npts) '''
+        m = self.metrics.index(metric)
+        if group is None:
+            return self.data[:,m,:,:].sum(axis=1)
+        return self.data[:,m,self.groups.index(group),:]
+
+
+    def totals(self):
+        ''' Sum of each metric over time, as a float64 array of shape (n_schools, n_metrics, n_groups) '''
+        return self.data.sum(axis=3, dtype=np.float64)
+
+
+    def to_df(self, days=None):
+        '''
+        Metadata table as a dataframe, with a column for the total of each metric and
+        group, e.g. "in_person_students". If days is a dict of labels to days (sim.t),
+        there is also a column for each metric and group in the bin of each day, e.g.
+        "infectious_students_d1".
+        '''
+        import pandas as pd # Imported here since only needed for this
+        df = pd.DataFrame({key:self.meta[key] for key in self.meta_keys})
+        totals = self.totals()
+        for m,metric in enumerate(self.metrics):
+            for g,group in enumerate(self.groups):
+                df[f'{metric}_{group}'] = totals[:,m,g]
+        for label,t in (days or {}).items():
+            for m,metric in enumerate(self.metrics):
+                for g,group in enumerate(self.groups):
+                    df[f'{metric}_{group}_{label}'] = self.data[:,m,g,self.bin(t)]
+        return df
+
+
+    def __getitem__(self, sid):
+        ''' Statistics of one school in the original format, with the time series as views into data '''
+        k = self.index[sid]
+        stype = str(self.meta['type'][k])
+        stats = {
+            'type': stype,
+            'scenario': self.scenarios.get(stype),
+            'num': {group:self.meta[f'num_{group}'][k] for group in self.groups},
+        }
+        for m,metric in enumerate(self.metrics):
+            stats[metric] = {group:self.data[k,m,g,:] for g,group in enumerate(self.groups)}
+        stats['num_school_days'] = self.meta['num_school_days'][k]
+        stats['n_tested'] = {test:self.meta[f'n_tested_{test}'][k] for test in self.tests}
+        return stats
+
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __iter__(self):
+        return iter(self.sids)
+
+    def __contains__(self, sid):
+        return sid in self.index
+
+    def keys(self):
+        return list(self.sids)
+
+    def values(self):
+        return [self[sid] for sid in self.sids]
+
+    def items(self):
+        return [(sid, self[sid]) for sid in self.sids]
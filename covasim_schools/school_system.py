@@ -0,0 +1,284 @@
+'''
+Vectorized engine for running all schools at once. Rather than one School object
+per school, SchoolSystem holds every school's roster, edges and parameters in
+concatenated arrays keyed by school index, and runs each daily phase (testing,
+tracing, screening, layer construction and statistics) once for all schools using
+masks and segment operations. It is used by schools_manager(engine='system'), and
+is statistically equivalent to the per-school path.
+'''
+
+import covasim as cv
+import numpy as np
+import sciris as sc
+from .school_interventions import int2key, ContactIndex, antigen_test
+from .school_results import SchoolResults
+
+__all__ = ['SchoolSystem']
+
+groups = SchoolResults.groups # Order of the groups, matching SchoolResults
+
+# Which cohorts attend on each day of the week, for full-time and hybrid schools
+full_days = {'Monday':'all', 'Tuesday':'all', 'Wednesday':'all', 'Thursday':'all', 'Friday':'all', 'Saturday':'weekend', 'Sunday':'weekend'}
+hybrid_days = {'Monday':'A', 'Tuesday':'A', 'Wednesday':'distance', 'Thursday':'B', 'Friday':'B', 'Saturday':'weekend', 'Sunday':'weekend'}
+
+
+class SchoolSystem(sc.prettyobj):
+    '''
+    All open schools in a sim, stored as concatenated arrays. People are referred
+    to by their position in the concatenated roster; pos_school gives the index of
+    the school each position belongs to.
+
+    Args:
+        sim          (covasim Sim) : the simulation object
+        school_types (list)        : the type of each school, e.g. 'es'
+        school_ids   (list)        : the ID of each school
+        layers       (dict)        : school ID to the layer for that school, as returned by partition_school_layer()
+        scenario     (SchoolScenario) : the scenario, with one entry per school type
+        calendar     (TestingCalendar) : the testing schedule
+        layer_keys   (list)        : the contacts key each school's edges go into (default: one key per school)
+        results      (SchoolResults) : where to record statistics, or None to not record them
+        results_rows (array)       : the row of results that each school's statistics are added to
+    '''
+
+    def __init__(self, sim, school_types, school_ids, layers, scenario, calendar, layer_keys=None, results=None, results_rows=None):
+        ppl = sim.people
+        self.sids = [int2key(school_id) for school_id in school_ids]
+        self.n_schools = len(school_ids)
+        if layer_keys is None:
+            layer_keys = self.sids
+        self.layer_keys = list(dict.fromkeys(layer_keys)) # Unique, in order
+        self.school_key = np.array([self.layer_keys.index(key) for key in layer_keys], dtype=np.int64)
+        self.stypes = sorted(set(school_types))
+        self.school_stype = np.array([self.stypes.index(stype) for stype in school_types], dtype=np.int64)
+
+        # Rosters
+        rosters = [np.array(ppl.schools[school_id], dtype=np.int64) for school_id in school_ids]
+        sizes = np.array([len(roster) for roster in rosters], dtype=np.int64)
+        self.uids = np.concatenate(rosters) if rosters else np.empty(0, dtype=np.int64)
+        self.n = len(self.uids)
+        self.pos_school = np.repeat(np.arange(self.n_schools), sizes)
+        self.order = np.argsort(self.uids, kind='stable')
+        self.sorted_uids = self.uids[self.order]
+
+        # Group of each position: 0 for students, 1 for teachers, 2 for staff, and 3 for anyone else
+        self.pos_group = np.full(self.n, 3, dtype=np.int64)
+        for g,flag in enumerate([ppl.student_flag, ppl.teacher_flag, ppl.staff_flag]):
+            self.pos_group[np.array(flag, dtype=bool)[self.uids]] = g
+
+        # Parameters of each school
+        def par(key, default=0):
+            return np.array([scenario[stype][key] if scenario[stype][key] is not None else default for stype in school_types], dtype=float)
+        self.start_day = np.array([sim.day(scenario[stype]['start_day']) for stype in school_types], dtype=np.int64)
+        self.screen_prob = par('screen_prob')
+        self.screen2pcr = par('screen2pcr')
+        self.test_prob = par('test_prob')
+        self.trace_prob = par('trace_prob')
+        self.quar_prob = par('quar_prob')
+        self.ili_prob = par('ili_prob')
+        schedules = [scenario[stype]['schedule'].lower() for stype in school_types]
+        for schedule in set(schedules) - {'full', 'hybrid', 'remote'}:
+            print(f'Warning: Unrecognized schedule ({schedule}) passed to SchoolSystem.')
+        self.is_full = np.array([schedule == 'full' for schedule in schedules])
+        self.is_hybrid = np.array([schedule == 'hybrid' for schedule in schedules])
+
+        # Split the students of hybrid schools into the A and B cohorts: 0 for everyone attending both, 1 for A, 2 for B, and 3 for neither
+        self.pos_cohort = np.zeros(self.n, dtype=np.int64)
+        pos_hybrid = self.is_hybrid[self.pos_school]
+        hybrid_students = (pos_hybrid & (self.pos_group == 0)).nonzero()[0]
+        in_A = cv.n_binomial(0.5, len(hybrid_students))
+        self.pos_cohort[hybrid_students] = np.where(in_A, 1, 2)
+        self.pos_cohort[pos_hybrid & (self.pos_group == 3)] = 3
+
+        # Edges, concatenated in school order; people from outside a school map to an extra, always-present position
+        layer_list = [layers[school_id] for school_id in school_ids]
+        self.empty_layer = cv.Layer()
+        self.edges = {key:np.concatenate([layer[key] for layer in layer_list] + [self.empty_layer[key]]) for key in self.empty_layer.meta_keys()}
+        self.edge_school = np.repeat(np.arange(self.n_schools), [len(layer) for layer in layer_list])
+        self.p1_pos = self.positions(self.edges['p1'])
+        self.p2_pos = self.positions(self.edges['p2'])
+        self.n_edges = len(self.edge_school)
+
+        # Which edges are in the A and B sublayers: for hybrid schools, edges touching a student of the other cohort are dropped
+        cohort = np.append(self.pos_cohort, 0)
+        c1 = cohort[self.p1_pos]
+        c2 = cohort[self.p2_pos]
+        edge_hybrid = self.is_hybrid[self.edge_school]
+        edge_remote = ~(self.is_full | self.is_hybrid)[self.edge_school]
+        self.edge_in_A = ~edge_remote & (~edge_hybrid | ((c1 != 2) & (c2 != 2)))
+        self.edge_in_B = ~edge_remote & (~edge_hybrid | ((c1 != 1) & (c2 != 1)))
+        traceable = self.edge_in_A | self.edge_in_B # Contacts are traced in both sublayers
+        self.contact_index = ContactIndex(self.p1_pos[traceable], self.p2_pos[traceable], self.p1_pos[traceable], self.p2_pos[traceable], self.n) # Neighbors are positions, not uids
+
+        # Testing: the positions eligible for each test of each school type
+        self.calendar = calendar
+        self.test_pos = {}
+        for s,stype in enumerate(self.stypes):
+            for i,test in enumerate(calendar.tests.get(stype, [])):
+                in_groups = np.isin(self.pos_group, [groups.index(group) for group in test['groups']])
+                self.test_pos[(stype, i)] = (in_groups & (self.school_stype[self.pos_school] == s)).nonzero()[0]
+
+        # State
+        self.is_open = np.zeros(self.n_schools, dtype=bool) # Schools start closed
+        self.release_day = np.full(self.n, -1, dtype=np.int32) # Release day for each person sent home, -1 if never
+        self.num_school_days = np.zeros(self.n_schools, dtype=np.int64)
+        self.n_tested = {'PCR': np.zeros(self.n_schools, dtype=np.int64), 'Antigen': np.zeros(self.n_schools, dtype=np.int64)}
+        self.num = np.bincount(self.pos_school*4 + self.pos_group, minlength=4*self.n_schools).reshape(self.n_schools, 4)[:,:3] * sim.pars['pop_scale']
+        self.results = results
+        self.results_rows = np.arange(self.n_schools) if results_rows is None else np.asarray(results_rows)
+        return
+
+
+    def positions(self, uids):
+        ''' Positions of uids in the concatenated rosters; people not in any school map to n '''
+        uids = np.asarray(uids, dtype=np.int64)
+        output = np.full(len(uids), self.n, dtype=np.int64)
+        if self.n and len(uids):
+            idx = np.minimum(np.searchsorted(self.sorted_uids, uids), self.n-1)
+            found = self.sorted_uids[idx] == uids
+            output[found] = self.order[idx[found]]
+        return output
+
+
+    def count(self, pos):
+        ''' Number of positions in each school '''
+        return np.bincount(self.pos_school[pos], minlength=self.n_schools)
+
+
+    def test(self, sim):
+        ''' Conduct any testing due today, across all schools at once '''
+        for stype in self.stypes:
+            for i,test in self.calendar.tests_due(sim.t, stype):
+                self.test_one(sim, test, self.test_pos[(stype, i)])
+        return
+
+
+    def test_one(self, sim, test, pos):
+        ''' Conduct one test on the positions eligible for it '''
+        ppl = sim.people
+        t = sim.t
+        pos = pos[~ppl.diagnosed[self.uids[pos]]]
+        pos = cv.binomial_filter(test['coverage'], pos)
+        uids = self.uids[pos]
+        if test['is_antigen']:
+            self.n_tested['Antigen'] += self.count(pos)
+            ag_pos = self.positions(antigen_test(uids, sim=sim, sym7d_sens=test['symp7d_sensitivity'], other_sens=test['other_sensitivity'], specificity=test['specificity']))
+            followed_up = cv.n_binomial(test['PCR_followup_perc'], len(ag_pos))
+            ppl.test(self.uids[ag_pos[followed_up]], test_sensitivity=1.0, test_delay=test['PCR_followup_delay'])
+            self.n_tested['PCR'] += self.count(ag_pos[followed_up])
+            self.release_day[ag_pos] = np.where(followed_up, t+test['PCR_followup_delay'], t+sim.pars['quar_period'])
+        else:
+            self.n_tested['PCR'] += self.count(pos)
+            ppl.test(uids, test_sensitivity=test['sensitivity'], test_delay=test['delay'])
+        return
+
+
+    def screen(self, sim, arriving):
+        ''' Screen those arriving at school; positives are sent home and some get a PCR test '''
+        ppl = sim.people
+        t = sim.t
+        pos = arriving.nonzero()[0]
+        school = self.pos_school[pos]
+        screened = pos[cv.n_binomial(self.screen_prob[school], len(pos))]
+        uids = self.uids[screened]
+        screen_pos = ppl.symptomatic[uids] & ~(ppl.recovered[uids] | ppl.dead[uids])
+
+        # Add in screen positives from ILI amongst those who were screened negative
+        ili = ~screen_pos & cv.n_binomial(self.ili_prob[self.pos_school[screened]], len(screened))
+        screen_pos = screened[screen_pos | ili]
+
+        # Perform follow-up testing on some, grouped by the delay to results
+        tested = cv.n_binomial(self.test_prob[self.pos_school[screen_pos]], len(screen_pos))
+        delay = self.screen2pcr[self.pos_school[screen_pos]]
+        for d in np.unique(delay[tested]):
+            ppl.test(self.uids[screen_pos[tested & (delay == d)]], test_delay=d)
+        self.n_tested['PCR'] += self.count(screen_pos[tested])
+
+        # Send the screen positives home - quar_period if no PCR and otherwise the time to the PCR
+        self.release_day[screen_pos] = np.where(tested, t+delay, t+sim.pars['quar_period'])
+        return
+
+
+    def update(self, sim):
+        ''' Process the day for every school, and return a dict from layer key to layer '''
+
+        ppl = sim.people
+        t = sim.t
+        quar_until = t + sim.pars['quar_period']
+
+        # Even if a school is not yet open, consider testing in the population
+        self.test(sim)
+
+        # Isolate newly diagnosed individuals - could happen before school starts
+        newly_dx = ppl.date_diagnosed[self.uids] == t
+        self.release_day[newly_dx] = quar_until
+
+        # Open schools on their start day; closed schools do nothing further
+        self.is_open |= self.start_day == t
+        if not self.is_open.any():
+            return {key:self.empty_layer for key in self.layer_keys}
+        pos_open = self.is_open[self.pos_school]
+
+        # Work out which schools are in session today, and for which cohorts
+        dayname = sc.readdate(sim.date(t)).strftime('%A')
+        in_A = self.is_open & ((self.is_full & (full_days[dayname] == 'all')) | (self.is_hybrid & (hybrid_days[dayname] == 'A')))
+        in_B = self.is_open & ((self.is_full & (full_days[dayname] == 'all')) | (self.is_hybrid & (hybrid_days[dayname] == 'B')))
+        self.num_school_days += in_A | in_B
+        school = self.pos_school
+        cohort = self.pos_cohort
+        scheduled = (in_A[school] & ((cohort == 0) | (cohort == 1))) | (in_B[school] & ((cohort == 0) | (cohort == 2)))
+
+        # Quarantine contacts of newly diagnosed individuals
+        to_trace = (newly_dx & pos_open).nonzero()[0]
+        if len(to_trace):
+            to_trace = to_trace[cv.n_binomial(self.trace_prob[school[to_trace]], len(to_trace))]
+            reached = self.contact_index.find_contacts(to_trace)
+            reached = reached[reached < self.n] # Only people in a school can be sent home from one
+            to_quar = reached[cv.n_binomial(self.quar_prob[school[reached]], len(reached))]
+            self.release_day[to_quar] = quar_until
+
+        # Determine who will arrive at school, and perform symptom screening
+        arriving = scheduled & (self.release_day < t)
+        self.screen(sim, arriving)
+        at_home = self.release_day >= t
+        passed_screening = scheduled & ~at_home
+
+        # Statistics
+        if self.results is not None:
+            infectious = ppl.infectious[self.uids] & pos_open
+            rescale = sim.rescale_vec[t]
+            bins = school*4 + self.pos_group
+            for k,mask in enumerate([infectious, infectious & arriving, infectious & passed_screening, pos_open & (ppl.date_exposed[self.uids] == t-1), scheduled, passed_screening]):
+                counts = np.bincount(bins[mask], minlength=4*self.n_schools).reshape(self.n_schools, 4)
+                self.results.add(self.results_rows, k, t, counts[:,:3] * rescale)
+
+        # Build the layers: the day's sublayer, minus anyone at home
+        if self.n_edges == 0:
+            return {key:self.empty_layer for key in self.layer_keys}
+        present = np.append(~at_home, True)
+        edge_school = self.edge_school
+        active = ((self.edge_in_A & in_A[edge_school]) | (self.edge_in_B & in_B[edge_school])) & present[self.p1_pos] & present[self.p2_pos]
+        inds = active.nonzero()[0]
+        edge_key = self.school_key[edge_school[inds]]
+        if np.any(edge_key[1:] < edge_key[:-1]): # Schools sharing a layer are not contiguous, so group their edges
+            order = np.argsort(edge_key, kind='stable')
+            inds = inds[order]
+            edge_key = edge_key[order]
+        bounds = np.searchsorted(edge_key, np.arange(len(self.layer_keys)+1))
+        edges = {key:arr[inds] for key,arr in self.edges.items()}
+        layers = {}
+        for k,lkey in enumerate(self.layer_keys):
+            if bounds[k] == bounds[k+1]:
+                layers[lkey] = self.empty_layer
+            else:
+                layers[lkey] = cv.Layer(**{key:arr[bounds[k]:bounds[k+1]] for key,arr in edges.items()})
+        return layers
+
+
+    def finalize(self):
+        ''' Add the sizes and test counts of each school to the results '''
+        if self.results is not None:
+            for k in range(self.n_schools):
+                num = {group:self.num[k,g] for g,group in enumerate(groups)}
+                n_tested = {key:self.n_tested[key][k] for key in self.n_tested.keys()}
+                self.results.add_meta(self.results_rows[k], num, self.num_school_days[k], n_tested)
+        return
@@ -0,0 +1,142 @@
+'''
+Run many sims in parallel with as many workers as memory allows. Rather than
+running fixed batches, where every worker waits for the slowest sim of the batch
+(e.g. one with daily PCR testing), a new sim is started as soon as any sim
+finishes. Each worker measures its peak memory while running a sim, and the number
+of sims running at once is limited so that the largest peak seen so far, times the
+number of running sims, fits into the memory that was available at the start. A sim
+is also held back while the memory available now is less than that peak.
+
+Until a sim has finished, the memory per sim is estimated from the population
+size, at bytes_per_person per person. Sims are taken from the iterable only when
+they are about to start, so a generator can be used to avoid holding every sim,
+with its people, in memory at once.
+
+Example:
+
+    sims = (make_sim(seed) for seed in range(100))
+    sims = cvsch.run_sims(sims, ncpus=32)
+'''
+
+import os
+import time
+import threading
+import psutil
+import concurrent.futures as cf
+import sciris as sc
+
+__all__ = ['bytes_per_person', 'run_sims']
+
+bytes_per_person = 8e9/225e3 # Initial estimate of the peak memory of a worker, per person in the sim
+
+
+class PeakMonitor(threading.Thread):
+    ''' Record the peak resident memory of this process, by polling it until stopped '''
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = self.process.memory_info().rss
+        self.stopped = threading.Event()
+        return
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+        return
+
+    def stop(self):
+        ''' Stop polling, and return the peak in bytes '''
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return self.peak
+
+
+def run_sim(sim, keep_people=False):
+    ''' Run one sim in a worker, storing the worker's peak memory (bytes), the time taken (s), and the worker in sim.run_info '''
+    T = time.time()
+    monitor = PeakMonitor()
+    monitor.start()
+    try:
+        sim.run()
+        if not keep_people:
+            sim.shrink(in_place=True)
+    finally:
+        peak = monitor.stop()
+    sim.run_info = sc.objdict(peak_rss=peak, time=time.time()-T, pid=os.getpid())
+    return sim
+
+
+def run_sims(sims, ncpus=None, mem_frac=0.9, mem_per_sim=None, keep_people=False, callback=None, verbose=True):
+    '''
+    Run sims in parallel, starting each as soon as a worker is free and memory
+    allows.
+
+    Args:
+        sims (iterable): the sims to run; taken one at a time, so may be a generator
+        ncpus (int): the maximum number of sims to run at once (default: number of CPUs)
+        mem_frac (float): fraction of the memory available at the start that the workers may use
+        mem_per_sim (float): initial estimate of the peak memory of a worker in bytes (default: from the population size)
+        keep_people (bool): whether to keep the people of each finished sim
+        callback (func): called with each finished sim, in the order they finish, e.g. to save it
+        verbose (bool): whether to print progress
+
+    Returns:
+        The finished sims, in the order they were supplied; each has sim.run_info with its peak memory (bytes) and run time (s)
+    '''
+    if ncpus is None:
+        ncpus = sc.cpu_count()
+    budget = mem_frac*psutil.virtual_memory().available
+    sims = iter(sims)
+    measured = 0 # Largest peak memory of a worker so far
+    results = {}
+    running = {}
+    count = 0
+    exhausted = False
+
+    def estimate(sim):
+        ''' Peak memory of a worker running this sim '''
+        if measured:
+            return measured
+        elif mem_per_sim is not None:
+            return mem_per_sim
+        return sim['pop_size']*bytes_per_person
+
+    with cf.ProcessPoolExecutor(max_workers=ncpus) as executor:
+        pending = None
+        while True:
+
+            # Start sims until the limit is reached
+            while not exhausted:
+                if pending is None:
+                    pending = next(sims, None)
+                    if pending is None:
+                        exhausted = True
+                        break
+                mem = estimate(pending)
+                if len(running) >= max(1, min(ncpus, int(budget // mem))):
+                    break
+                if running and psutil.virtual_memory().available < mem: # E.g. if other jobs have started since
+                    break
+                running[executor.submit(run_sim, pending, keep_people)] = count
+                count += 1
+                pending = None
+
+            if not running:
+                break
+
+            # Wait for any sim to finish
+            done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in done:
+                ind = running.pop(future)
+                sim = future.result()
+                measured = max(measured, sim.run_info.peak_rss)
+                results[ind] = sim
+                if verbose:
+                    print(f'Finished sim {ind} ("{sim.label}") in {sim.run_info.time:0.1f} s with {sim.run_info.peak_rss/1e9:0.2f} GB; {len(results)} done, {len(running)} running')
+                if callback is not None:
+                    callback(sim)
+
+    return [results[ind] for ind in range(count)]
@@ -40,5 +40,9 @@ setup(
         "covasim",
         "synthpops",
         "optuna",
+        "psutil",
     ],
+    extras_require={
+        "results": ["pyarrow"], # For ResultsSink and load_results()
+    },
 )
@@ -0,0 +1,222 @@
+'''
+Calibrate with sequential Monte Carlo approximate Bayesian computation (ABC-SMC),
+as an alternative to taking the best Optuna trials. The parameters, their bounds
+(a uniform prior), the sim, and the distance (the mismatch from evaluate_sim()) are
+the same as in calibrate_model.py.
+
+Each generation keeps n_particles parameter sets. The first is drawn from the prior;
+each later one is drawn by perturbing particles of the previous generation, and a
+proposal is kept only if its mismatch is within the tolerance, which is the alpha
+quantile of the previous generation's mismatches. Proposals are run in parallel
+batches until enough are accepted, and weighted so that the final generation is a
+sample from the approximate posterior (Beaumont et al. 2009).
+
+The output has the same layout as the pars_*.json file from calibrate_model.py, with
+the random seed to run each entry with as its index, plus the particle's weight. The
+entries are a systematic resample of the final generation, by weight, in a random
+order, so the first N entries, as used by the scenario scripts, are a sample from the
+posterior; they are not sorted by mismatch. A particle can appear more than once, but
+each entry has its own seed, so no sim is repeated: the first copy of a particle keeps
+the seed of the sim it was accepted with, and each other copy gets a new seed. The
+resample is seeded, so saving again gives the same file.
+'''
+
+import numpy as np
+import sciris as sc
+import create_sim as cs
+import calibrate_model as cm
+
+
+def run_particle(pars, index, pop_size=cm.pop_size):
+    ''' Run the calibration sim for one parameter set with random seed index, and return the metrics from evaluate_sim() '''
+    pars = sc.mergedicts(pars, {'rand_seed':index})
+    if cm.reuse_templates:
+        sim = cm.trial_sim(pars, pop_size=pop_size)
+    else:
+        sim = cs.create_sim(pars, pop_size=pop_size, folder=cm.folder, children_equally_sus=cm.children_equally_sus, alternate_symptomaticity=cm.alternate_symptomaticity)
+        cm.add_schools(sim)
+    sim.run()
+    return cm.evaluate_sim(sim)
+
+
+class ABCSMC(sc.prettyobj):
+    '''
+    ABC-SMC sampler over the calibration parameters.
+
+    Args:
+        n_particles (int): number of parameter sets in each generation
+        n_generations (int): maximum number of generations, including the first, from the prior
+        alpha (float): quantile of the previous generation's mismatches used as the next tolerance
+        min_acceptance (float): stop after a generation in which fewer than this fraction of proposals were accepted
+        batch_size (int): number of proposals run in parallel at a time (default: ncpus)
+        ncpus (int): number of parallel processes
+        simulate (func): function of the parameters and random seed that returns a dict with the mismatch (default: run_particle())
+        bounds (dict): the prior bounds of each parameter (default: from define_pars())
+        rand_seed (int): seed for the proposals, separate from the seeds of the sims
+
+    Example:
+
+        abc = ABCSMC(n_particles=100, ncpus=24)
+        abc.run()
+        abc.save()
+    '''
+
+    def __init__(self, n_particles=100, n_generations=5, alpha=0.5, min_acceptance=0.05, batch_size=None, ncpus=None,
+                 simulate=None, bounds=None, rand_seed=0):
+        self.n_particles    = n_particles
+        self.n_generations  = n_generations
+        self.alpha          = alpha
+        self.min_acceptance = min_acceptance
+        self.ncpus          = ncpus if ncpus is not None else sc.cpu_count()
+        self.batch_size     = batch_size if batch_size is not None else self.ncpus
+        self.simulate       = simulate if simulate is not None else run_particle
+        self.bounds         = bounds if bounds is not None else cs.define_pars(which='bounds')
+        self.keys           = list(self.bounds.keys())
+        self.lower          = np.array([self.bounds[key][0] for key in self.keys], dtype=float)
+        self.upper          = np.array([self.bounds[key][1] for key in self.keys], dtype=float)
+        self.rng            = np.random.default_rng(rand_seed)
+        self.n_sims         = 0 # Sims run so far, also used as the random seed of the next sim
+        self.generations    = []
+        return
+
+
+    def run_batch(self, thetas):
+        ''' Run a batch of proposals in parallel, each with its own random seed; returns the seeds and metrics '''
+        indices = list(range(self.n_sims, self.n_sims + len(thetas)))
+        self.n_sims += len(thetas)
+        iterkwargs = [dict(pars=dict(zip(self.keys, theta)), index=index) for theta,index in zip(thetas, indices)]
+        metrics = sc.parallelize(self.simulate, iterkwargs=iterkwargs, ncpus=self.ncpus)
+        return indices, metrics
+
+
+    def propose(self, n, prev):
+        ''' Draw n proposals from the prior (for the first generation) or by perturbing the previous generation '''
+        if prev is None:
+            return self.rng.uniform(self.lower, self.upper, size=(n, len(self.keys)))
+        thetas = []
+        while len(thetas) < n:
+            ind = self.rng.choice(len(prev.thetas), p=prev.weights)
+            theta = self.rng.multivariate_normal(prev.thetas[ind], prev.cov)
+            if np.all(theta >= self.lower) and np.all(theta <= self.upper): # Outside the prior, so would never be accepted
+                thetas.append(theta)
+        return np.array(thetas)
+
+
+    def weigh(self, thetas, prev):
+        ''' Importance weights of accepted particles: uniform prior density over the perturbation kernel mixture '''
+        if prev is None:
+            return np.full(len(thetas), 1/len(thetas))
+        inv = np.linalg.inv(prev.cov)
+        diffs = thetas[:,None,:] - prev.thetas[None,:,:]
+        kernel = np.exp(-0.5*np.einsum('ijk,kl,ijl->ij', diffs, inv, diffs)) # Normalization is the same for every particle, so omitted
+        weights = 1/(kernel @ prev.weights)
+        return weights/weights.sum()
+
+
+    def run_generation(self, prev=None):
+        ''' Run proposals until n_particles are within the tolerance, and return the generation '''
+        eps = np.inf if prev is None else np.quantile(prev.mismatches, self.alpha)
+        thetas, indices, metrics = [], [], []
+        n_proposed = 0
+        while len(thetas) < self.n_particles:
+            n = self.n_particles if prev is None else self.batch_size # Every draw from the prior is accepted
+            batch = self.propose(n, prev)
+            batch_indices, batch_metrics = self.run_batch(batch)
+            n_proposed += n
+            for theta, index, ret in zip(batch, batch_indices, batch_metrics):
+                if ret['mismatch'] <= eps and len(thetas) < self.n_particles:
+                    thetas.append(theta)
+                    indices.append(index)
+                    metrics.append(ret)
+            if prev is not None and len(thetas)/n_proposed < self.min_acceptance and n_proposed >= self.n_particles/self.min_acceptance:
+                break # Too few are being accepted to finish the generation
+
+        gen = sc.objdict()
+        gen.eps        = eps
+        gen.thetas     = np.array(thetas)
+        gen.indices    = np.array(indices)
+        gen.metrics    = metrics
+        gen.mismatches = np.array([ret['mismatch'] for ret in metrics])
+        gen.n_proposed = n_proposed
+        gen.acceptance = len(thetas)/n_proposed
+        if len(thetas) == self.n_particles:
+            gen.weights = self.weigh(gen.thetas, prev)
+            gen.cov = 2*np.atleast_2d(np.cov(gen.thetas, rowvar=False, aweights=gen.weights)) # Twice the weighted covariance, as in Beaumont et al.
+        return gen
+
+
+    def run(self, verbose=True):
+        ''' Run the generations; returns the final complete generation '''
+        prev = None
+        for g in range(self.n_generations):
+            gen = self.run_generation(prev)
+            if verbose:
+                print(f'Generation {g}: tolerance {gen.eps:0.4f}, accepted {len(gen.thetas)} of {gen.n_proposed} ({gen.acceptance:0.1%}), median mismatch {np.median(gen.mismatches):0.4f}, {self.n_sims} sims so far')
+            if 'weights' not in gen: # The generation could not be completed; keep the previous one
+                break
+            self.generations.append(gen)
+            prev = gen
+            if gen.acceptance < self.min_acceptance:
+                break
+        return self.generations[-1]
+
+
+    def to_json(self, order=None, seed=0):
+        '''
+        The final generation in the pars_*.json layout. By default, the particles are
+        resampled systematically by weight and shuffled, using a generator seeded with
+        seed, so repeated calls give the same entries. Each entry has a distinct index
+        (the sim's random seed); "particle" is the seed of the sim that the particle
+        was accepted with, and "mismatch" and "weight" are the particle's. With
+        order='mismatch', each particle appears once, with its own seed, sorted by
+        mismatch.
+        '''
+        gen = self.generations[-1]
+        n = len(gen.thetas)
+        if order == 'mismatch':
+            inds = np.argsort(gen.mismatches)
+        else:
+            rng = np.random.default_rng(seed)
+            positions = (rng.uniform() + np.arange(n))/n # One draw, evenly spaced, so each particle appears floor or ceil of n*weight times
+            inds = np.minimum(np.searchsorted(np.cumsum(gen.weights), positions), n-1)
+            inds = rng.permutation(inds)
+        json = []
+        seen = set()
+        new_seed = self.n_sims # Seeds from here on have not been used by any sim
+        for i in inds:
+            if i in seen:
+                index = new_seed
+                new_seed += 1
+            else:
+                index = gen.indices[i]
+                seen.add(i)
+            pars = {key:float(val) for key,val in zip(self.keys, gen.thetas[i])}
+            json.append(dict(index=float(index), particle=float(gen.indices[i]), mismatch=float(gen.mismatches[i]), weight=float(gen.weights[i]), pars=pars))
+        return json
+
+
+    def save(self, filename=None, **kwargs):
+        ''' Save the final generation as JSON (default: named like the calibration file, with _abc); kwargs are passed to to_json() '''
+        if filename is None:
+            filename = f'{cm.name}_abc.json'
+        json = self.to_json(**kwargs)
+        sc.savejson(filename, json, indent=2)
+        return json
+
+
+if __name__ == '__main__':
+
+    n_particles   = 100
+    n_generations = 6
+    ncpus         = cm.n_workers
+
+    # Build each population's template once here, so the parallel workers share it
+    if cm.reuse_templates:
+        for pop_seed in range(cm.max_pop_seeds):
+            cm.templates[(cm.pop_size, pop_seed)] = cm.make_template(cm.pop_size, pop_seed)
+
+    T = sc.tic()
+    abc = ABCSMC(n_particles=n_particles, n_generations=n_generations, ncpus=ncpus)
+    abc.run()
+    abc.save()
+    sc.toc(T)
@@ -1,6 +1,8 @@
 # This code is used to build the pars_* file containing parameter configuations and corresponding rand_seed values.
 
 import os
+import pickle
+import functools
 import sciris as sc
 import optuna as op
 import numpy as np
@@ -8,6 +10,7 @@ import pandas as pd
 import create_sim as cs
 import covasim_schools as cvsch
 import covasim as cv
+import covasim.utils as cvu
 import synthpops as sp
 cv.check_save_version('1.7.6', folder='gitinfo', comments={'SynthPops':sc.gitinfo(sp.__file__)})
 
@@ -36,18 +39,42 @@ weight = {
     'tests':        1,   # per 100k (per day) - 225 is 5000 tests in 2.23M pop per day
 }
 
-label     = '_'.join([f'{k}={v}' for k,v in to_fit.items()])
-name      = os.path.join(folder, f'pars_{label}_pop_size={int(pop_size)}')
-if children_equally_sus:
-    name += '_children_equally_sus'
-if alternate_symptomaticity:
-    name += '_alternate_symptomaticity'
+def make_name(targets):
+    ''' Name of the study and the pars_*.json file for a set of targets '''
+    label = '_'.join([f'{k}={v}' for k,v in targets.items()])
+    name  = os.path.join(folder, f'pars_{label}_pop_size={int(pop_size)}')
+    if children_equally_sus:
+        name += '_children_equally_sus'
+    if alternate_symptomaticity:
+        name += '_alternate_symptomaticity'
+    return name
 
-storage   = f'sqlite:///{name}.db'
+name      = make_name(to_fit)
+
+journal   = True # Workers append to one journal file, rather than contending for SQLite's database lock on every write
+storage   = f'{name}.journal' if journal else f'sqlite:///{name}.db'
 n_workers = 24
 n_trials  = 20 # Each worker does n_trials
 save_json = True
 
+# Days on which the mismatch known so far is reported to Optuna, so that trials that are clearly worse than the others can be stopped early
+checkpoints = ['2020-11-02', '2020-11-16', '2020-11-30', '2020-12-14', '2020-12-28', '2021-01-11']
+do_prune = True
+
+# Multi-fidelity calibration: screen n_workers*n_trials trials on small populations, then
+# rerun only the best 1/eta of them at each larger size. Only the trials run at the last
+# size, which must be pop_size, go into the study "name" and hence the JSON file. Each
+# size needs its own populations in the folder, e.g. from create_sp_pop.py for 20e3.
+multi_fidelity = False
+fidelities = [20e3, pop_size]
+eta = 4
+
+# Each worker keeps an initialized sim per population, and each trial starts from a copy
+# of it with only the calibrated parameters and random seed changed; see trial_sim()
+reuse_templates = True
+max_pop_seeds = 5 # As in create_sim()
+templates = {}
+
 def scenario(es, ms, hs):
     return {
         'pk': None,
@@ -58,6 +85,22 @@ def scenario(es, ms, hs):
     }
 
 
+def compute_mismatch(ret, targets=None, weights=None):
+    ''' Weighted mean absolute error (scaled to true value) of the targets in ret (default targets and weights: to_fit and weight) '''
+    if targets is None:
+        targets = to_fit
+    if weights is None:
+        weights = weight
+    mismatch = 0
+    wsum = 0
+    for key,true in targets.items():
+        if key in ret:
+            realized = ret[key]
+            mismatch += weights[key] * np.abs(realized-true)/true
+            wsum += weights[key]
+    return mismatch / wsum
+
+
 def evaluate_sim(sim):
     first = sim.day('2020-11-02')
     last = sim.day('2021-01-31')
@@ -71,28 +114,70 @@ def evaluate_sim(sim):
         'tests': np.mean(sim.results['new_tests'][first:last]) * 1e5 / (sim.pars['pop_size'] * sim.pars['pop_scale']),
     }
 
-    mismatch = 0
-    wsum = 0
-    for key,true in to_fit.items():
-        realized = ret[key]
-        mismatch += weight[key] * np.abs(realized-true)/true
-        wsum += weight[key]
-
-    ret['mismatch'] = mismatch / wsum
+    ret['mismatch'] = compute_mismatch(ret)
 
     return ret # Weighted mean absolute error (scaled to true value)
 
 
-def objective(trial, kind='default'):
-    ''' Define the objective for Optuna '''
-    pars = {}
-    bounds = cs.define_pars(which='bounds', kind=kind)
-    for key, bound in bounds.items():
-        pars[key] = trial.suggest_uniform(key, *bound)
-    pars['rand_seed'] = trial.number
-
-    sim = cs.create_sim(pars, pop_size=pop_size, folder=folder, children_equally_sus=children_equally_sus, alternate_symptomaticity=alternate_symptomaticity)
-
+def partial_mismatch(sim):
+    '''
+    The mismatch of the targets that are known from the results before the current
+    day, for use while the sim is running: cases_begin from 2020-11-02 on, and the
+    prevalence, yield, and tests averaged over the days so far. Since the results
+    are only finalized at the end, these are computed from the daily counts; Re and
+    cases_end are only known at the end. Returns None before 2020-11-02.
+    '''
+    first = sim.day('2020-11-02')
+    last = sim.day('2021-01-31')
+    end = min(sim.t, last) # Results are complete up to the day before the current one
+    res = sim.results
+    scale = 1e5 / (sim.pars['pop_size'] * sim.pars['pop_scale'])
+
+    ret = {}
+    if sim.t >= first:
+        ret['cases_begin'] = np.sum(res['new_diagnoses'][(first-14):first]) * scale
+    if end > first:
+        tests = res['new_tests'][first:end]
+        diagnoses = res['new_diagnoses'][first:end]
+        alive = sim.scaled_pop_size - np.cumsum(res['new_deaths'][:end])[first:end]
+        ret['prevalence'] = np.mean(res['n_exposed'][first:end]/alive)
+        ret['yield'] = np.mean(np.divide(diagnoses, tests, out=np.zeros(len(tests)), where=tests>0))
+        ret['tests'] = np.mean(tests) * scale
+    if not ret:
+        return None
+    return compute_mismatch(ret)
+
+
+class prune_trial(cv.Intervention):
+    '''
+    Report the partial mismatch to Optuna on each checkpoint day, and stop the sim
+    (by raising optuna.TrialPruned) if the study's pruner rejects the trial. The
+    step reported is the day of the sim.
+    '''
+
+    def __init__(self, trial, days, **kwargs):
+        super().__init__(**kwargs)
+        self.trial = trial
+        self.days = days
+        return
+
+    def initialize(self, sim):
+        self.days = [sim.day(day) for day in self.days]
+        self.initialized = True
+        return
+
+    def apply(self, sim):
+        if sim.t in self.days:
+            mismatch = partial_mismatch(sim)
+            if mismatch is not None:
+                self.trial.report(mismatch, step=sim.t)
+                if self.trial.should_prune():
+                    raise op.TrialPruned(f'Pruned on day {sim.t} with partial mismatch {mismatch:0.3f}')
+        return
+
+
+def add_schools(sim):
+    ''' Add the schools manager used in calibration, with all schools remote '''
     remote = {
         'start_day': '2020-11-02',
         'schedule': 'Remote',
@@ -106,67 +191,214 @@ def objective(trial, kind='default'):
         'testing': None,
     }
     scen = scenario(es=remote, ms=remote, hs=remote)
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, stats_level='none') # School statistics are not used in calibration
     sim['interventions'] += [sm]
+    return sim
+
+
+def make_template(pop_size, pop_seed):
+    '''
+    An initialized sim for one population, with no seed infections, pickled. Also
+    returns the transmissibility odds ratio of each person, so that their viral loads
+    can be drawn again for each trial.
+    '''
+    pars = dict(pop_infected=0, rand_seed=pop_seed)
+    sim = cs.create_sim(pars, pop_size=pop_size, folder=folder, children_equally_sus=children_equally_sus,
+                        alternate_symptomaticity=alternate_symptomaticity, max_pop_seeds=max_pop_seeds)
+    add_schools(sim)
+    sim.initialize()
+    progs = sim['prognoses']
+    age_bins = np.searchsorted(progs['age_cutoffs'], sim.people.age, side='right') - 1 # As in People.set_prognoses()
+    trans_ORs = progs['trans_ORs'][age_bins]
+    return pickle.dumps(sim, protocol=pickle.HIGHEST_PROTOCOL), trans_ORs
+
+
+def trial_sim(pars, pop_size=pop_size):
+    '''
+    The sim for one trial. Rather than loading the population and initializing the
+    people and the schools for every trial, a copy is made of this worker's template
+    for the population (see make_template()), and only what depends on the calibrated
+    parameters and random seed is redone, in the same order as Sim.initialize(): the
+    viral loads, the seed infections, and the parameters of the testing and NPI
+    interventions. The sim is the same as from create_sim() and add_schools().
+    '''
+    key = (pop_size, pars['rand_seed'] % max_pop_seeds)
+    if key not in templates:
+        templates[key] = make_template(*key)
+    template, trans_ORs = templates[key]
+    sim = pickle.loads(template)
+
+    sim['rand_seed'] = pars['rand_seed']
+    sim['pop_infected'] = pars['pop_infected']
+    sim.set_seed()
+    sim.people.rel_trans[:] = trans_ORs*cvu.sample(**sim['beta_dist'], size=len(sim.people))
+    inds = cvu.choose(sim['pop_size'], sim['pop_infected'])
+    sim.people.infect(inds=inds, layer='seed_infection')
+
+    for interv in sim['interventions']:
+        if isinstance(interv, cv.test_prob):
+            interv.symp_prob = interv.symp_quar_prob = pars['symp_prob']
+        elif isinstance(interv, cv.change_beta) and interv.label == 'NPI_work_community':
+            interv.changes = np.array([pars['change_beta']], dtype=float)
+    sim.set_seed() # Reset the random seed again so the random number stream is consistent
+    return sim
+
+
+def objective(trial, kind='default', pop_size=pop_size, prune=do_prune):
+    ''' Define the objective for Optuna '''
+    pars = {}
+    bounds = cs.define_pars(which='bounds', kind=kind)
+    for key, bound in bounds.items():
+        pars[key] = trial.suggest_uniform(key, *bound)
+    pars['rand_seed'] = trial.number
+
+    if reuse_templates and kind == 'default': # Templates only know how to set the default parameters
+        sim = trial_sim(pars, pop_size=pop_size)
+    else:
+        sim = cs.create_sim(pars, pop_size=pop_size, folder=folder, children_equally_sus=children_equally_sus, alternate_symptomaticity=alternate_symptomaticity)
+        add_schools(sim)
+    if prune:
+        pruner = prune_trial(trial, checkpoints)
+        sim['interventions'] += [pruner]
+        if sim.initialized:
+            pruner.initialize(sim)
     sim.run()
 
-    mismatch = evaluate_sim(sim)['mismatch']
-    return mismatch
+    ret = evaluate_sim(sim)
+    trial.set_user_attr('metrics', {key:float(ret[key]) for key in to_fit}) # So the trial can be scored against other targets later; see rescore()
+    return ret['mismatch']
+
+
+def get_storage():
+    ''' The Optuna storage: a journal file if the storage is a .journal file, otherwise a database URL '''
+    if not storage.endswith('.journal'):
+        return storage
+    try:
+        backend = op.storages.journal.JournalFileBackend(storage)
+    except AttributeError: # Before Optuna 4.0
+        backend = op.storages.JournalFileStorage(storage)
+    return op.storages.JournalStorage(backend)
+
+
+def make_pruner(prune=do_prune):
+    ''' Stop trials whose partial mismatch is worse than the median of earlier trials at the same checkpoint; pruners are not stored with the study, so each worker makes its own '''
+    if not prune:
+        return op.pruners.NopPruner()
+    return op.pruners.MedianPruner(n_startup_trials=n_workers, n_warmup_steps=0)
 
 
-def worker():
+def worker(n=n_trials, study_name=name, pop_size=pop_size, prune=do_prune):
     ''' Run a single worker '''
-    study = op.load_study(storage=storage, study_name=name)
-    output = study.optimize(objective, n_trials=n_trials)
+    study = op.load_study(storage=get_storage(), study_name=study_name, pruner=make_pruner(prune))
+    output = study.optimize(functools.partial(objective, pop_size=pop_size, prune=prune), n_trials=n)
     return output
 
 
-def run_workers():
-    ''' Run multiple workers in parallel '''
-    output = sc.parallelize(worker, n_workers)
+def run_workers(study_name=name, pop_size=pop_size, counts=None, prune=do_prune):
+    ''' Run multiple workers in parallel, each running n_trials trials or the number in counts '''
+    if counts is None:
+        counts = [n_trials]*n_workers
+    output = sc.parallelize(worker, iterkwargs=[dict(n=n) for n in counts if n > 0],
+                            kwargs=dict(study_name=study_name, pop_size=pop_size, prune=prune))
     return output
 
 
-def make_study(restart=True):
+def make_study(restart=True, study_name=name):
     ''' Make a study, deleting one if it already exists '''
     try:
         if restart:
-            print(f'About to delete {storage}:{name}, you have 5 seconds to intervene!')
+            print(f'About to delete {storage}:{study_name}, you have 5 seconds to intervene!')
             sc.timedsleep(5.0)
-            op.delete_study(storage=storage, study_name=name)
+            op.delete_study(storage=get_storage(), study_name=study_name)
     except:
         pass
 
-    output = op.create_study(storage=storage, study_name=name, load_if_exists=not(restart))
+    output = op.create_study(storage=get_storage(), study_name=study_name, load_if_exists=not(restart), pruner=make_pruner())
     return output
 
 
-if __name__ == '__main__':
-    t0 = sc.tic()
-    make_study(restart=False)
-    run_workers()
-    study = op.load_study(storage=storage, study_name=name)
-    best_pars = study.best_params
-    T = sc.toc(t0, output=True)
-    print(f'Output: {best_pars}, time: {T}')
+def fidelity_name(fidelity):
+    ''' Name of the study for one population size; the last is the main study '''
+    if fidelity == fidelities[-1]:
+        return name
+    return f'{name}_screen={int(fidelity)}'
+
+
+def promote(from_name, to_name):
+    '''
+    Queue the parameters of the best 1/eta of the completed trials of one study as
+    trials of the next, skipping any that are already there (e.g. when resuming).
+    Returns the number of trials waiting to be run.
+    '''
+    source = op.load_study(storage=get_storage(), study_name=from_name)
+    target = op.load_study(storage=get_storage(), study_name=to_name)
+    done = source.get_trials(deepcopy=False, states=[op.trial.TrialState.COMPLETE])
+    done = sorted(done, key=lambda trial: trial.value)
+    n_promote = int(np.ceil(len(done)/eta))
+    existing = [trial.params or trial.system_attrs.get('fixed_params') for trial in target.get_trials(deepcopy=False)] # Queued trials only have their parameters in fixed_params
+    queued = 0
+    for trial in done[:n_promote]:
+        if trial.params not in existing:
+            target.enqueue_trial(trial.params)
+            queued += 1
+    waiting = len(target.get_trials(deepcopy=False, states=[op.trial.TrialState.WAITING]))
+    print(f'Promoting {queued} of the best {n_promote} of {len(done)} trials from {from_name} to {to_name}; {waiting} to run')
+    return waiting
+
+
+def run_multi_fidelity():
+    '''
+    Successive halving over population size: run the sampler at the smallest size,
+    then rerun the best trials at each larger size. Pruning is only used while
+    screening, so every promoted trial gets a full evaluation.
+    '''
+    if fidelities[-1] != pop_size:
+        raise ValueError(f'The last fidelity must be the population size, {pop_size}, not {fidelities[-1]}')
+    for f,fidelity in enumerate(fidelities):
+        study_name = fidelity_name(fidelity)
+        make_study(restart=False, study_name=study_name)
+        if f == 0:
+            run_workers(study_name=study_name, pop_size=fidelity)
+        else:
+            waiting = promote(fidelity_name(fidelities[f-1]), study_name)
+            counts = [waiting//n_workers + (w < waiting%n_workers) for w in range(n_workers)] # Exactly one trial per queued set of parameters
+            run_workers(study_name=study_name, pop_size=fidelity, counts=counts, prune=False)
+    return
+
+
+def export_pars(study_name=name, filename=None):
+    '''
+    Rank the completed trials of a study by mismatch and save them as the pars_*.json
+    file used by the scenario scripts, the same for any storage.
+
+    Args:
+        study_name (str): the study to export (default: the main study)
+        filename (str): where to save the JSON (default: the study name plus .json); if False, do not save
+
+    Returns:
+        The list of entries, each with the index (random seed), mismatch, and parameters
+    '''
+    study = op.load_study(storage=get_storage(), study_name=study_name)
 
     sc.heading('Loading data...')
     best = cs.define_pars('best')
-    bounds = cs.define_pars('bounds')
 
     sc.heading('Making results structure...')
     results = []
 
     failed_trials = []
+    pruned_trials = []
     for trial in study.trials:
         data = {'index': trial.number, 'mismatch': trial.value}
         for key, val in trial.params.items():
             data[key] = val
-        if data['mismatch'] is None:
+        if trial.state == op.trial.TrialState.PRUNED: # Only trials that ran to the end are used
+            pruned_trials.append(data['index'])
+        elif data['mismatch'] is None:
             failed_trials.append(data['index'])
         else:
             results.append(data)
-    print(f'Processed {len(study.trials)} trials; {len(failed_trials)} failed')
+    print(f'Processed {len(study.trials)} trials; {len(pruned_trials)} pruned; {len(failed_trials)} failed')
 
     sc.heading('Making data structure...')
     keys = ['index', 'mismatch'] + list(best.keys())
@@ -179,16 +411,97 @@ if __name__ == '__main__':
             data[key].append(r[key])
     df = pd.DataFrame.from_dict(data)
 
+    if filename is None:
+        filename = f'{study_name}.json'
+    return save_ranking(df, filename)
+
+
+def save_ranking(df, filename):
+    ''' Sort a dataframe of index, mismatch, and parameters by mismatch and save it in the pars_*.json layout, unless filename is False '''
+    order = np.argsort(df['mismatch'])
+    json = []
+    for o in order:
+        row = df.iloc[o,:].to_dict()
+        rowdict = dict(index=row.pop('index'), mismatch=row.pop('mismatch'), pars={})
+        for key,val in row.items():
+            rowdict['pars'][key] = val
+        json.append(rowdict)
+    if filename is not False:
+        sc.savejson(filename, json, indent=2)
+    return json
+
+
+def trials_table(study_name=name, filename=None):
+    '''
+    Table of the completed trials of a study that recorded their metrics, with one
+    row per trial: the index (random seed), the parameters, and each metric from
+    evaluate_sim(). This is all rescore() needs.
+
+    Args:
+        study_name (str): the study (default: the main study)
+        filename (str): where to save the table as CSV (default: the study name plus _trials.csv); if False, do not save
+
+    Returns:
+        A dataframe
+    '''
+    study = op.load_study(storage=get_storage(), study_name=study_name)
+    rows = []
+    for trial in study.get_trials(deepcopy=False, states=[op.trial.TrialState.COMPLETE]):
+        if 'metrics' in trial.user_attrs:
+            rows.append(dict(index=trial.number, **trial.params, **trial.user_attrs['metrics']))
+    df = pd.DataFrame(rows)
+    print(f'{len(df)} of {len(study.trials)} trials have metrics')
+    if filename is not False:
+        if filename is None:
+            filename = f'{study_name}_trials.csv'
+        df.to_csv(filename, index=False)
+    return df
+
+
+def rescore(table, targets=None, weights=None, filename=None):
+    '''
+    Rank calibration trials against new targets and weights, without running any
+    sims, and save the ranking as a pars_*.json file.
+
+    Args:
+        table (str/dataframe): the trials, from trials_table(), or the CSV file it saved
+        targets (dict): the values to fit, as in to_fit (default: to_fit)
+        weights (dict): the weight of each target, as in weight (default: weight)
+        filename (str): where to save the JSON (default: named after the targets, as from calibration); if False, do not save
+
+    Returns:
+        The list of entries, as from export_pars()
+    '''
+    if isinstance(table, str):
+        table = pd.read_csv(table, float_precision='round_trip') # Read back exactly the values that were written
+    if targets is None:
+        targets = to_fit
+    missing = [key for key in targets if key not in table.columns]
+    if missing:
+        raise ValueError(f'Targets {missing} were not recorded for these trials')
+    metrics = table[list(targets.keys())].to_dict('records')
+    df = table[['index'] + list(cs.define_pars('best').keys())].copy()
+    df.insert(1, 'mismatch', [compute_mismatch(ret, targets=targets, weights=weights) for ret in metrics])
+    if filename is None:
+        filename = f'{make_name(targets)}.json'
+    return save_ranking(df, filename)
+
+
+if __name__ == '__main__':
+    t0 = sc.tic()
+    if multi_fidelity:
+        run_multi_fidelity()
+    else:
+        make_study(restart=False)
+        run_workers()
+    study = op.load_study(storage=get_storage(), study_name=name)
+    best_pars = study.best_params
+    T = sc.toc(t0, output=True)
+    print(f'Output: {best_pars}, time: {T}')
+
     if save_json:
-        order = np.argsort(df['mismatch'])
-        json = []
-        for o in order:
-            row = df.iloc[o,:].to_dict()
-            rowdict = dict(index=row.pop('index'), mismatch=row.pop('mismatch'), pars={})
-            for key,val in row.items():
-                rowdict['pars'][key] = val
-            json.append(rowdict)
-        sc.savejson(f'{name}.json', json, indent=2)
+        json = export_pars(name)
+        trials_table(name)
         saveobj = False
         if saveobj: # Smaller file, but less portable
             sc.saveobj(f'{name}.obj', json)
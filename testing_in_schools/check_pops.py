@@ -1,6 +1,8 @@
 # Simple script to load in population files and print some useful information about schools
 
+import numpy as np
 import sciris as sc
+import covasim_schools as cvsch
 
 files = sc.getfilelist('v20201016_225k/inputs')
 n_files = len(files)
@@ -15,41 +17,27 @@ school_ids = []
 school_ids_type = []
 for p,pop in enumerate(pops):
 
-    print(f'Pop {p} has {sum(pop.student_flag)} students, {sum(pop.teacher_flag)} teachers, and {sum(pop.staff_flag)} staff')
-
-    students = {}
-    teachers = {}
-    staff = {}
-    for st, sids in pop.school_types.items():
-        if st in ['pk', 'uv']:
-            continue
-        students[st] = 0
-        teachers[st] = 0
-        staff[st] = 0
-        for sid in sids:
-            uids = pop.schools[sid]
-            students[st] += len([u for u in uids if pop.student_flag[u]])
-            teachers[st] += len([u for u in uids if pop.teacher_flag[u]])
-            staff[st] += len([u for u in uids if pop.staff_flag[u]])
-
-    print(f'Students: {students}')
-    print(f'Teachers: {teachers}')
-    print(f'Staff: {staff}')
-
+    # The .ppl files here predate the typed school columns (school_id holds None and the flags are lists), so derive them
+    arrs = cvsch.school_arrays(pop)
+    school_id, school_type_code, school_role = arrs['school_id'], arrs['school_type_code'], arrs['school_role']
+
+    # Count each role in each school type
+    n_types, n_roles = len(cvsch.school_type_keys), len(cvsch.school_role_keys)
+    in_school = school_role >= 0
+    counts = np.bincount(school_type_code[in_school]*n_roles + school_role[in_school], minlength=n_types*n_roles).reshape(n_types, n_roles)
+    n_students, n_teachers, n_staff = counts.sum(axis=0)
+    print(f'Pop {p} has {n_students} students, {n_teachers} teachers, and {n_staff} staff')
+    for r,role in enumerate(['Students', 'Teachers', 'Staff']):
+        by_type = {st:int(counts[t,r]) for t,st in enumerate(cvsch.school_type_keys) if st not in ['pk', 'uv']}
+        print(f'{role}: {by_type}')
+
+    in_school = school_id >= 0
+    ids = set(np.unique(school_id[in_school]).tolist())
     school_ids_type.append(sc.objdict())
-    inds = [i for i,val in enumerate(pop.school_id) if val is not None]
-    ids = set(pop.school_id[inds])
-    for ind in inds:
-        kind = pop.school_type_by_person[ind]
-        sid = pop.school_id[ind]
-        if kind not in school_ids_type[-1]:
-            school_ids_type[-1][kind] = {sid:1}
-        elif sid not in school_ids_type[-1][kind]:
-            school_ids_type[-1][kind][sid] = 1
-        else:
-            school_ids_type[-1][kind][sid] += 1
-    for k in school_ids_type[-1].keys():
-        school_ids_type[-1][k] = len(school_ids_type[-1][k])
+    for t,kind in enumerate(cvsch.school_type_keys):
+        sids = np.unique(school_id[in_school & (school_type_code == t)])
+        if len(sids):
+            school_ids_type[-1][kind] = len(sids)
     print(f'School {files[p]} has {len(ids)} unique schools')
     print(school_ids_type[-1])
     print(school_ids_type[-1]['es'] + school_ids_type[-1]['ms'] + school_ids_type[-1]['hs'])
@@ -0,0 +1,11 @@
+# Convert population files to memory-mapped population stores, which create_sim() then uses in preference to the .ppl files
+
+import sys
+import sciris as sc
+import covasim_schools as cvsch
+
+folder = sys.argv[1] if len(sys.argv) > 1 else 'inputs'
+files = sc.getfilelist(folder, pattern='*.ppl')
+
+for fn in files:
+    cvsch.convert_popfile(fn)
@@ -16,7 +16,7 @@ cv.check_save_version('1.7.6', folder='gitinfo', comments={'SynthPops':sc.gitinf
 
 par_inds = (20,30)
 pop_size = 2.25e5
-batch_size = 16
+ncpus = 32 # At most; fewer if memory runs short
 
 folder = 'v20201019'
 stem = f'countermeasures_v2_{par_inds[0]}-{par_inds[1]}'
@@ -89,10 +89,10 @@ if __name__ == '__main__':
 
     par_list = sc.loadjson(calibfile)[par_inds[0]:par_inds[1]]
 
-    sims = []
-    msims = []
+    from calibrate_model import evaluate_sim # Needs Optuna
+    sink = cvsch.ResultsSink(os.path.join(folder, 'results', stem), metrics=evaluate_sim, days={'d1':'2020-11-02'}) # Summary rows for the plotting scripts
+
     tot = len(scenarios) * len(testing) * len(par_list) * len(sensitivity)
-    proc = 0
 
     # Save time by pre-generating the base simulations
     base_sims = []
@@ -103,48 +103,44 @@ if __name__ == '__main__':
         base_sim.dynamic_par = par
         base_sims.append(base_sim)
 
-    for senskey, builders in sensitivity.items():
-        print(f'Beginning {senskey}')
-        for eidx, base_sim in enumerate(base_sims):
-            for sidx, (skey, scen) in enumerate(scenarios.items()):
-                for tidx, (tkey, test) in enumerate(testing.items()):
-                    sim = base_sim.copy()
-
-                    sim.label = f'{skey} + {tkey}'
-                    sim.key1 = skey
-                    sim.key2 = tkey
-                    sim.key3 = senskey
-                    sim.eidx = eidx
-                    sim.scen = scen
-                    sim.tscen = test
-                    sim.dynamic_par = par
-
-                    # Call the function to build the sensitivity analysis
-                    modscen = sc.dcp(scen)
-                    for builder in builders:
-                        modscen = builder(sim, modscen, sc.dcp(test))
-
-
-                    sm = cvsch.schools_manager(modscen)
-                    sim['interventions'] += [sm]
-
-                    sims.append(sim)
-                    proc += 1
-
-                    if len(sims) == batch_size:# or proc == tot or (tidx == len(testing)-1 and sidx == len(scenarios)-1 and eidx == len(par_list)-1):
-                        print(f'Running sims {proc-len(sims)}-{proc-1} of {tot}')
-                        msim = cv.MultiSim(sims)
-                        msims.append(msim)
-                        msim.run(reseed=False, par_args={'ncpus': 32}, noise=0.0, keep_people=False)
-                        sims = []
-
-        #fn = os.path.join(folder, 'msims', f'{stem}_{senskey}.msim')
-        #print(f'*** Saving to {fn} after completing {senskey}')
-        #sims_this_scenario = [s for msim in msims for s in msim.sims if s.key3 == senskey]
-        #msim = cv.MultiSim(sims_this_scenario)
-        #cv.save(fn, msim)
-
-    msim = cv.MultiSim.merge(msims)
+    def make_sims():
+        ''' Create each sim only when there is a worker and memory free to run it '''
+        for senskey, builders in sensitivity.items():
+            print(f'Beginning {senskey}')
+            for eidx, base_sim in enumerate(base_sims):
+                for sidx, (skey, scen) in enumerate(scenarios.items()):
+                    for tidx, (tkey, test) in enumerate(testing.items()):
+                        sim = base_sim.copy()
+
+                        sim.label = f'{skey} + {tkey}'
+                        sim.key1 = skey
+                        sim.key2 = tkey
+                        sim.key3 = senskey
+                        sim.eidx = eidx
+                        sim.scen = scen
+                        sim.tscen = test
+                        sim.dynamic_par = par
+
+                        # Call the function to build the sensitivity analysis
+                        modscen = sc.dcp(scen)
+                        for builder in builders:
+                            modscen = builder(sim, modscen, sc.dcp(test))
+
+
+                        sm = cvsch.schools_manager(modscen, batch_testing=True)
+                        sim['interventions'] += [sm]
+                        yield sim
+
+    finished = []
+    def save_sim(sim):
+        ''' Write the summary rows of each sim as soon as it finishes '''
+        sink.add(sim)
+        finished.append(sim.label)
+        print(f'Finished {len(finished)} of {tot} sims')
+
+    sims = cvsch.run_sims(make_sims(), ncpus=ncpus, callback=save_sim) # Runs as many at once as memory allows
+
+    msim = cv.MultiSim(sims)
     msim.base_sim = [] # Save disk space
     fn = os.path.join(folder, 'msims', f'{stem}.msim')
     print(f'Saving msims to {fn}')
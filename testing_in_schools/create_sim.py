@@ -4,6 +4,8 @@ Used in calibration and other downstream activities.
 '''
 
 import os
+import copy
+import collections
 import covasim as cv
 import sciris as sc
 import covasim_schools as cvsch
@@ -30,9 +32,73 @@ def define_pars(which='best', kind='default', ):
     return output
 
 
+# Populations loaded so far in this process, most recently used last; see load_people()
+pop_cache = collections.OrderedDict()
+pop_cache_size = 5 # Enough for every population when max_pop_seeds=5
+shared_keys = ['uid', 'age', 'sex'] # Person arrays that a sim never changes
+
+
+def copy_people(people):
+    '''
+    Copy a loaded People object for a new sim. The arrays that sims only replace,
+    rather than change in place, are shared with the original: ages, sexes, the
+    contacts of each layer, and the school attributes. The health states, dates,
+    and other per-person arrays that a sim updates are copied. For a population
+    store, the shared arrays stay mapped, so pickling the copy still only refers to
+    the store's files.
+    '''
+    new = object.__new__(type(people))
+    new.__dict__.update(people.__dict__)
+    for key in people.keys():
+        if key not in shared_keys:
+            new[key] = people[key].copy()
+    new.contacts = copy.copy(people.contacts)
+    for lkey,layer in people.contacts.items():
+        new.contacts[lkey] = copy.copy(layer) # A new layer with the same arrays, so replacing an array doesn't affect the original
+    new.flows = dict(people.flows)
+    new.infection_log = list(people.infection_log)
+    new._pending_quarantine = copy.deepcopy(people._pending_quarantine)
+    if hasattr(people, '_mapped'):
+        new._mapped = dict(people._mapped)
+    return new
+
+
+def load_people(popfile, cache=True):
+    '''
+    Load a population file, or a population store made by convert_pops.py, and return
+    a copy of it. Loaded populations are cached, keyed by path and modification time,
+    so each population is only read from disk once per process, i.e. once per worker
+    for sims that are built in the workers, as in calibrate_model.py, and once in
+    total for sims that are built in the main process, as in run_scenarios.py. The
+    least recently used is dropped when there are more than pop_cache_size. Since the
+    sim modifies its people, a copy is returned; see copy_people().
+
+    Args:
+        popfile (str): the .ppl file or store directory
+        cache (bool): whether to use the cache
+    '''
+    path = os.path.abspath(popfile)
+    is_store = os.path.isdir(path)
+    load = cvsch.load_pop_store if is_store else cv.load
+    if not cache:
+        return load(path)
+
+    mtime = os.path.getmtime(os.path.join(path, 'meta.json') if is_store else path)
+    key = (path, mtime)
+    if key in pop_cache:
+        pop_cache.move_to_end(key)
+    else:
+        for old_key in [k for k in pop_cache if k[0] == path]: # The file has changed since it was cached
+            del pop_cache[old_key]
+        pop_cache[key] = load(path)
+    while len(pop_cache) > pop_cache_size:
+        pop_cache.popitem(last=False)
+    return copy_people(pop_cache[key])
+
+
 def create_sim(params=None, pop_size=2.25e5, rand_seed=1, folder=None, popfile_stem=None,
                children_equally_sus=False, alternate_symptomaticity=False, max_pop_seeds=5, load_pop=True, save_pop=False, people=None,
-               label=None, verbose=0, **kwargs):
+               cache_pop=True, label=None, verbose=0, **kwargs):
     '''
     Create the simulation for use with schools. This is the main function used to
     create the sim object.
@@ -46,9 +112,10 @@ def create_sim(params=None, pop_size=2.25e5, rand_seed=1, folder=None, popfile_s
         children_equally_sus (bool): whether children should be equally susceptible as adults (for sensitivity)
         alternate_symptomaticity (bool): whether to use symptoms by age from Table 1 in https://arxiv.org/pdf/2006.08471.pdf
         max_pop_seeds (int): maximum number of populations to generate (for use with different random seeds)
-        load_pop (bool): whether to load people from disk (otherwise, use supplied or create afresh)
+        load_pop (bool): whether to load people from disk (otherwise, use supplied or create afresh); a population store next to the popfile is used if present
         save_pop (bool): if a population is being generated, whether to save
         people (People): if supplied, use instead of loading from file
+        cache_pop (bool): whether to keep loaded populations in memory for the next sim (see load_people())
         label (str): a name for the simulation
         verbose (float): level of verbosity to use (merged into parameters)
         kwargs (dict): merged with params
@@ -121,7 +188,11 @@ def create_sim(params=None, pop_size=2.25e5, rand_seed=1, folder=None, popfile_s
             popfile_stem = os.path.join(folder, popfile_stem) # Prepend user folder
         pop_seed = p.rand_seed % max_pop_seeds
         popfile = popfile_stem + str(pop_seed) + '.ppl'
+        store = cvsch.store_path(popfile)
+        if os.path.isdir(store): # Prefer the memory-mapped store, if one has been made by convert_pops.py
+            popfile = store
         print(f'Note: loading population from {popfile}')
+        popfile = load_people(popfile, cache=cache_pop)
     elif people is not None: # People is supplied; use that
         popfile = people
         print('Note: using supplied people')
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 import matplotlib as mplt
 import covasim_schools as cvsch
 import testing_scenarios as t_s # From the local folder
+import run_branched as rb
 from pathlib import Path
 import synthpops as sp
 
@@ -20,10 +21,11 @@ mplt.rcParams['font.size'] = font_size
 mplt.rcParams['font.family'] = font_style
 
 do_run = False
+do_branch = False # Simulate the days before testing starts once per parameter set, see run_branched.py; results are then statistically equivalent to, but not reproducible against, unbranched runs
 
 par_inds = (0,30) # First and last parameters to run
 pop_size = 2.25e5 # 1e5 2.25e4 2.25e5
-batch_size = 16
+ncpus = 16 # At most; fewer if memory runs short
 
 folder = 'v20201019'
 stem = f'pcr_days_sweep_{par_inds[0]}-{par_inds[1]}'
@@ -51,50 +53,41 @@ if __name__ == '__main__':
 
     par_list = sc.loadjson(calibfile)[par_inds[0]:par_inds[1]]
 
-    if do_run:
-        sims = []
-        msims = []
-        tot = len(scenarios) * len(testing) * len(par_list)
-        proc = 0
-        for skey, scen in scenarios.items():
-            for tidx, (tkey, test) in enumerate(testing.items()):
-                for eidx, entry in enumerate(par_list):
-                    par = sc.dcp(entry['pars'])
-                    par['rand_seed'] = int(entry['index'])
-                    sim = cs.create_sim(par, pop_size=pop_size, folder=folder)
-
-                    # Modify scen with test
-                    this_scen = sc.dcp(scen)
-                    for stype, spec in this_scen.items():
-                        if spec is not None:
-                            spec['testing'] = sc.dcp(test) # dcp probably not needed because deep copied in new_schools
-                            #spec['beta_s'] = 1.5 # Shouldn't matter considering schools are closed in the 'all_remote' scenario
-
-                    ns = cvsch.schools_manager(this_scen)
-                    sim['interventions'] += [ns]
-
-                    sim.label = f'{skey} + {tkey}'
-                    sim.key1 = skey
-                    sim.key2 = tkey
-                    sim.scen = scen
-                    sim.tscen = test
-                    sim.dynamic_par = par
-                    sims.append(sim)
-
-                    proc += 1
-
-                    if len(sims) == batch_size or proc == tot:# or (tidx == len(testing)-1 and eidx == len(par_list)-1):
-                        print(f'Running sims {proc-len(sims)}-{proc-1} of {tot}')
-                        msim = cv.MultiSim(sims)
-                        msims.append(msim)
-                        msim.run(reseed=False, par_args={'ncpus': 16}, noise=0.0, keep_people=False)
-                        sims = []
-
-            print(f'*** Saving after completing {skey}')
-            sims_this_scenario = [s for msim in msims for s in msim.sims if s.key1 == skey]
-            msim = cv.MultiSim(sims_this_scenario)
-
-        msim = cv.MultiSim.merge(msims)
+    if do_run and do_branch:
+        msim = rb.run_branched(scenarios, testing, par_list, pop_size=pop_size, folder=folder, ncpus=ncpus)
+        fn = os.path.join(folder, 'msims', f'{stem}.msim')
+        print(f'Saving to {fn}')
+        msim.save(fn, keep_people=False)
+    elif do_run:
+        def make_sims():
+            ''' Create each sim only when there is a worker and memory free to run it '''
+            for skey, scen in scenarios.items():
+                for tidx, (tkey, test) in enumerate(testing.items()):
+                    for eidx, entry in enumerate(par_list):
+                        par = sc.dcp(entry['pars'])
+                        par['rand_seed'] = int(entry['index'])
+                        sim = cs.create_sim(par, pop_size=pop_size, folder=folder)
+
+                        # Modify scen with test
+                        this_scen = sc.dcp(scen)
+                        for stype, spec in this_scen.items():
+                            if spec is not None:
+                                spec['testing'] = sc.dcp(test) # dcp probably not needed because deep copied in new_schools
+                                #spec['beta_s'] = 1.5 # Shouldn't matter considering schools are closed in the 'all_remote' scenario
+
+                        ns = cvsch.schools_manager(this_scen, batch_testing=True)
+                        sim['interventions'] += [ns]
+
+                        sim.label = f'{skey} + {tkey}'
+                        sim.key1 = skey
+                        sim.key2 = tkey
+                        sim.scen = scen
+                        sim.tscen = test
+                        sim.dynamic_par = par
+                        yield sim
+
+        sims = cvsch.run_sims(make_sims(), ncpus=ncpus) # Runs as many at once as memory allows
+        msim = cv.MultiSim(sims)
         fn = os.path.join(folder, 'msims', f'{stem}.msim')
         print(f'Saving to {fn}')
         msim.save(fn, keep_people=False)
@@ -1,4 +1,4 @@
-# Main workhorse script to generate plots from scenario simulations.  Sims are saved into the msim folder of the respective analysis folder, e.g. v20201013. Often we distribute computing by seeds, generating several *.msim files, which are combined here before plotting.
+# Main workhorse script to generate plots from scenario simulations.  The scenario scripts write a summary row for each sim, and a row for each school, to the results folder of the respective analysis folder, e.g. v20201019/results/<variant>; only the columns used here are read. Runs from before the results folder only saved the sims (a .sims file in the msims folder), so for those the same rows are built from the sims.
 
 import os
 import covasim as cv
@@ -9,8 +9,8 @@ import pandas as pd
 import matplotlib as mplt
 import matplotlib.pyplot as plt
 import seaborn as sns
-import datetime as dt
-from calibrate_model import evaluate_sim
+import covasim_schools as cvsch
+from calibrate_model import to_fit, evaluate_sim
 from pathlib import Path
 
 # Global plotting styles
@@ -24,16 +24,12 @@ pop_size = 2.25e5
 folder = 'v20201019'
 variant = 'countermeasures_v2_0-30'
 school_scenario = 'with_countermeasures'
-cachefn = os.path.join(folder, 'msims', f'{variant}.sims')
+resultsdir = os.path.join(folder, 'results', variant)
+cachefn = os.path.join(folder, 'msims', f'{variant}.sims') # Used if there is no results folder
 
 imgdir = os.path.join(folder, 'img_'+variant)
 Path(imgdir).mkdir(parents=True, exist_ok=True)
 
-print(f'loading {cachefn}')
-#sims = cv.MultiSim.load(cachefn).sims
-sims = cv.load(cachefn)
-
-results = []
 groups = ['students', 'teachers', 'staff']
 
 scen_names = sc.odict({ # key1
@@ -77,81 +73,51 @@ sens_names = sc.odict({ # key3
 sens_order = sens_names.values()
 
 
-for sim in sims:
-    sim.key2 = test_names[sim.key2][0] if sim.key2 in test_names else sim.key2
-    sim.key3 = sens_names[sim.key3] if sim.key3 in sens_names else sim.key3
-
-    first_date = '2020-11-02'
-    first_school_day = sim.day(first_date)
-    last_date = '2021-01-31'
-    last_school_day = sim.day(last_date)
-    ret = {
-        'key1': sim.key1,
-        'key2': sim.key2,
-        'key3': sim.key3,
-    }
-
-    perf = evaluate_sim(sim)
-    ret.update(perf)
-
-    n_schools = {'es':0, 'ms':0, 'hs':0}
-    n_schools_with_inf_d1 = {'es':0, 'ms':0, 'hs':0}
-
-    grp_dict = {'Students': ['students'], 'Teachers & Staff': ['teachers', 'staff']}
-    perc_inperson_days_lost = {k:[] for k in grp_dict.keys()}
-    attackrate = {k:[] for k in grp_dict.keys()}
-    count = {k:0 for k in grp_dict.keys()}
-    exposed = {k:0 for k in grp_dict.keys()}
-    inperson_days = {k:0 for k in grp_dict.keys()}
-    possible_days = {k:0 for k in grp_dict.keys()}
-
-    for sid,stats in sim.school_stats.items():
-        if stats['type'] not in ['es', 'ms', 'hs']:
-            continue
-
-        inf = stats['infectious']
-        inf_at_sch = stats['infectious_stay_at_school'] # stats['infectious_arrive_at_school'] stats['infectious_stay_at_school']
-        in_person = stats['in_person']
-        exp = stats['newly_exposed']
-        num_school_days = stats['num_school_days']
-        possible_school_days = np.busday_count(first_date, last_date)
-        n_exp = {}
-        for grp in groups:
-            n_exp[grp] = np.sum(exp[grp])
-
-        for gkey, grps in grp_dict.items():
-            in_person_days = scheduled_person_days = num_exposed = num_people = 0
-            for grp in grps:
-                in_person_days += np.sum(in_person[grp])
-                scheduled_person_days += num_school_days * stats['num'][grp]
-                num_exposed += n_exp[grp]
-                num_people += stats['num'][grp]
-            perc_inperson_days_lost[gkey].append(
-                100*(scheduled_person_days - in_person_days)/scheduled_person_days if scheduled_person_days > 0 else 100
-            )
-            attackrate[gkey].append( 100 * num_exposed / num_people)
-
-            exposed[gkey] += n_exp[grp]
-            count[gkey] += stats['num'][grp]
-            inperson_days[gkey] += in_person_days
-            possible_days[gkey] += possible_school_days*num_people
-
-        n_schools[stats['type']] += 1
-        if inf_at_sch['students'][first_school_day] + inf_at_sch['teachers'][first_school_day] + inf_at_sch['staff'][first_school_day] > 0:
-            n_schools_with_inf_d1[stats['type']] += 1
-
-    for stype in ['es', 'ms', 'hs']:
-        ret[f'{stype}_perc_d1'] = 100 * n_schools_with_inf_d1[stype] / n_schools[stype]
-
-    # Deciding between district and school perspective here
-    for gkey in grp_dict.keys():
-        ret[f'perc_inperson_days_lost_{gkey}'] = 100*(possible_days[gkey]-inperson_days[gkey])/possible_days[gkey] #np.mean(perc_inperson_days_lost[gkey])
-        ret[f'attackrate_{gkey}'] = 100*exposed[gkey] / count[gkey] #np.mean(attackrate[gkey])
-        ret[f'count_{gkey}'] = np.sum(count[gkey])
-
-    results.append(ret)
-
-df = pd.DataFrame(results)
+first_date = '2020-11-02'
+last_date = '2021-01-31'
+possible_school_days = np.busday_count(first_date, last_date)
+grp_dict = {'Students': ['students'], 'Teachers & Staff': ['teachers', 'staff']}
+
+# One row per sim, and one per school, read from the results written by the scenario script
+if os.path.isdir(resultsdir):
+    print(f'Loading {resultsdir}')
+    sims = None
+else:
+    print(f'No results in {resultsdir}, so building them from {cachefn}')
+    sims = cv.load(cachefn)
+
+def load_table(table='summary', columns=None, filters=None):
+    ''' Read a table from the results folder, or build it from the sims '''
+    if sims is None:
+        return cvsch.load_results(resultsdir, table=table, columns=columns, filters=filters)
+    return cvsch.collect_results(sims, table=table, columns=columns, filters=filters, metrics=evaluate_sim, days={'d1':first_date})
+
+keys = cvsch.partition_keys # Each sim has its own key1, key2, key3, and seed
+df = load_table(columns=keys + list(to_fit.keys()) + ['mismatch'])
+columns = keys + ['type'] + [f'{key}_{grp}' for key in ['num', 'in_person', 'newly_exposed'] for grp in groups] + [f'infectious_stay_at_school_{grp}_d1' for grp in groups]
+schools = load_table(table='schools', columns=columns, filters=[('type', 'in', ['es', 'ms', 'hs'])])
+
+# Totals over the schools of each sim
+schools['d1'] = schools[[f'infectious_stay_at_school_{grp}_d1' for grp in groups]].sum(axis=1) > 0
+for gkey, grps in grp_dict.items():
+    schools[f'inperson_days_{gkey}'] = schools[[f'in_person_{grp}' for grp in grps]].sum(axis=1)
+    schools[f'possible_days_{gkey}'] = possible_school_days*schools[[f'num_{grp}' for grp in grps]].sum(axis=1)
+    schools[f'exposed_{gkey}'] = schools[[f'newly_exposed_{grp}' for grp in grps]].sum(axis=1)
+    schools[f'count_{gkey}'] = schools[[f'num_{grp}' for grp in grps]].sum(axis=1)
+totals = schools.groupby(keys).sum(numeric_only=True)
+perc_d1 = 100*schools.pivot_table(index=keys, columns='type', values='d1', aggfunc='mean')
+for stype in ['es', 'ms', 'hs']:
+    totals[f'{stype}_perc_d1'] = perc_d1[stype]
+
+# Deciding between district and school perspective here
+for gkey in grp_dict.keys():
+    totals[f'perc_inperson_days_lost_{gkey}'] = 100*(totals[f'possible_days_{gkey}']-totals[f'inperson_days_{gkey}'])/totals[f'possible_days_{gkey}']
+    totals[f'attackrate_{gkey}'] = 100*totals[f'exposed_{gkey}'] / totals[f'count_{gkey}']
+derived = [f'{stype}_perc_d1' for stype in ['es', 'ms', 'hs']] + [f'{key}_{gkey}' for gkey in grp_dict.keys() for key in ['perc_inperson_days_lost', 'attackrate', 'count']]
+df = df.merge(totals[derived].reset_index(), on=keys)
+df['key2'] = [test_names[key][0] if key in test_names else key for key in df['key2']]
+df['key3'] = [sens_names[key] if key in sens_names else key for key in df['key3']]
+df = df[['key1', 'key2', 'key3'] + [col for col in df.columns if col not in keys]]
 
 # Frac in-person days lost
 d = pd.melt(df, id_vars=['key1', 'key2', 'key3'], value_vars=[f'perc_inperson_days_lost_{gkey}' for gkey in grp_dict.keys()], var_name='Group', value_name='Days lost (%)')
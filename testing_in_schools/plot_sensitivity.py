@@ -1,4 +1,4 @@
-# Main workhorse script to generate plots from scenario simulations.  Sims are saved into the msim folder of the respective analysis folder, e.g. v20201013. Often we distribute computing by seeds, generating several *.msim files, which are combined here before plotting.
+# Main workhorse script to generate plots from scenario simulations.  The scenario scripts write a summary row for each sim, and a row for each school, to the results folder of the respective analysis folder, e.g. v20201019/results/<variant>; only the columns used here are read. Runs from before the results folder only saved the sims (a .sims file in the msims folder), so for those the same rows are built from the sims.
 
 import os
 import covasim as cv
@@ -9,8 +9,8 @@ import pandas as pd
 import matplotlib as mplt
 import matplotlib.pyplot as plt
 import seaborn as sns
-import datetime as dt
-from calibrate_model import evaluate_sim
+import covasim_schools as cvsch
+from calibrate_model import to_fit, evaluate_sim
 from pathlib import Path
 
 # Global plotting styles
@@ -23,22 +23,12 @@ pop_size = 2.25e5
 
 folder = 'v20201019'
 variant = 'sensitivity_v3'
-cachefn = os.path.join(folder, 'msims', f'{variant}.sims')
-debug_plot = False
+resultsdir = os.path.join(folder, 'results', variant)
+cachefn = os.path.join(folder, 'msims', f'{variant}.sims') # Used if there is no results folder
 
 imgdir = os.path.join(folder, 'img_'+variant)
 Path(imgdir).mkdir(parents=True, exist_ok=True)
 
-print(f'loading {cachefn}')
-#sims = cv.MultiSim.load(cachefn).sims
-sims = cv.load(cachefn)
-
-#sims = cv.MultiSim.load(os.path.join(folder, 'msims','sensitivity_v2_alt_symp_0-30.msim')).sims
-#sims += cv.load(os.path.join(folder, 'msims','sensitivity_v2_0-30.sims'))
-
-
-results = []
-byschool = []
 groups = ['students', 'teachers', 'staff']
 
 scen_names = sc.odict({ # key1
@@ -105,117 +95,71 @@ sens_names = sc.odict({ # key3
 sens_order = sens_names.values()
 
 
-for sim in sims:
-    sim.key2 = test_names[sim.key2][0] if sim.key2 in test_names else sim.key2
-    sim.key3 = sens_names[sim.key3] if sim.key3 in sens_names else sim.key3
-
-
-tests = []
-for sim in sims:
-    first_date = '2020-11-02'
-    first_school_day = sim.day(first_date)
-    last_date = '2021-01-31'
-    last_school_day = sim.day(last_date)
-    ret = {
-        'key1': sim.key1,
-        'key2': sim.key2,
-        'key3': sim.key3,
-    }
-
-    perf = evaluate_sim(sim)
-    ret.update(perf)
-
-    n_schools = {'es':0, 'ms':0, 'hs':0}
-    n_schools_with_inf_d1 = {'es':0, 'ms':0, 'hs':0}
-
-    grp_dict = {'Students': ['students'], 'Teachers & Staff': ['teachers', 'staff']}
-    perc_inperson_days_lost = {k:[] for k in grp_dict.keys()}
-    attackrate = {k:[] for k in grp_dict.keys()}
-    count = {k:0 for k in grp_dict.keys()}
-    exposed = {k:0 for k in grp_dict.keys()}
-    inperson_days = {k:0 for k in grp_dict.keys()}
-    possible_days = {k:0 for k in grp_dict.keys()}
-
-    #tests.append([sim.key1, sim.key2, np.sum(sim.results['new_tests'][first:last])])
-    #tests.append([sim.key1, sim.key2, sim.results['new_tests']]) # [first:last]
-
-    for sid,stats in sim.school_stats.items():
-        if stats['type'] not in ['es', 'ms', 'hs']:
-            continue
-
-        inf = stats['infectious']
-        inf_at_sch = stats['infectious_stay_at_school'] # stats['infectious_arrive_at_school'] stats['infectious_stay_at_school']
-        in_person = stats['in_person']
-        exp = stats['newly_exposed']
-        num_school_days = stats['num_school_days']
-        possible_school_days = np.busday_count(first_date, last_date)
-        n_exp = {}
-        for grp in groups:
-            n_exp[grp] = np.sum(exp[grp])
-
-        for gkey, grps in grp_dict.items():
-            in_person_days = scheduled_person_days = num_exposed = num_people = 0
-            for grp in grps:
-                in_person_days += np.sum(in_person[grp])
-                scheduled_person_days += num_school_days * stats['num'][grp]
-                num_exposed += n_exp[grp]
-                num_people += stats['num'][grp]
-            perc_inperson_days_lost[gkey].append(
-                100*(scheduled_person_days - in_person_days)/scheduled_person_days if scheduled_person_days > 0 else 100
-            )
-            attackrate[gkey].append( 100 * num_exposed / num_people)
-
-            exposed[gkey] += n_exp[grp]
-            count[gkey] += stats['num'][grp]
-            inperson_days[gkey] += in_person_days
-            possible_days[gkey] += possible_school_days*num_people
-
-        n_schools[stats['type']] += 1
-        if inf_at_sch['students'][first_school_day] + inf_at_sch['teachers'][first_school_day] + inf_at_sch['staff'][first_school_day] > 0:
-            n_schools_with_inf_d1[stats['type']] += 1
-
-        if debug_plot and sim.key1=='as_normal' and sim.key2 == 'None':# and sum([inf_at_sch[g][first_school_day] for g in groups]) > 0:
-            f = plt.figure(figsize=(12,8))
-            for grp in ['students', 'teachers', 'staff']:
-                #plt.plot(sim.results['date'], inf[grp], label=grp)
-                plt.plot(sim.results['date'], stats['infectious_arrive_at_school'][grp], ls='-', label=f'{grp} arrived')
-                plt.plot(sim.results['date'], stats['infectious_stay_at_school'][grp], ls=':', label=f'{grp} stayed')
-                #plt.plot(sim.results['date'], at_home[grp], ls=':', label=f'{grp} at home')
-                plt.axvline(x=dt.datetime(2020, 11, 2), color = 'r')
-            plt.title(sim.label)
-            plt.legend()
-            plt.show()
-
-        byschool.append({
-            'sid': sid,
-            'type': stats['type'],
-            'key1': sim.key1, # Filtered to just one scenario (key1)
-            'key2': sim.key2,
-            'key3': sim.key3,
-            'n_students': stats['num']['students'], #sum([stats['num'][g] for g in groups]),
-            'n': sum([stats['num'][g] for g in groups]),
-            'd1 infectious': sum([inf_at_sch[g][first_school_day] for g in groups]),
-            'd1 bool': sum([inf_at_sch[g][first_school_day] for g in groups]) > 0,
-            'PCR': stats['n_tested']['PCR'],
-            'Antigen': stats['n_tested']['Antigen'],
-            'Days': last_school_day - first_school_day,
-            'Pop*Scale': sim.pars['pop_size']*sim.pars['pop_scale'],
-        })
-
-    for stype in ['es', 'ms', 'hs']:
-        ret[f'{stype}_perc_d1'] = 100 * n_schools_with_inf_d1[stype] / n_schools[stype]
-
-    # Deciding between district and school perspective here
-    for gkey in grp_dict.keys():
-        ret[f'perc_inperson_days_lost_{gkey}'] = 100*(possible_days[gkey]-inperson_days[gkey])/possible_days[gkey] #np.mean(perc_inperson_days_lost[gkey])
-        ret[f'attackrate_{gkey}'] = 100*exposed[gkey] / count[gkey] #np.mean(attackrate[gkey])
-        ret[f'count_{gkey}'] = np.sum(count[gkey])
-
-    results.append(ret)
-
-df = pd.DataFrame(results)
+first_date = '2020-11-02'
+last_date = '2021-01-31'
+possible_school_days = np.busday_count(first_date, last_date)
+grp_dict = {'Students': ['students'], 'Teachers & Staff': ['teachers', 'staff']}
+
+# One row per sim, and one per school, read from the results written by the scenario script
+if os.path.isdir(resultsdir):
+    print(f'Loading {resultsdir}')
+    sims = None
+else:
+    print(f'No results in {resultsdir}, so building them from {cachefn}')
+    sims = cv.load(cachefn)
+
+def load_table(table='summary', columns=None, filters=None):
+    ''' Read a table from the results folder, or build it from the sims '''
+    if sims is None:
+        return cvsch.load_results(resultsdir, table=table, columns=columns, filters=filters)
+    return cvsch.collect_results(sims, table=table, columns=columns, filters=filters, metrics=evaluate_sim, days={'d1':first_date})
+
+keys = cvsch.partition_keys # Each sim has its own key1, key2, key3, and seed
+df = load_table(columns=keys + list(to_fit.keys()) + ['mismatch', 'pop_size', 'pop_scale'])
+columns = keys + ['sid', 'type', 'n_tested_PCR', 'n_tested_Antigen'] + [f'{key}_{grp}' for key in ['num', 'in_person', 'newly_exposed'] for grp in groups] + [f'infectious_stay_at_school_{grp}_d1' for grp in groups]
+schools = load_table(table='schools', columns=columns, filters=[('type', 'in', ['es', 'ms', 'hs'])])
+for frame in [df, schools]:
+    frame['key2'] = [test_names[key][0] if key in test_names else key for key in frame['key2']]
+    frame['key3'] = [sens_names[key] if key in sens_names else key for key in frame['key3']]
+
+# Totals over the schools of each sim
+schools['d1 infectious'] = schools[[f'infectious_stay_at_school_{grp}_d1' for grp in groups]].sum(axis=1)
+schools['d1'] = schools['d1 infectious'] > 0
+for gkey, grps in grp_dict.items():
+    schools[f'inperson_days_{gkey}'] = schools[[f'in_person_{grp}' for grp in grps]].sum(axis=1)
+    schools[f'possible_days_{gkey}'] = possible_school_days*schools[[f'num_{grp}' for grp in grps]].sum(axis=1)
+    schools[f'exposed_{gkey}'] = schools[[f'newly_exposed_{grp}' for grp in grps]].sum(axis=1)
+    schools[f'count_{gkey}'] = schools[[f'num_{grp}' for grp in grps]].sum(axis=1)
+totals = schools.groupby(keys).sum(numeric_only=True)
+perc_d1 = 100*schools.pivot_table(index=keys, columns='type', values='d1', aggfunc='mean')
+for stype in ['es', 'ms', 'hs']:
+    totals[f'{stype}_perc_d1'] = perc_d1[stype]
+
+# Deciding between district and school perspective here
+for gkey in grp_dict.keys():
+    totals[f'perc_inperson_days_lost_{gkey}'] = 100*(totals[f'possible_days_{gkey}']-totals[f'inperson_days_{gkey}'])/totals[f'possible_days_{gkey}']
+    totals[f'attackrate_{gkey}'] = 100*totals[f'exposed_{gkey}'] / totals[f'count_{gkey}']
+derived = [f'{stype}_perc_d1' for stype in ['es', 'ms', 'hs']] + [f'{key}_{gkey}' for gkey in grp_dict.keys() for key in ['perc_inperson_days_lost', 'attackrate', 'count']]
+df = df.merge(totals[derived].reset_index(), on=keys)
+
+byschool = pd.DataFrame({
+    'sid': schools['sid'],
+    'type': schools['type'],
+    'key1': schools['key1'],
+    'key2': schools['key2'],
+    'key3': schools['key3'],
+    'n_students': schools['num_students'],
+    'n': schools[[f'num_{grp}' for grp in groups]].sum(axis=1),
+    'd1 infectious': schools['d1 infectious'],
+    'd1 bool': schools['d1'],
+    'PCR': schools['n_tested_PCR'],
+    'Antigen': schools['n_tested_Antigen'],
+    'Days': (sc.readdate(last_date) - sc.readdate(first_date)).days,
+})
+byschool['Pop*Scale'] = schools[keys].merge(df[keys + ['pop_size', 'pop_scale']], on=keys, how='left').eval('pop_size*pop_scale').values
+df = df[['key1', 'key2', 'key3'] + [col for col in df.columns if col not in keys + ['pop_size', 'pop_scale']]]
 '''
-d = pd.DataFrame(byschool)
+d = byschool.copy()
 print( d.groupby('key2')[['PCR', 'Antigen']].mean() )
 tests = pd.DataFrame(tests, columns=['Scen', 'Testing', 'Tests'])
 col = {
@@ -311,7 +255,7 @@ plt.tight_layout()
 cv.savefig(os.path.join(imgdir, 'SchoolsWithFirstDayInfections_sensitivity.png'), dpi=300)
 
 # Infections on first day as function on school type and testing - regression
-d = pd.DataFrame(byschool)
+d = byschool.copy()
 d.replace( {'type': {'es':'Elementary', 'ms':'Middle', 'hs':'High'}}, inplace=True)
 d.replace( {'key2': {'PCR one week prior, 1d delay':'PCR one week prior', 'Daily PCR, no delay':'PCR one day prior'}}, inplace=True)
 g = sns.FacetGrid(data=d, row='key2', height=3, aspect=3.5, margin_titles=False, row_order=['None', 'PCR one week prior', 'PCR one day prior']) # row='type'
@@ -329,7 +273,7 @@ cv.savefig(os.path.join(imgdir, 'FirstDayInfectionsReg_sensitivity.png'), dpi=30
 
 # Tests required
 fig, ax = plt.subplots(figsize=(12,8))
-d = pd.DataFrame(byschool)
+d = byschool.copy()
 # Additional tests per 100,000 population
 print(d.groupby('type').sum())
 d['PCR'] *= 100000 / d['Days'] / d['Pop*Scale']
@@ -0,0 +1,96 @@
+'''
+Run the scenario x testing grid of run_scenarios.py, but simulate the days before
+schools open or testing starts only once per parameter set, then branch each
+scenario and testing combination from there (see covasim_schools.run_branches).
+With the default scenarios, the first test is on 2020-10-26, so 55 of the 153 days
+are shared. The branch day is found from the scenarios, so other sweeps, e.g.
+pcr_days_sweep.py, can use run_branched() as well.
+'''
+
+import os
+import covasim as cv
+import create_sim as cs
+import sciris as sc
+import synthpops as sp
+import covasim_schools as cvsch
+import testing_scenarios as t_s # From the local folder
+
+
+def make_scenario(base_scen, test, skip_screening=False):
+    ''' Add testing to a scenario, as in run_scenarios.py '''
+    this_scen = sc.dcp(base_scen)
+    for stype, spec in this_scen.items():
+        if spec is not None:
+            spec['testing'] = sc.dcp(test)
+            if skip_screening:
+                spec['screen_prob'] = 0
+    return this_scen
+
+
+def run_entry(entry, scenarios, testing, pop_size, folder, skip_screening=False, sink=None):
+    ''' Run every scenario and testing combination for one calibrated parameter set, as branches of one sim, writing each to the sink if supplied '''
+    par = sc.dcp(entry['pars'])
+    par['rand_seed'] = int(entry['index'])
+    base_sim = cs.create_sim(par, pop_size=pop_size, folder=folder)
+
+    managers = {}
+    keys = {}
+    for skey, base_scen in scenarios.items():
+        for tkey, test in testing.items():
+            label = f'{skey} + {tkey}'
+            managers[label] = cvsch.schools_manager(make_scenario(base_scen, test, skip_screening=skip_screening), batch_testing=True)
+            keys[label] = (skey, tkey, test)
+
+    sims = cvsch.run_branches(base_sim, managers)
+    for label, sim in sims.items():
+        sim.key1, sim.key2, sim.tscen = keys[label]
+        sim.scen = managers[label].scenario
+        sim.dynamic_par = par
+        if sink is not None:
+            sink.add(sim)
+    return list(sims.values())
+
+
+def run_branched(scenarios, testing, par_list, pop_size, folder, skip_screening=False, ncpus=32, sink=None):
+    '''
+    Run every combination of scenario, testing, and parameter set, in parallel over
+    the parameter sets. If a cvsch.ResultsSink is supplied, each sim's summary rows
+    are written to it as soon as its parameter set finishes.
+
+    Returns:
+        A MultiSim, with the sims in the same order as run_scenarios.py: by scenario, then testing, then parameter set
+    '''
+    results = sc.parallelize(run_entry, iterarg=par_list, ncpus=ncpus,
+                             kwargs=dict(scenarios=scenarios, testing=testing, pop_size=pop_size, folder=folder, skip_screening=skip_screening, sink=sink))
+    sims = []
+    for eidx, entry_sims in enumerate(results):
+        for sim in entry_sims:
+            sim.eidx = eidx
+            sims.append(sim)
+    order = {(skey, tkey):k for k,(skey, tkey) in enumerate((skey, tkey) for skey in scenarios for tkey in testing)}
+    sims = sorted(sims, key=lambda sim: (order[(sim.key1, sim.key2)], sim.eidx))
+    return cv.MultiSim(sims)
+
+
+if __name__ == '__main__':
+
+    cv.check_save_version('1.7.6', folder='gitinfo', comments={'SynthPops':sc.gitinfo(sp.__file__)})
+
+    par_inds = (0,10)
+    pop_size = 2.25e5
+    skip_screening = True
+
+    folder = 'v20201019'
+    stem = f'final_20201026_v2_noscreening_branched_{par_inds[0]}-{par_inds[1]}'
+    calibfile = os.path.join(folder, 'pars_cases_begin=75_cases_end=75_re=1.0_prevalence=0.002_yield=0.024_tests=225_pop_size=225000.json')
+
+    scenarios = t_s.generate_scenarios()
+    testing = t_s.generate_testing()
+    par_list = sc.loadjson(calibfile)[par_inds[0]:par_inds[1]]
+
+    from calibrate_model import evaluate_sim # Needs Optuna
+    sink = cvsch.ResultsSink(os.path.join(folder, 'results', stem), metrics=evaluate_sim, days={'d1':'2020-11-02'})
+    msim = run_branched(scenarios, testing, par_list, pop_size=pop_size, folder=folder, skip_screening=skip_screening, sink=sink)
+    fn = os.path.join(folder, 'msims', f'{stem}.msim')
+    print(f'Saving to {fn}')
+    cv.save(fn, msim)
@@ -0,0 +1,230 @@
+'''
+Resumable version of run_scenarios.py. Each cell of the grid -- one scenario,
+testing, sensitivity, and calibrated parameter set -- is saved to its own file as
+soon as it finishes, and recorded in a manifest. Running the script again only runs
+the cells that are missing from the manifest or whose inputs have changed, so a
+crash loses only the cells that were running, and adding an entry to
+generate_testing() only runs the new cells.
+
+Each cell is identified by its keys, e.g. "baseline | as_normal | PCR every 1w | 3",
+and fingerprinted by a hash of everything that determines its result: the scenario,
+testing, parameters, seed, population size, create_sim() options, and the source of
+the function that adds the interventions. The manifest, manifest.json in the output
+folder, maps each cell to its fingerprint and file. Files are named by the key as
+well as the fingerprint, so cells with the same inputs have separate files.
+'''
+
+import os
+import json
+import inspect
+import hashlib
+import concurrent.futures as cf
+import covasim as cv
+import sciris as sc
+import synthpops as sp
+import covasim_schools as cvsch
+import create_sim as cs
+import testing_scenarios as t_s # From the local folder
+
+
+def add_schools(sim, scen, test):
+    ''' Default builder: add testing to the scenario, and the scenario to the sim '''
+    for stype, spec in scen.items():
+        if spec is not None:
+            spec['testing'] = test
+    sim['interventions'] += [cvsch.schools_manager(scen, batch_testing=True)]
+    return
+
+
+def make_cells(scenarios, testing, par_list, sensitivity=None, pop_size=2.25e5, sim_kwargs=None):
+    '''
+    Make the list of cells in the grid.
+
+    Args:
+        scenarios (dict): scenario key to scenario, as from generate_scenarios()
+        testing (dict): testing key to testing, as from generate_testing()
+        par_list (list): calibrated parameter entries, each with "pars" and "index" (the seed)
+        sensitivity (dict): sensitivity key to a builder function, as in sensitivity_scenarios.py, or to a dict with the builder and create_sim() options (default: {'baseline':add_schools})
+        pop_size (int): number of people
+        sim_kwargs (dict): passed to create_sim(), e.g. the folder
+
+    Returns:
+        A list of cells, each a dict
+    '''
+    if sensitivity is None:
+        sensitivity = {'baseline':add_schools}
+    cells = []
+    for senskey, sens in sensitivity.items():
+        if callable(sens):
+            sens = dict(builder=sens)
+        for skey, scen in scenarios.items():
+            for tkey, test in testing.items():
+                for eidx, entry in enumerate(sens.get('par_list', par_list)):
+                    cells.append(dict(
+                        key        = f'{senskey} | {skey} | {tkey} | {entry["index"]}',
+                        senskey    = senskey,
+                        skey       = skey,
+                        tkey       = tkey,
+                        eidx       = eidx,
+                        entry      = entry,
+                        scen       = scen,
+                        test       = test,
+                        builder    = sens['builder'],
+                        pop_size   = pop_size,
+                        sim_kwargs = sc.mergedicts(sim_kwargs, sens.get('sim_kwargs')),
+                    ))
+    return cells
+
+
+def fingerprint(cell):
+    ''' Hash of everything that determines the result of a cell '''
+    try:
+        builder = inspect.getsource(cell['builder'])
+    except (OSError, TypeError):
+        builder = cell['builder'].__qualname__
+    inputs = {key:cell[key] for key in ['scen', 'test', 'entry', 'pop_size', 'sim_kwargs']}
+    inputs['builder'] = builder
+    inputs['version'] = [cv.__version__, cvsch.__version__]
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def cell_file(cell):
+    ''' File of a cell's sim, relative to the folder; named by its key as well as its fingerprint, since the saved sim records its keys '''
+    text = f'{cell["key"]}\n{fingerprint(cell)}'
+    return os.path.join('cells', f'{hashlib.sha1(text.encode()).hexdigest()}.sim')
+
+
+def run_cell(cell, folder, sink=None):
+    ''' Run one cell and save the sim, and its rows to the sink if supplied; returns the filename, relative to the folder '''
+    par = sc.dcp(cell['entry']['pars'])
+    par['rand_seed'] = int(cell['entry']['index'])
+    sim = cs.create_sim(par, pop_size=cell['pop_size'], **cell['sim_kwargs'])
+    sim.label = f'{cell["skey"]} + {cell["tkey"]}'
+    sim.key1 = cell['skey']
+    sim.key2 = cell['tkey']
+    sim.key3 = cell['senskey']
+    sim.eidx = cell['eidx']
+    sim.scen = cell['scen']
+    sim.tscen = cell['test']
+    sim.dynamic_par = par
+    cell['builder'](sim, sc.dcp(cell['scen']), sc.dcp(cell['test']))
+    sim.run()
+    if sink is not None:
+        sink.add(sim)
+    sim.shrink(in_place=True)
+
+    filename = cell_file(cell)
+    tmpfile = os.path.join(folder, filename + '.tmp')
+    cv.save(tmpfile, sim)
+    os.replace(tmpfile, os.path.join(folder, filename)) # So a file only exists once it is complete
+    return filename
+
+
+def load_manifest(folder):
+    ''' The manifest of completed cells, as a dict of cell key to fingerprint and file '''
+    path = os.path.join(folder, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(folder, manifest):
+    ''' Save the manifest, replacing the previous one in a single step '''
+    path = os.path.join(folder, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return
+
+
+def pending_cells(cells, folder):
+    ''' The cells that are not in the manifest, have changed, or whose file is missing '''
+    manifest = load_manifest(folder)
+    pending = []
+    for cell in cells:
+        done = manifest.get(cell['key'])
+        if done is None or done['fingerprint'] != fingerprint(cell) or not os.path.exists(os.path.join(folder, done['file'])):
+            pending.append(cell)
+    return pending
+
+
+def run_grid(cells, folder, ncpus=32, sink=None):
+    '''
+    Run the cells that are not yet done, in parallel, recording each in the manifest
+    as soon as it finishes. A cell that fails is reported and left pending. If a
+    cvsch.ResultsSink is supplied, each sim's summary rows are written to it as well.
+
+    Returns:
+        The keys of the cells that failed
+    '''
+    os.makedirs(os.path.join(folder, 'cells'), exist_ok=True)
+    pending = pending_cells(cells, folder)
+    print(f'{len(cells)-len(pending)} of {len(cells)} cells already done, running {len(pending)}')
+    manifest = load_manifest(folder)
+    failed = []
+    if not pending:
+        return failed
+
+    with cf.ProcessPoolExecutor(max_workers=ncpus) as executor:
+        futures = {executor.submit(run_cell, cell, folder, sink):cell for cell in pending}
+        for k, future in enumerate(cf.as_completed(futures)):
+            cell = futures[future]
+            try:
+                filename = future.result()
+            except Exception as E:
+                print(f'Cell "{cell["key"]}" failed: {E}')
+                failed.append(cell['key'])
+                continue
+            old = manifest.get(cell['key'])
+            manifest[cell['key']] = dict(fingerprint=fingerprint(cell), file=filename)
+            if old is not None and old['file'] not in [done['file'] for done in manifest.values()] and os.path.exists(os.path.join(folder, old['file'])):
+                os.remove(os.path.join(folder, old['file'])) # Result for an earlier version of this cell, which no other cell uses
+            save_manifest(folder, manifest)
+            print(f'Finished cell {k+1} of {len(pending)}: {cell["key"]}')
+
+    return failed
+
+
+def load_grid(cells, folder):
+    ''' Load the sims of the given cells, which must all be done, as a MultiSim '''
+    pending = pending_cells(cells, folder)
+    if pending:
+        raise RuntimeError(f'{len(pending)} of {len(cells)} cells have not been run, e.g. "{pending[0]["key"]}"')
+    manifest = load_manifest(folder)
+    sims = [cv.load(os.path.join(folder, manifest[cell['key']]['file'])) for cell in cells]
+    return cv.MultiSim(sims)
+
+
+if __name__ == '__main__':
+
+    cv.check_save_version('1.7.6', folder='gitinfo', comments={'SynthPops':sc.gitinfo(sp.__file__)})
+
+    par_inds = (0,10)
+    pop_size = 2.25e5
+    skip_screening = True
+
+    folder = 'v20201019'
+    stem = f'final_20201026_v2_noscreening_{par_inds[0]}-{par_inds[1]}'
+    outfolder = os.path.join(folder, 'grid', stem)
+    calibfile = os.path.join(folder, 'pars_cases_begin=75_cases_end=75_re=1.0_prevalence=0.002_yield=0.024_tests=225_pop_size=225000.json')
+
+    scenarios = t_s.generate_scenarios()
+    if skip_screening:
+        for scen in scenarios.values():
+            for spec in scen.values():
+                if spec is not None:
+                    spec['screen_prob'] = 0
+    testing = t_s.generate_testing()
+    par_list = sc.loadjson(calibfile)[par_inds[0]:par_inds[1]]
+
+    cells = make_cells(scenarios, testing, par_list, pop_size=pop_size, sim_kwargs=dict(folder=folder))
+    from calibrate_model import evaluate_sim # Needs Optuna
+    sink = cvsch.ResultsSink(os.path.join(outfolder, 'results'), metrics=evaluate_sim, days={'d1':'2020-11-02'})
+    failed = run_grid(cells, outfolder, sink=sink)
+    if not failed:
+        msim = load_grid(cells, outfolder)
+        fn = os.path.join(folder, 'msims', f'{stem}.msim')
+        print(f'Saving to {fn}')
+        cv.save(fn, msim)
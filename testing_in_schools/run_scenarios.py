@@ -16,7 +16,7 @@ cv.check_save_version('1.7.6', folder='gitinfo', comments={'SynthPops':sc.gitinf
 
 par_inds = (0,10)
 pop_size = 2.25e5
-batch_size = 24
+ncpus = 32 # At most; fewer if memory runs short
 save_after_each_scenario = True
 
 skip_screening = True
@@ -35,56 +35,58 @@ testing = t_s.generate_testing()
 # Now ignoring pars_v1 an pars_v2, using calibrated values instead:
 par_list = sc.loadjson(calibfile)[par_inds[0]:par_inds[1]]
 
-sims = []
-msims = []
 tot = len(scenarios) * len(testing) * len(par_list)
-proc = 0
-
-for skey, base_scen in scenarios.items():
-    for tidx, (tkey, test) in enumerate(testing.items()):
-        for eidx, entry in enumerate(par_list):
-            par = sc.dcp(entry['pars'])
-            par['rand_seed'] = int(entry['index'])
-            sim = cs.create_sim(par, pop_size=pop_size, folder=folder)
-
-            # Modify base_scen with testing intervention
-            this_scen = sc.dcp(base_scen)
-            for stype, spec in this_scen.items():
-                if spec is not None:
-                    spec['testing'] = sc.dcp(test) # dcp probably not needed because deep copied in new_schools
-                    if skip_screening:
-                        print('WARNING: Seeting screen_prob to 0')
-                        spec['screen_prob'] = 0
-
-            sim.label = f'{skey} + {tkey}'
-            sim.key1 = skey
-            sim.key2 = tkey
-            sim.eidx = eidx
-            sim.tscen = test
-            sim.scen = this_scen # After modification with testing above
-            sim.dynamic_par = par
-
-            sm = cvsch.schools_manager(this_scen)
-            sim['interventions'] += [sm]
-            sims.append(sim)
-            proc += 1
-
-            condition = len(sims) == batch_size or proc == tot
-            if save_after_each_scenario:
-                condition = condition or (tidx == len(testing)-1 and eidx == len(par_list)-1)
-            if condition:
-                print(f'Running sims {proc-len(sims)}-{proc-1} of {tot}')
-                msim = cv.MultiSim(sims)
-                msim.run(reseed=False, par_args={'ncpus': 32}, noise=0.0, keep_people=False)
-                msims.append(msim)
-                sims = []
-    if save_after_each_scenario:
-        print(f'*** Saving after completing {skey}')
-        sims_this_scenario = [s for msim in msims for s in msim.sims if s.key1 == skey]
+counts = {skey:0 for skey in scenarios}
+finished = []
+
+from calibrate_model import evaluate_sim # Needs Optuna
+sink = cvsch.ResultsSink(os.path.join(folder, 'results', stem), metrics=evaluate_sim, days={'d1':'2020-11-02'}) # Summary rows for the plotting scripts
+
+def make_sims():
+    ''' Create each sim only when there is a worker and memory free to run it '''
+    for skey, base_scen in scenarios.items():
+        for tidx, (tkey, test) in enumerate(testing.items()):
+            for eidx, entry in enumerate(par_list):
+                par = sc.dcp(entry['pars'])
+                par['rand_seed'] = int(entry['index'])
+                sim = cs.create_sim(par, pop_size=pop_size, folder=folder)
+
+                # Modify base_scen with testing intervention
+                this_scen = sc.dcp(base_scen)
+                for stype, spec in this_scen.items():
+                    if spec is not None:
+                        spec['testing'] = sc.dcp(test) # dcp probably not needed because deep copied in new_schools
+                        if skip_screening:
+                            print('WARNING: Seeting screen_prob to 0')
+                            spec['screen_prob'] = 0
+
+                sim.label = f'{skey} + {tkey}'
+                sim.key1 = skey
+                sim.key2 = tkey
+                sim.eidx = eidx
+                sim.tscen = test
+                sim.scen = this_scen # After modification with testing above
+                sim.dynamic_par = par
+
+                sm = cvsch.schools_manager(this_scen, batch_testing=True)
+                sim['interventions'] += [sm]
+                yield sim
+
+def save_scenario(sim):
+    ''' Write the summary rows of each sim, and save the sims of a scenario once all of them have finished '''
+    sink.add(sim)
+    finished.append(sim)
+    print(f'Finished {len(finished)} of {tot} sims')
+    counts[sim.key1] += 1
+    if save_after_each_scenario and counts[sim.key1] == len(testing)*len(par_list):
+        print(f'*** Saving after completing {sim.key1}')
+        sims_this_scenario = [s for s in finished if s.key1 == sim.key1]
         msim = cv.MultiSim(sims_this_scenario)
-        cv.save(os.path.join(folder, 'msims', f'{stem}_{skey}.msim'), msim)
+        cv.save(os.path.join(folder, 'msims', f'{stem}_{sim.key1}.msim'), msim)
+
+sims = cvsch.run_sims(make_sims(), ncpus=ncpus, callback=save_scenario) # Runs as many at once as memory allows
 
-msim = cv.MultiSim.merge(msims)
+msim = cv.MultiSim(sims)
 fn = os.path.join(folder, 'msims', f'{stem}.msim')
 print(f'Saving to {fn}')
 cv.save(fn, msim)
@@ -17,7 +17,7 @@ cv.check_save_version('1.7.6', folder='gitinfo', comments={'SynthPops':sc.gitinf
 
 par_inds = (10,20)
 pop_size = 2.25e5 # 1e5 2.25e4 2.25e5
-batch_size = 24
+ncpus = 32 # At most; fewer if memory runs short
 
 folder = 'v20201019'
 stem = f'sensitivity_v3_{par_inds[0]}-{par_inds[1]}'
@@ -33,7 +33,7 @@ def baseline(sim, scen, test):
         if spec is not None:
             spec['testing'] = test # dcp probably not needed because deep copied in new_schools
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def alt_symp(sim, scen, test):
@@ -56,7 +56,7 @@ def alt_symp(sim, scen, test):
     prog['symp_probs'] = symp_probs
     '''
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def children_equally_sus(sim, scen, test):
@@ -75,7 +75,7 @@ def children_equally_sus(sim, scen, test):
     sim.pars['prognoses'] = prog
     '''
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def lower_sens_spec(sim, scen, test):
@@ -91,7 +91,7 @@ def lower_sens_spec(sim, scen, test):
         if spec is not None:
             spec['testing'] = test # dcp probably not needed because deep copied in new_schools
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def no_NPI_reduction(sim, scen, test):
@@ -102,7 +102,7 @@ def no_NPI_reduction(sim, scen, test):
             if spec['beta_s'] > 0:
                 spec['beta_s'] = 1.5 # Restore to pre-NPI level
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def lower_random_screening(sim, scen, test):
@@ -112,7 +112,7 @@ def lower_random_screening(sim, scen, test):
             spec['testing'] = test # dcp probably not needed because deep copied in new_schools
             spec['screen_prob'] = 0.5
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def no_screening(sim, scen, test):
@@ -122,7 +122,7 @@ def no_screening(sim, scen, test):
             spec['testing'] = test # dcp probably not needed because deep copied in new_schools
             spec['screen_prob'] = 0
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def lower_coverage(sim, scen, test):
@@ -134,7 +134,7 @@ def lower_coverage(sim, scen, test):
         if spec is not None:
             spec['testing'] = test # dcp probably not needed because deep copied in new_schools
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 def increased_mobility(sim, scen, test):
@@ -143,7 +143,7 @@ def increased_mobility(sim, scen, test):
         if spec is not None:
             spec['testing'] = test # dcp probably not needed because deep copied in new_schools
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
     # Different random path if ce not placed in the right order
@@ -210,7 +210,7 @@ def broken_bubbles(sim, scen, test):
     all_school_contacts = pd.concat(school_contacts)
     sim.people.contacts['s'] = cv.Layer().from_df(all_school_contacts)
 
-    sm = cvsch.schools_manager(scen)
+    sm = cvsch.schools_manager(scen, batch_testing=True)
     sim['interventions'] += [sm]
 
 
@@ -280,62 +280,66 @@ if __name__ == '__main__':
     par_list_ch_eq_sus = sc.loadjson(calibfile_ch_eq_sus)[par_inds[0]:par_inds[1]]
     par_list_alt_symp = sc.loadjson(calibfile_alt_symp)[par_inds[0]:par_inds[1]]
 
-    sims = []
-    msims = []
-    tot = len(scenarios) * len(testing) * len(par_list) * len(sensitivity)
-    proc = 0
-
-    # Save time by pre-generating the base simulations
-
-    for senskey, builder in sensitivity.items():
-        ch_eq_sus = False
-        alt_symp = False
+    # Parameters and create_sim() options for each sensitivity
+    options = {}
+    for senskey in sensitivity:
         if senskey == 'children_equally_sus':
-            plist = par_list_ch_eq_sus
-            ch_eq_sus = True
+            options[senskey] = dict(plist=par_list_ch_eq_sus, ch_eq_sus=True, alt_symp=False)
         elif senskey == 'alt_symp':
-            plist = par_list_alt_symp
-            alt_symp = True
+            options[senskey] = dict(plist=par_list_alt_symp, ch_eq_sus=False, alt_symp=True)
         else:
-            plist = par_list
-
-        for eidx, entry in enumerate(plist):
-            par = sc.dcp(entry['pars'])
-            par['rand_seed'] = int(entry['index'])
-            base_sim = cs.create_sim(par, pop_size=pop_size, folder=folder, children_equally_sus=ch_eq_sus, alternate_symptomaticity=alt_symp)
-
-            for sidx, (skey, scen) in enumerate(scenarios.items()):
-                for tidx, (tkey, test) in enumerate(testing.items()):
-                    sim = base_sim.copy()
-
-                    sim.label = f'{skey} + {tkey}'
-                    sim.key1 = skey
-                    sim.key2 = tkey
-                    sim.key3 = senskey
-                    sim.eidx = eidx
-                    sim.scen = scen
-                    sim.tscen = test
-                    sim.dynamic_par = par
-
-                    # Call the function to build the sensitivity analysis
-                    builder(sim, sc.dcp(scen), sc.dcp(test))
-
-                    sims.append(sim)
-                    proc += 1
-
-                    if len(sims) == batch_size or proc == tot or (tidx == len(testing)-1 and sidx == len(scenarios)-1 and eidx == len(par_list)-1):
-                        print(f'Running sims {proc-len(sims)}-{proc-1} of {tot}')
-                        msim = cv.MultiSim(sims)
-                        msims.append(msim)
-                        msim.run(reseed=False, par_args={'ncpus': 32}, noise=0.0, keep_people=False)
-                        sims = []
-
-        fn = os.path.join(folder, 'msims', f'{stem}_{senskey}.msim')
-        print(f'*** Saving to {fn} after completing {senskey}')
-        sims_this_scenario = [s for msim in msims for s in msim.sims if s.key3 == senskey]
-        msim = cv.MultiSim(sims_this_scenario)
-        cv.save(fn, msim)
-
-    msim = cv.MultiSim.merge(msims)
+            options[senskey] = dict(plist=par_list, ch_eq_sus=False, alt_symp=False)
+
+    expected = {senskey:len(scenarios)*len(testing)*len(opts['plist']) for senskey,opts in options.items()} # Number of sims of each sensitivity
+    tot = sum(expected.values())
+    counts = {senskey:0 for senskey in sensitivity}
+    finished = []
+
+    from calibrate_model import evaluate_sim # Needs Optuna
+    sink = cvsch.ResultsSink(os.path.join(folder, 'results', stem), metrics=evaluate_sim, days={'d1':'2020-11-02'}) # Summary rows for the plotting scripts
+
+    def make_sims():
+        ''' Create each sim only when there is a worker and memory free to run it '''
+        for senskey, builder in sensitivity.items():
+            opts = options[senskey]
+            for eidx, entry in enumerate(opts['plist']):
+                par = sc.dcp(entry['pars'])
+                par['rand_seed'] = int(entry['index'])
+                # Save time by generating the base simulation once per parameter set
+                base_sim = cs.create_sim(par, pop_size=pop_size, folder=folder, children_equally_sus=opts['ch_eq_sus'], alternate_symptomaticity=opts['alt_symp'])
+
+                for sidx, (skey, scen) in enumerate(scenarios.items()):
+                    for tidx, (tkey, test) in enumerate(testing.items()):
+                        sim = base_sim.copy()
+
+                        sim.label = f'{skey} + {tkey}'
+                        sim.key1 = skey
+                        sim.key2 = tkey
+                        sim.key3 = senskey
+                        sim.eidx = eidx
+                        sim.scen = scen
+                        sim.tscen = test
+                        sim.dynamic_par = par
+
+                        # Call the function to build the sensitivity analysis
+                        builder(sim, sc.dcp(scen), sc.dcp(test))
+                        yield sim
+
+    def save_sensitivity(sim):
+        ''' Write the summary rows of each sim, and save the sims of a sensitivity once all of them have finished '''
+        sink.add(sim)
+        finished.append(sim)
+        print(f'Finished {len(finished)} of {tot} sims')
+        counts[sim.key3] += 1
+        if counts[sim.key3] == expected[sim.key3]:
+            fn = os.path.join(folder, 'msims', f'{stem}_{sim.key3}.msim')
+            print(f'*** Saving to {fn} after completing {sim.key3}')
+            sims_this_scenario = [s for s in finished if s.key3 == sim.key3]
+            msim = cv.MultiSim(sims_this_scenario)
+            cv.save(fn, msim)
+
+    sims = cvsch.run_sims(make_sims(), ncpus=ncpus, callback=save_sensitivity) # Runs as many at once as memory allows
+
+    msim = cv.MultiSim(sims)
     msim.base_sim = [] # Save disk space
     cv.save(os.path.join(folder, 'msims', f'{stem}.msim'), msim)
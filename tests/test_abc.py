@@ -0,0 +1,52 @@
+'''
+Check that the ABC-SMC sampler narrows in on the parameters that fit, and writes the calibration JSON layout
+'''
+
+import numpy as np
+from testing_in_schools import create_sim as cs
+from testing_in_schools import calibrate_abc as ca
+
+truth = dict(pop_infected=150, change_beta=0.7, symp_prob=0.2)
+
+
+def toy_simulate(pars, index):
+    ''' Cheap stand-in for a sim: the relative distance from the true parameters, plus noise set by the seed '''
+    noise = np.random.default_rng(index).normal(0, 0.01)
+    mismatch = np.mean([abs(pars[key] - true)/true for key,true in truth.items()]) + abs(noise)
+    return {'mismatch':mismatch}
+
+
+def test_abc():
+    ''' Tolerances shrink, the posterior moves towards the truth, and the output matches pars_*.json '''
+    abc = ca.ABCSMC(n_particles=30, n_generations=4, alpha=0.5, ncpus=2, batch_size=10, simulate=toy_simulate, rand_seed=1)
+    final = abc.run(verbose=False)
+
+    eps = [gen.eps for gen in abc.generations]
+    assert len(abc.generations) >= 3
+    assert eps[0] == np.inf and all(np.diff(eps[1:]) < 0)
+    assert np.isclose(final.weights.sum(), 1) and len(final.thetas) == 30
+    assert (final.mismatches <= final.eps).all()
+    assert np.average(final.mismatches, weights=final.weights) < np.mean(abc.generations[0].mismatches)/2
+
+    # The same layout as the calibration file, with each sim's seed as its index
+    json = abc.to_json()
+    assert len(json) == 30 and len({entry['index'] for entry in json[:10]}) == 10 # The first N entries give N different sims
+    assert len({entry['index'] for entry in json}) == 30
+    assert {entry['particle'] for entry in json} <= set(final.indices.astype(float))
+    assert abc.to_json() == json # The resample is seeded, so it doesn't change between calls
+    assert list(json[0]['pars'].keys()) == list(cs.define_pars(which='best').keys())
+    for entry in json:
+        assert np.isclose(toy_simulate(entry['pars'], int(entry['particle']))['mismatch'], entry['mismatch'])
+        assert entry['index'] == entry['particle'] or entry['index'] >= abc.n_sims # A repeated particle gets a seed no sim has used
+
+    # Each particle appears in proportion to its weight
+    counts = np.array([sum(entry['particle'] == index for entry in json) for index in final.indices])
+    assert (np.abs(counts - 30*final.weights) < 1).all()
+    ranked = abc.to_json(order='mismatch')
+    assert [entry['mismatch'] for entry in ranked] == sorted(final.mismatches.tolist())
+
+    return
+
+
+if __name__ == '__main__':
+    test_abc()
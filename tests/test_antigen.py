@@ -0,0 +1,97 @@
+'''
+Check the antigen test kernel against an implementation from set operations, and benchmark it
+'''
+
+import numpy as np
+import sciris as sc
+import covasim as cv
+import covasim_schools as cvsch
+
+
+def make_sim(pop_size=20e3):
+    ''' Make a sim with plenty of infectious, symptomatic, and diagnosed people '''
+    sim = cv.Sim(pop_size=pop_size, pop_infected=pop_size/10, pop_type='random', n_days=30, rand_seed=1, verbose=0,
+                 interventions=cv.test_prob(symp_prob=0.2))
+    sim.run(until=20)
+    return sim
+
+
+def antigen_test_by_sets(inds, sym7d_sens=1.0, other_sens=1.0, specificity=1, loss_prob=0.0, sim=None):
+    ''' Antigen test built from set operations on the uids, with separate draws for each group '''
+
+    ppl = sim.people
+    t = sim.t
+
+    inds = np.unique(inds)
+    is_infectious_not_dx = cv.itruei(ppl.infectious * ~ppl.diagnosed, inds)
+    symp = cv.itruei(ppl.symptomatic, is_infectious_not_dx)
+    recently_symp_inds = symp[t-ppl.date_symptomatic[symp] < 7]
+
+    other_inds = np.setdiff1d(is_infectious_not_dx, recently_symp_inds)
+
+    is_inf_pos = np.concatenate((
+        cv.binomial_filter(sym7d_sens, recently_symp_inds), # Higher sensitivity for <7 days
+        cv.binomial_filter(other_sens, other_inds)          # Lower sensitivity of otheres
+    ))
+
+    not_lost           = cv.n_binomial(1.0-loss_prob, len(is_inf_pos))
+    true_positive_uids = is_inf_pos[not_lost]
+
+    # False positivies
+    if specificity < 1:
+        non_infectious_uids = np.setdiff1d(inds, is_infectious_not_dx)
+        false_positive_uids = cv.binomial_filter(1-specificity, non_infectious_uids)
+    else:
+        false_positive_uids = np.empty(0, dtype=np.int64)
+
+    return np.concatenate((true_positive_uids, false_positive_uids))
+
+
+def test_antigen_test():
+    ''' The kernel gives the same positives when results are certain, and the same rates otherwise '''
+
+    sim = make_sim()
+    np.random.seed(1)
+    inds = np.random.choice(len(sim.people), size=5000, replace=False)
+    assert sim.people.diagnosed[inds].any() and (sim.people.infectious[inds] & sim.people.symptomatic[inds]).any()
+
+    # Perfect and useless tests have no randomness
+    for pars in [dict(), dict(sym7d_sens=0, other_sens=0, specificity=0)]:
+        new = cvsch.antigen_test(inds, sim=sim, **pars)
+        expected = antigen_test_by_sets(inds, sim=sim, **pars)
+        assert np.array_equal(new, np.sort(expected))
+
+    # Otherwise compare the mean number of positives over repeated tests
+    pars = dict(sym7d_sens=0.9, other_sens=0.6, specificity=0.9, loss_prob=0.1)
+    n_reps = 200
+    counts = {}
+    for label, func in [['new', cvsch.antigen_test], ['sets', antigen_test_by_sets]]:
+        counts[label] = np.array([len(func(inds, sim=sim, **pars)) for r in range(n_reps)])
+    diff = counts['new'].mean() - counts['sets'].mean()
+    se = np.sqrt((counts['new'].var() + counts['sets'].var())/n_reps)
+    assert abs(diff) < 4*se, f'Mean positives differ by {diff:0.1f} (SE {se:0.1f})'
+
+    return
+
+
+def benchmark_antigen(sizes=(1e3, 1e4, 1e5), n_reps=20):
+    ''' Time the kernel against the implementation from set operations '''
+
+    sim = make_sim(pop_size=2*max(sizes))
+    pars = dict(sym7d_sens=0.9, other_sens=0.6, specificity=0.9, loss_prob=0.1)
+    for size in sizes:
+        inds = np.random.choice(len(sim.people), size=int(size), replace=False)
+        timings = {}
+        for label, func in [['new', cvsch.antigen_test], ['sets', antigen_test_by_sets]]:
+            T = sc.tic()
+            for r in range(n_reps):
+                func(inds, sim=sim, **pars)
+            timings[label] = sc.toc(T, output=True)/n_reps
+        print(f'{int(size):>7} testees: new {timings["new"]*1e3:0.2f} ms, sets {timings["sets"]*1e3:0.2f} ms ({timings["sets"]/timings["new"]:0.1f}x)')
+
+    return timings
+
+
+if __name__ == '__main__':
+    test_antigen_test()
+    timings = benchmark_antigen()
@@ -0,0 +1,100 @@
+'''
+Check that branching scenarios from a shared prefix matches running each scenario from the start
+'''
+
+import pytest
+import numpy as np
+import sciris as sc
+import covasim as cv
+import covasim_schools as cvsch
+from testing_in_schools import create_sim as cs
+from testing_in_schools.testing_scenarios import generate_scenarios, generate_testing
+
+pop_size = 10e3
+params = dict(rand_seed=1, pop_infected=100, change_beta=1.0)
+
+
+def make_scenario(scen_key, test_key):
+    ''' A scenario with the given testing '''
+    scen = generate_scenarios()[scen_key]
+    for spec in scen.values():
+        if spec is not None:
+            spec['testing'] = generate_testing()[test_key]
+    return scen
+
+
+def test_divergence_day():
+    ''' The divergence day is the first school opening or test in any scenario '''
+
+    sim = cv.Sim(pop_size=100, start_day='2020-09-01', end_day='2021-01-31', verbose=0)
+    sim.initialize()
+    normal = make_scenario('as_normal', 'None')
+    tested = make_scenario('as_normal', 'PCR every 1w') # First test on 2020-10-26
+    assert cvsch.divergence_day(sim, [normal]) == sim.day('2020-11-02')
+    assert cvsch.divergence_day(sim, [normal, tested]) == sim.day('2020-10-26')
+
+    late = sc.dcp(normal)
+    for spec in late.values():
+        if spec is not None:
+            spec['start_day'] = '2022-01-01' # Never opens during the sim
+    assert cvsch.divergence_day(sim, [late]) == sim.npts
+
+    return
+
+
+def test_branches():
+    ''' Branches share the prefix exactly, catch up on absences, and give complete results '''
+
+    people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+    scens = {'countermeasures':make_scenario('with_countermeasures', 'Antigen every 1w, PCR f/u'), 'hybrid':make_scenario('all_hybrid', 'PCR every 1w')}
+    base_sim = cs.create_sim(sc.dcp(params), pop_size=pop_size, load_pop=False, people=people)
+    day = cvsch.divergence_day(base_sim, scens.values())
+
+    # Run each scenario from the start up to the divergence day, to compare against
+    unbranched = {}
+    for engine in ['schools', 'system']:
+        sim = sc.dcp(base_sim)
+        sim['interventions'] += [cvsch.schools_manager(scens['countermeasures'], engine=engine)]
+        sim.run(until=day)
+        unbranched[engine] = sim
+
+    # A manager added at the divergence day sends home the same people as one that ran from the start
+    prefix = sc.dcp(base_sim)
+    prefix['interventions'] += [cvsch.close_schools()]
+    prefix.run(until=day)
+    for engine, sim in unbranched.items():
+        assert np.array_equal(prefix.results['new_infections'][:day], sim.results['new_infections'][:day])
+        branch = sc.dcp(prefix)
+        branch['interventions'][-1].release(branch)
+        manager = cvsch.schools_manager(scens['countermeasures'], engine=engine)
+        manager.initialize(branch)
+        expected = sim['interventions'][-1]
+        if engine == 'schools':
+            for school, expected_school in zip(manager.schools, expected.schools):
+                assert np.array_equal(school.absences.release_day, expected_school.absences.release_day)
+        else:
+            assert np.array_equal(manager.system.release_day, expected.system.release_day)
+            assert (manager.system.release_day >= day).any() # Some people are still at home when schools open
+
+    # Full branched runs
+    sims = cvsch.run_branches(base_sim, {label:cvsch.schools_manager(scen) for label,scen in scens.items()})
+    assert list(sims.keys()) == list(scens.keys())
+    for label, sim in sims.items():
+        assert sim.complete and sim.label == label
+        assert np.array_equal(sim.results['new_infections'][:day], unbranched['schools'].results['new_infections'][:day])
+        assert sim.school_results.n_school_days > 0
+        assert sim.school_stats.get('in_person')[:,:day].sum() == 0 # Schools are closed before the divergence day
+    assert sims['countermeasures'].school_results.n_tested.Antigen > 0
+    assert sims['hybrid'].school_results.n_tested.PCR > 0
+    assert len(base_sim['interventions']) == 4 # The base sim is unchanged
+
+    # Branching after the divergence day would skip the tests due before it
+    with pytest.raises(ValueError):
+        cvsch.run_branches(base_sim, {label:cvsch.schools_manager(scen) for label,scen in scens.items()}, day=day+1)
+
+    return
+
+
+if __name__ == '__main__':
+    test_divergence_day()
+    test_branches()
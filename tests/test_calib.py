@@ -6,11 +6,15 @@ NB: skipped by default since the full population files etc. won't exist on GitHu
 '''
 
 import os
+import tempfile
+import numpy as np
+import optuna as op
 import sciris as sc
 import covasim as cv
 import covasim_schools as cvsch
 from testing_in_schools import create_sim as cs
 from testing_in_schools.testing_scenarios import generate_scenarios, generate_testing
+from testing_in_schools import calibrate_model as cm
 from testing_in_schools.calibrate_model import evaluate_sim
 import pytest
 
@@ -57,6 +61,184 @@ def test_calib():
     return sim
 
 
+def make_remote_sim(pop_size=5e3):
+    ''' A small sim with schools remote, as in calibration '''
+    remote = generate_scenarios()['all_remote']['es']
+    sim = cs.create_sim(dict(rand_seed=1, pop_infected=100), pop_size=pop_size, load_pop=False)
+    sim['interventions'] += [cvsch.schools_manager(cm.scenario(es=remote, ms=remote, hs=remote), stats_level='none')]
+    return sim
+
+
+def test_partial_mismatch():
+    ''' On the last day, the partial mismatch matches evaluate_sim() for the targets it covers, and a rejected trial stops the sim '''
+
+    partial = {}
+    def record(sim):
+        if sim.t == sim.day('2021-01-31'):
+            partial['mismatch'] = cm.partial_mismatch(sim)
+        elif sim.t < sim.day('2020-11-02'):
+            assert cm.partial_mismatch(sim) is None
+
+    sim = make_remote_sim()
+    sim['interventions'] += [record]
+    sim.run()
+    ret = evaluate_sim(sim)
+    expected = cm.compute_mismatch({key:ret[key] for key in ['cases_begin', 'prevalence', 'yield', 'tests']})
+    assert np.isclose(partial['mismatch'], expected)
+
+    # A pruner that rejects every trial stops the sim on the first checkpoint
+    study = op.create_study(pruner=op.pruners.ThresholdPruner(upper=0))
+    trial = study.ask()
+    sim = make_remote_sim()
+    sim['interventions'] += [cm.prune_trial(trial, cm.checkpoints)]
+    try:
+        sim.run()
+        raise AssertionError('Trial was not pruned')
+    except op.TrialPruned:
+        pass
+    assert sim.t == sim.day(cm.checkpoints[0])
+    assert list(study.trials[0].intermediate_values.keys()) == [sim.t]
+
+    return
+
+
+def fake_objective(trial, pop_size=None, prune=False):
+    ''' Cheap stand-in for the objective, recording the population size it was run at '''
+    bounds = cs.define_pars(which='bounds')
+    values = [(trial.suggest_uniform(key, *bound) - bound[0])/(bound[1] - bound[0]) for key,bound in bounds.items()]
+    trial.set_user_attr('pop_size', pop_size)
+    return float(np.sum(values))
+
+
+def test_multi_fidelity():
+    ''' Only the best screened trials are rerun at the full size, and only those go into the main study '''
+    defaults = {key:getattr(cm, key) for key in ['storage', 'name', 'objective', 'n_workers', 'n_trials', 'eta', 'fidelities']}
+    with tempfile.TemporaryDirectory() as folder:
+        cm.name = os.path.join(folder, 'pars')
+        cm.storage = f'sqlite:///{cm.name}.db'
+        cm.objective = fake_objective
+        cm.n_workers, cm.n_trials, cm.eta = 2, 6, 4
+        cm.fidelities = [20e3, cm.pop_size]
+        try:
+            cm.run_multi_fidelity()
+            screen = op.load_study(storage=cm.storage, study_name=cm.fidelity_name(20e3)).trials
+            main = op.load_study(storage=cm.storage, study_name=cm.name).trials
+            assert cm.fidelity_name(cm.pop_size) == cm.name
+            assert len(screen) == 12 and len(main) == 3
+            best = sorted(screen, key=lambda trial: trial.value)[:3]
+            assert sorted(trial.value for trial in main) == [trial.value for trial in best]
+            assert all(trial.user_attrs['pop_size'] == cm.pop_size for trial in main)
+            assert cm.promote(cm.fidelity_name(20e3), cm.name) == 0 # Resuming does not queue them again
+        finally:
+            for key,value in defaults.items():
+                setattr(cm, key, value)
+    return
+
+
+def test_journal():
+    ''' Parallel workers share a journal file, and the export ranks the trials as from SQLite '''
+    defaults = {key:getattr(cm, key) for key in ['storage', 'name', 'objective', 'n_workers', 'n_trials']}
+    with tempfile.TemporaryDirectory() as folder:
+        cm.objective = fake_objective
+        cm.n_workers, cm.n_trials = 3, 4
+        exported = {}
+        try:
+            for kind in ['journal', 'sqlite']:
+                cm.name = os.path.join(folder, f'pars_{kind}')
+                cm.storage = f'{cm.name}.journal' if kind == 'journal' else f'sqlite:///{cm.name}.db'
+                cm.make_study(restart=False, study_name=cm.name)
+                cm.run_workers(study_name=cm.name, prune=False)
+                exported[kind] = cm.export_pars(cm.name)
+                assert os.path.exists(f'{cm.name}.json')
+        finally:
+            for key,value in defaults.items():
+                setattr(cm, key, value)
+
+    for kind, entries in exported.items():
+        assert len(entries) == 12
+        assert sorted(entry['index'] for entry in entries) == list(range(12))
+        assert [entry['mismatch'] for entry in entries] == sorted(entry['mismatch'] for entry in entries)
+        assert list(entries[0]['pars'].keys()) == list(cs.define_pars(which='best').keys())
+        assert np.isclose(entries[0]['mismatch'], fake_objective(op.trial.FixedTrial(entries[0]['pars'])))
+    return
+
+
+def metrics_objective(trial):
+    ''' Cheap stand-in for the objective that records metrics, as the real one does '''
+    bounds = cs.define_pars(which='bounds')
+    values = [(trial.suggest_uniform(key, *bound) - bound[0])/(bound[1] - bound[0]) for key,bound in bounds.items()]
+    metrics = {key:true*(1 + values[k%len(values)] - 0.5) for k,(key,true) in enumerate(cm.to_fit.items())}
+    trial.set_user_attr('metrics', metrics)
+    return cm.compute_mismatch(metrics)
+
+
+def test_rescore():
+    ''' Trials can be ranked against new targets from their recorded metrics alone '''
+    defaults = {key:getattr(cm, key) for key in ['storage', 'name', 'folder']}
+    with tempfile.TemporaryDirectory() as folder:
+        cm.folder = folder
+        cm.name = cm.make_name(cm.to_fit)
+        cm.storage = f'{cm.name}.journal'
+        try:
+            study = cm.make_study(restart=False, study_name=cm.name)
+            study.optimize(metrics_objective, n_trials=20)
+            exported = cm.export_pars(cm.name, filename=False)
+            table = cm.trials_table(cm.name)
+            assert len(table) == 20 and set(cm.to_fit.keys()) <= set(table.columns)
+
+            # The same targets give the same ranking, from the table or its CSV file
+            for source in [table, f'{cm.name}_trials.csv']:
+                same = cm.rescore(source, filename=False)
+                assert [entry['index'] for entry in same] == [entry['index'] for entry in exported]
+                assert np.allclose([entry['mismatch'] for entry in same], [entry['mismatch'] for entry in exported])
+                assert same[0]['pars'] == exported[0]['pars']
+
+            # New targets give a new ranking and file
+            targets = sc.mergedicts(cm.to_fit, {'prevalence':0.004})
+            weights = sc.mergedicts(cm.weight, {'tests':0})
+            rescored = cm.rescore(table, targets=targets, weights=weights)
+            assert os.path.exists(f'{cm.make_name(targets)}.json') and 'prevalence=0.004' in cm.make_name(targets)
+            best = table.iloc[np.argmin([cm.compute_mismatch(row, targets, weights) for row in table.to_dict('records')])]
+            assert rescored[0]['index'] == best['index']
+        finally:
+            for key,value in defaults.items():
+                setattr(cm, key, value)
+    return
+
+
+def test_templates():
+    ''' A trial's sim made from the worker's template runs exactly as one made from scratch '''
+    defaults = {key:getattr(cm, key) for key in ['folder', 'max_pop_seeds', 'templates']}
+    pop_size = 5e3
+    people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(os.path.join(folder, 'inputs'))
+        sc.saveobj(os.path.join(folder, 'inputs', f'kc_synthpops_clustered_{int(pop_size)}_withstaff_seed0.ppl'), people)
+        cm.folder, cm.max_pop_seeds, cm.templates = folder, 1, {}
+        try:
+            for seed in [3, 4]:
+                pars = dict(pop_infected=150, change_beta=0.5, symp_prob=0.2, rand_seed=seed)
+                fresh = cs.create_sim(sc.dcp(pars), pop_size=pop_size, folder=folder, children_equally_sus=cm.children_equally_sus,
+                                      alternate_symptomaticity=cm.alternate_symptomaticity, max_pop_seeds=1)
+                cm.add_schools(fresh)
+                fresh.run()
+                reused = cm.trial_sim(pars, pop_size=pop_size)
+                reused.run()
+                for key in ['new_infections', 'new_diagnoses', 'new_tests', 'n_exposed']:
+                    assert np.array_equal(fresh.results[key].values, reused.results[key].values), f'Mismatch in {key} for seed {seed}'
+                assert evaluate_sim(fresh) == evaluate_sim(reused)
+            assert list(cm.templates.keys()) == [(pop_size, 0)]
+        finally:
+            for key,value in defaults.items():
+                setattr(cm, key, value)
+    return
+
+
 if __name__ == '__main__':
 
     sim = test_calib()
+    test_partial_mismatch()
+    test_multi_fidelity()
+    test_journal()
+    test_rescore()
+    test_templates()
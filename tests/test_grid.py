@@ -0,0 +1,89 @@
+'''
+Check that the grid runner saves each cell, and reruns only cells that are missing or have changed
+'''
+
+import os
+import tempfile
+import sciris as sc
+import covasim_schools as cvsch
+from testing_in_schools import run_grid as rg
+from testing_in_schools.testing_scenarios import generate_scenarios, generate_testing
+
+pop_size = 2e3
+params = dict(pop_infected=20, change_beta=1.0)
+
+
+def test_grid():
+    ''' Run a small grid, then resume it after adding a testing option and changing a scenario '''
+
+    with tempfile.TemporaryDirectory() as folder:
+        people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+        sc.saveobj(os.path.join(folder, 'pop_seed0.ppl'), people)
+        sim_kwargs = dict(folder=folder, popfile_stem='pop_seed', max_pop_seeds=1)
+        outfolder = os.path.join(folder, 'grid')
+
+        all_scenarios = generate_scenarios()
+        all_testing = generate_testing()
+        scenarios = {key:all_scenarios[key] for key in ['as_normal', 'all_remote']}
+        testing = {key:all_testing[key] for key in ['None']}
+        par_list = [dict(index=k, pars=params) for k in range(2)]
+
+        cells = rg.make_cells(scenarios, testing, par_list, pop_size=pop_size, sim_kwargs=sim_kwargs)
+        assert len(cells) == 4
+        assert rg.run_grid(cells, outfolder, ncpus=2) == []
+        assert rg.pending_cells(cells, outfolder) == []
+        manifest = rg.load_manifest(outfolder)
+        assert sorted(manifest.keys()) == sorted(cell['key'] for cell in cells)
+
+        # A new testing option only adds its own cells
+        testing['PCR every 1w'] = all_testing['PCR every 1w']
+        cells = rg.make_cells(scenarios, testing, par_list, pop_size=pop_size, sim_kwargs=sim_kwargs)
+        pending = rg.pending_cells(cells, outfolder)
+        assert sorted(cell['tkey'] for cell in pending) == ['PCR every 1w']*4
+
+        # A changed scenario reruns its cells, and replaces their files
+        scenarios['all_remote'] = sc.dcp(scenarios['all_remote'])
+        scenarios['all_remote']['es']['start_day'] = '2020-12-01'
+        cells = rg.make_cells(scenarios, testing, par_list, pop_size=pop_size, sim_kwargs=sim_kwargs)
+        pending = rg.pending_cells(cells, outfolder)
+        assert len(pending) == 6
+        assert all(cell['tkey'] == 'PCR every 1w' or cell['skey'] == 'all_remote' for cell in pending)
+        assert rg.run_grid(cells, outfolder, ncpus=2) == []
+        assert rg.pending_cells(cells, outfolder) == []
+        assert len(os.listdir(os.path.join(outfolder, 'cells'))) == len(cells)
+
+        # The results load in grid order
+        msim = rg.load_grid(cells, outfolder)
+        assert [(sim.key1, sim.key2, sim.eidx) for sim in msim.sims] == [(cell['skey'], cell['tkey'], cell['eidx']) for cell in cells]
+        assert all(sim.complete for sim in msim.sims)
+
+    return
+
+
+def test_grid_keys():
+    ''' Cells with the same inputs but different keys are saved separately, with their own keys '''
+
+    with tempfile.TemporaryDirectory() as folder:
+        people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+        sc.saveobj(os.path.join(folder, 'pop_seed0.ppl'), people)
+        sim_kwargs = dict(folder=folder, popfile_stem='pop_seed', max_pop_seeds=1)
+        outfolder = os.path.join(folder, 'grid')
+
+        scenarios = {'all_remote':generate_scenarios()['all_remote']}
+        testing = {'None':generate_testing()['None']}
+        par_list = [dict(index=0, pars=params)]
+        sensitivity = {'baseline':rg.add_schools, 'copy':rg.add_schools}
+
+        cells = rg.make_cells(scenarios, testing, par_list, sensitivity=sensitivity, pop_size=pop_size, sim_kwargs=sim_kwargs)
+        assert rg.fingerprint(cells[0]) == rg.fingerprint(cells[1])
+        assert rg.run_grid(cells, outfolder, ncpus=2) == []
+        assert len(os.listdir(os.path.join(outfolder, 'cells'))) == 2
+        msim = rg.load_grid(cells, outfolder)
+        assert [sim.key3 for sim in msim.sims] == ['baseline', 'copy']
+
+    return
+
+
+if __name__ == '__main__':
+    test_grid()
+    test_grid_keys()
@@ -0,0 +1,115 @@
+'''
+Check that the school layers are split and updated correctly
+'''
+
+import numpy as np
+import sciris as sc
+import covasim as cv
+import covasim_schools as cvsch
+
+
+pop_size = 10e3
+
+
+def make_people():
+    ''' A small population with a few schools of each type '''
+    return cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+
+
+def partition_by_loop(people, school_ids):
+    ''' Partition the school layer by looping over the schools and removing each school's rows in turn '''
+    sdf = people.contacts['s'].to_df()
+    layers = {}
+    for school_id in school_ids:
+        uids = people.schools[school_id]
+        rows = (sdf['p1'].isin(uids)) | (sdf['p2'].isin(uids))
+        layers[school_id] = cv.Layer().from_df(sdf.loc[rows])
+        sdf = sdf.loc[~rows]
+    return layers
+
+
+def test_partition():
+    ''' Single-pass partitioning must match looping over the schools exactly '''
+
+    people = make_people()
+    school_ids = [scid for stype in ['es', 'ms', 'hs'] for scid in people.school_types[stype]]
+
+    layers = cvsch.partition_school_layer(people.contacts['s'], people.schools, school_ids, len(people))
+    looped = partition_by_loop(people, school_ids)
+
+    assert list(layers.keys()) == school_ids
+    for school_id in school_ids:
+        for key in ['p1', 'p2', 'beta']:
+            assert layers[school_id][key].dtype == looped[school_id][key].dtype
+            assert np.array_equal(layers[school_id][key], looped[school_id][key]), f'Mismatch in "{key}" for school {school_id}'
+
+    return
+
+
+def test_masked_layers():
+    ''' Masking the base layer must give the same daily layer as copying it and popping absent individuals '''
+
+    people = make_people()
+    school_id = people.school_types['hs'][0]
+    uids = np.array(people.schools[school_id])
+    layer = cvsch.partition_school_layer(people.contacts['s'], people.schools, [school_id], len(people))[school_id]
+
+    np.random.seed(1)
+    absent = np.random.choice(uids, size=len(uids)//5, replace=False)
+    managers = [cvsch.school_interventions.FullTimeContactManager(None, uids, layer, copy_layers=copy_layers) for copy_layers in [False, True]]
+    daily = []
+    for mgr in managers:
+        mgr.begin_day('2020-11-02') # A Monday
+        mgr.remove_individuals(absent)
+        daily.append(mgr.get_layer())
+
+    assert 0 < len(daily[0]) < len(layer)
+    for key in ['p1', 'p2', 'beta']:
+        assert np.array_equal(daily[0][key], daily[1][key])
+    assert len(layer) == len(managers[0].base_layer) # Base layer is untouched
+
+    return
+
+
+def test_contact_index():
+    ''' The tracing index must find the same contacts as searching the layer '''
+
+    people = make_people()
+    school_id = people.school_types['es'][0]
+    uids = np.array(people.schools[school_id])
+    layer = cvsch.partition_school_layer(people.contacts['s'], people.schools, [school_id], len(people))[school_id]
+    mgr = cvsch.school_interventions.FullTimeContactManager(None, uids, layer)
+
+    np.random.seed(2)
+    for n in [0, 1, 10, len(uids)]:
+        traced = np.random.choice(uids, size=n, replace=False)
+        assert np.array_equal(mgr.find_contacts(traced), layer.find_contacts(traced))
+
+    return
+
+
+def test_hybrid_index():
+    ''' Removing the edges between the A and B cohorts from the index leaves the contacts in either sublayer '''
+
+    people = make_people()
+    school_id = people.school_types['ms'][0]
+    uids = np.array(people.schools[school_id])
+    layer = cvsch.partition_school_layer(people.contacts['s'], people.schools, [school_id], len(people))[school_id]
+    sim = sc.objdict(people=people) # The manager only needs the people's roles
+
+    np.random.seed(3)
+    mgr = cvsch.school_interventions.HybridContactManager(sim, uids, layer)
+    A_layer, B_layer = mgr.A_base_layer, mgr.B_base_layer
+    for traced in [uids[:1], mgr.A_students[:10], mgr.B_students[:10], uids]:
+        expected = np.union1d(A_layer.find_contacts(traced), B_layer.find_contacts(traced))
+        assert np.array_equal(mgr.find_contacts(traced), expected)
+    assert len(mgr.contact_index.neighbors) < len(mgr.make_index(np.ones(len(layer), dtype=bool)).neighbors)
+
+    return
+
+
+if __name__ == '__main__':
+    test_partition()
+    test_masked_layers()
+    test_contact_index()
+    test_hybrid_index()
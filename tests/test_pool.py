@@ -0,0 +1,42 @@
+'''
+Check that the memory-aware pool gives the same sims as running them directly, and holds sims back when memory is short
+'''
+
+import numpy as np
+import sciris as sc
+import covasim_schools as cvsch
+from testing_in_schools import create_sim as cs
+
+pop_size = 2e3
+params = dict(pop_infected=20, change_beta=1.0)
+
+
+def make_sim(seed):
+    ''' A small sim, with its population made afresh '''
+    return cs.create_sim(sc.mergedicts(params, {'rand_seed':seed}), pop_size=pop_size, load_pop=False, label=f'Seed {seed}')
+
+
+def test_pool():
+    ''' Sims come back in order with their memory use, and the first sim runs alone if it might not fit '''
+
+    log = []
+    def make_sims():
+        for seed in range(3):
+            log.append(f'made {seed}')
+            yield make_sim(seed)
+
+    sims = cvsch.run_sims(make_sims(), ncpus=2, mem_per_sim=1e18, callback=lambda sim: log.append(f'done {sim.label}'))
+    assert log[:3] == ['made 0', 'made 1', 'done Seed 0'] # The next sim waits until the first has been measured
+    assert [sim.label for sim in sims] == ['Seed 0', 'Seed 1', 'Seed 2']
+    for seed,sim in enumerate(sims):
+        assert sim.results_ready and sim.people is None
+        assert sim.run_info.peak_rss > 0 and sim.run_info.time > 0
+        expected = make_sim(seed)
+        expected.run()
+        assert np.array_equal(sim.results['new_infections'].values, expected.results['new_infections'].values)
+
+    return
+
+
+if __name__ == '__main__':
+    test_pool()
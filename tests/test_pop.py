@@ -26,6 +26,69 @@ def test_school_pop(do_plot=False):
     return pop
 
 
+def school_columns_by_loop(population, pop_size):
+    ''' Extract the school membership by appending each person to lists, one person at a time '''
+    school_ids = [None] * int(pop_size)
+    teacher_flag = [False] * int(pop_size)
+    staff_flag = [False] * int(pop_size)
+    student_flag = [False] * int(pop_size)
+    school_types = {'pk': [], 'es': [], 'ms': [], 'hs': [], 'uv': []}
+    school_type_by_person = [None] * int(pop_size)
+    schools = dict()
+
+    for uid,person in population.items():
+        if person['scid'] is not None:
+            school_ids[uid] = person['scid']
+            school_type_by_person[uid] = person['sc_type']
+            if person['scid'] not in school_types[person['sc_type']]:
+                school_types[person['sc_type']].append(person['scid'])
+            if person['scid'] in schools:
+                schools[person['scid']].append(uid)
+            else:
+                schools[person['scid']] = [uid]
+            if person['sc_teacher'] is not None:
+                teacher_flag[uid] = True
+            elif person['sc_student'] is not None:
+                student_flag[uid] = True
+            elif person['sc_staff'] is not None:
+                staff_flag[uid] = True
+
+    return dict(school_id=school_ids, schools=schools, teacher_flag=teacher_flag, student_flag=student_flag,
+                staff_flag=staff_flag, school_types=school_types, school_type_by_person=school_type_by_person)
+
+
+def test_school_columns():
+    ''' The vectorized extraction gives the same schools, types, and roles as looping over people '''
+
+    # A population with people in no school, and a teacher who is also a student
+    np.random.seed(1)
+    pop_size = 2000
+    population = {}
+    for uid in range(pop_size):
+        scid = np.random.choice([None, 4, 9, 2, 7], p=[0.6, 0.1, 0.1, 0.1, 0.1])
+        role = np.random.randint(3)
+        population[uid] = dict(scid=scid, sc_type=None if scid is None else {4:'es', 9:'hs', 2:'es', 7:'uv'}[scid],
+                               sc_student=1 if (scid is not None and role in [0, 1]) else None,
+                               sc_teacher=1 if (scid is not None and role == 1) else None,
+                               sc_staff=1 if (scid is not None and role == 2) else None)
+
+    cols = cvsch.school_columns(population, pop_size)
+    looped = school_columns_by_loop(population, pop_size)
+
+    assert cols['school_id'].dtype == np.int32 and cols['school_role'].dtype == np.int8 and cols['school_type_code'].dtype == np.int8
+    assert np.array_equal(cols['school_id'], [-1 if scid is None else scid for scid in looped['school_id']])
+    assert cols['school_types'] == looped['school_types']
+    assert list(cols['schools'].keys()) == list(looped['schools'].keys())
+    for scid, uids in looped['schools'].items():
+        assert np.array_equal(cols['schools'][scid], uids)
+    for key in ['student_flag', 'teacher_flag', 'staff_flag']:
+        assert cols[key].dtype == bool and np.array_equal(cols[key], looped[key])
+    types = [cvsch.school_type_keys[code] if code >= 0 else None for code in cols['school_type_code']]
+    assert types == looped['school_type_by_person']
+
+    return
+
+
 def plot_schools(pop):
     ''' Not a formal test, but a sanity check for school distributions '''
     keys = ['pk', 'es', 'ms', 'hs'] # Exclude universities for this analysis
@@ -84,5 +147,6 @@ def plot_schools(pop):
 
 if __name__ == '__main__':
     pop = test_school_pop(do_plot=False)
+    test_school_columns()
     results = plot_schools(pop)
 
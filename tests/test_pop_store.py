@@ -0,0 +1,144 @@
+'''
+Check that a population store loads the same population, and gives the same sim, as the People object it was made from
+'''
+
+import os
+import pickle
+import tempfile
+import numpy as np
+import sciris as sc
+import covasim_schools as cvsch
+from testing_in_schools import create_sim as cs
+from testing_in_schools.testing_scenarios import generate_scenarios, generate_testing
+
+pop_size = 5e3
+params = dict(rand_seed=1, pop_infected=100, change_beta=1.0)
+
+
+def check_same(people, loaded):
+    ''' The loaded population has the same people, contacts, and schools '''
+    assert np.array_equal(people.age, loaded.age) and np.array_equal(people.sex, loaded.sex)
+    for lkey,layer in people.contacts.items():
+        for key in ['p1', 'p2', 'beta']:
+            assert loaded.contacts[lkey][key].dtype == layer[key].dtype
+            assert np.array_equal(loaded.contacts[lkey][key], layer[key]), f'Mismatch in "{key}" of layer {lkey}'
+    assert list(loaded.schools.keys()) == list(people.schools.keys())
+    for sid,uids in people.schools.items():
+        assert np.array_equal(loaded.schools[sid], uids)
+    assert loaded.school_types == people.school_types
+    for key in ['student_flag', 'teacher_flag', 'staff_flag']:
+        assert np.array_equal(getattr(loaded, key), np.asarray(getattr(people, key), dtype=bool))
+    return
+
+
+def make_scenario():
+    ''' A scenario with testing, so the school rosters and roles are used '''
+    scen = generate_scenarios()['with_countermeasures']
+    for spec in scen.values():
+        if spec is not None:
+            spec['testing'] = generate_testing()['Antigen every 1w, PCR f/u']
+    return scen
+
+
+def test_pop_store():
+    ''' Round trip through a store, for both current and older populations, and run a sim on it '''
+
+    people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+    with tempfile.TemporaryDirectory() as folder:
+
+        # Current populations
+        popfile = os.path.join(folder, 'pop.ppl')
+        sc.saveobj(popfile, people)
+        store = cvsch.convert_popfile(popfile)
+        assert store == os.path.join(folder, 'pop.store')
+        loaded = cvsch.load_pop_store(store)
+        check_same(people, loaded)
+        assert isinstance(loaded.contacts['s']['p2'].base, np.memmap)
+
+        # Pickling and copying map the arrays again, rather than copying them
+        for copied in [pickle.loads(pickle.dumps(loaded)), sc.dcp(loaded)]:
+            check_same(people, copied)
+            assert isinstance(copied.contacts['c']['beta'].base, np.memmap) and isinstance(copied.age.base, np.memmap)
+        assert len(loaded.__getstate__()['_mapped_refs']) == len(loaded._mapped)
+        assert loaded.contacts['c']['beta'] is not None # The original is untouched
+        for key in ['school_id', 'school_type_code', 'school_role']:
+            assert np.array_equal(getattr(loaded, key), getattr(people, key))
+
+        # Older populations, with object school IDs, list flags, and no type codes or roles
+        old = sc.dcp(people)
+        old.school_id = np.array([None if sid < 0 else sid for sid in people.school_id], dtype=object)
+        for key in ['student_flag', 'teacher_flag', 'staff_flag']:
+            setattr(old, key, getattr(people, key).tolist())
+        for key in ['school_type_code', 'school_role']:
+            delattr(old, key)
+        old_store = cvsch.save_pop_store(old, os.path.join(folder, 'old.store'))
+        loaded_old = cvsch.load_pop_store(old_store, mmap=False)
+        check_same(people, loaded_old)
+        assert np.array_equal(loaded_old.school_type_code, people.school_type_code)
+
+        # The sim is identical
+        results = []
+        for ppl in [sc.dcp(people), loaded]:
+            sim = cs.create_sim(sc.dcp(params), pop_size=pop_size, load_pop=False, people=ppl)
+            sim['interventions'] += [cvsch.schools_manager(make_scenario())]
+            sim.run()
+            results.append(sim)
+        assert np.array_equal(results[0].results['cum_infections'].values, results[1].results['cum_infections'].values)
+        assert results[0].school_results.n_tested == results[1].school_results.n_tested
+
+        del loaded, results # Release the mapped files before the folder is removed
+
+    return
+
+
+def test_pop_cache():
+    ''' Each population is loaded once, and reloaded only when its file changes '''
+
+    people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+    with tempfile.TemporaryDirectory() as folder:
+        popfile = os.path.join(folder, 'pop.ppl')
+        sc.saveobj(popfile, people)
+        store = cvsch.convert_popfile(popfile)
+        cs.pop_cache.clear()
+
+        copies = [cs.load_people(fn) for fn in [popfile, popfile, store, store]]
+        assert len(cs.pop_cache) == 2
+        for ppl in copies:
+            check_same(people, ppl)
+
+        # Copies share the contacts, but not the states that a sim changes
+        assert copies[0].contacts['h']['p1'] is copies[1].contacts['h']['p1'] and copies[0].contacts['h'] is not copies[1].contacts['h']
+        assert copies[0].susceptible is not copies[1].susceptible
+        assert len(copies[2].__getstate__()['_mapped_refs']) == len(copies[2]._mapped) # Still pickled as references to the store
+
+        # Running a sim on a copy leaves the cached population as loaded
+        for ppl in copies[:3:2]:
+            sim = cs.create_sim(sc.dcp(params), pop_size=pop_size, load_pop=False, people=ppl)
+            sim['interventions'] += [cvsch.schools_manager(make_scenario())]
+            sim.run()
+        for cached in cs.pop_cache.values():
+            check_same(people, cached)
+            assert cached.susceptible.all() and np.isnan(cached.date_exposed).all()
+
+        # A changed file replaces the cached population
+        people.age[:] = 30
+        sc.saveobj(popfile, people)
+        os.utime(popfile, (0, 1e9))
+        assert (cs.load_people(popfile).age == 30).all()
+        assert len(cs.pop_cache) == 2
+
+        # The least recently used population is dropped
+        default_size = cs.pop_cache_size
+        cs.pop_cache_size = 1
+        cs.load_people(store)
+        assert [key[0] for key in cs.pop_cache] == [os.path.abspath(store)]
+        cs.pop_cache_size = default_size
+        cs.pop_cache.clear()
+        del copies
+
+    return
+
+
+if __name__ == '__main__':
+    test_pop_store()
+    test_pop_cache()
@@ -0,0 +1,59 @@
+'''
+Check the columnar school results
+'''
+
+import pickle
+import numpy as np
+import covasim_schools as cvsch
+
+
+def make_stats(npts, k):
+    ''' Make statistics for one school in the format returned by SchoolStats.get() '''
+    groups = cvsch.SchoolResults.groups
+    stats = {metric:{group:np.full(npts, 10*m+g+k, dtype=np.float32) for g,group in enumerate(groups)} for m,metric in enumerate(cvsch.SchoolResults.metrics)}
+    stats['num'] = {group:100.0*(k+1) for group in groups}
+    stats['num_school_days'] = 50
+    stats['n_tested'] = {'PCR':k, 'Antigen':2*k}
+    return stats
+
+
+def test_results():
+    ''' Results can be stored, pickled, and read back in the original per-school format '''
+
+    npts = 30
+    sids = ['s1', 's5', 's9']
+    types = ['es', 'es', 'hs']
+    scenarios = {'es':{'schedule':'Full'}, 'hs':{'schedule':'Hybrid'}}
+    res = cvsch.SchoolResults(sids, types, npts, scenarios)
+    for k,sid in enumerate(sids):
+        res.set_school(sid, make_stats(npts, k))
+
+    res = pickle.loads(pickle.dumps(res))
+    assert res.data.shape == (3, len(res.metrics), len(res.groups), npts) and res.data.dtype == np.float32
+
+    # Dict-like access
+    assert list(res.keys()) == sids and len(res) == 3 and 's5' in res
+    for k,(sid,stats) in enumerate(res.items()):
+        expected = make_stats(npts, k)
+        assert stats['type'] == types[k]
+        assert stats['scenario'] is res.scenarios[types[k]]
+        assert stats['num_school_days'] == 50
+        assert stats['n_tested'] == expected['n_tested']
+        for metric in res.metrics:
+            for group in res.groups:
+                assert np.array_equal(stats[metric][group], expected[metric][group])
+
+    # Columnar access
+    assert np.array_equal(res.get('in_person', 'staff')[:,0], [52, 53, 54])
+    df = res.to_df()
+    assert list(df['sid']) == sids
+    assert np.allclose(df['in_person_staff'], npts*np.array([52, 53, 54]))
+    res.data[:,:,:,3] += 1
+    df = res.to_df(days={'d1':3})
+    assert np.array_equal(df['in_person_staff_d1'], [53, 54, 55]) and 'infectious_students_d1' in df.columns
+
+    return
+
+
+if __name__ == '__main__':
+    test_results()
@@ -0,0 +1,107 @@
+'''
+Check the summary rows written for each sim, and reading them back from the Parquet dataset
+'''
+
+import tempfile
+import pytest
+import numpy as np
+import pandas as pd
+import sciris as sc
+import covasim_schools as cvsch
+from testing_in_schools import create_sim as cs
+from testing_in_schools.testing_scenarios import generate_scenarios, generate_testing
+
+pop_size = 5e3
+params = dict(pop_infected=100, change_beta=1.0)
+
+
+def make_sims():
+    ''' Two small finished sims with different keys and seeds '''
+    people = cvsch.make_population(pop_size=pop_size, rand_seed=1, do_save=False)
+    sims = []
+    for k,(skey, tkey) in enumerate([('with_countermeasures', 'Antigen every 1w, PCR f/u'), ('all_hybrid', 'PCR every 1w')]):
+        scen = generate_scenarios()[skey]
+        for spec in scen.values():
+            if spec is not None:
+                spec['testing'] = generate_testing()[tkey]
+        sim = cs.create_sim(sc.mergedicts(params, {'rand_seed':k}), pop_size=pop_size, load_pop=False, people=sc.dcp(people))
+        sim['interventions'] += [cvsch.schools_manager(scen)]
+        sim.run()
+        sim.key1, sim.key2 = skey, tkey
+        sims.append(sim)
+    return sims
+
+
+def metrics(sim):
+    ''' Stand-in for evaluate_sim(), which needs Optuna to import '''
+    return {'cum_infections':sim.results['cum_infections'][-1]}
+
+
+def test_summary_row():
+    ''' The summary row has the metrics and the totals from gather_stats() '''
+    sim = make_sims()[0]
+    row = cvsch.summary_row(sim, metrics=metrics)
+    res = sim.school_results
+    assert row['cum_infections'] == sim.results['cum_infections'][-1]
+    assert row['n_tested_Antigen'] == res.n_tested.Antigen > 0
+    assert row['in_person_teachers+staff'] == res.in_person['teachers+staff']
+    assert row['num_all'] == res.num.all
+    assert row['pop_size'] == pop_size and row['pop_scale'] == sim['pop_scale']
+    assert all(not isinstance(value, np.generic) for value in row.values())
+    return
+
+
+def test_sink():
+    ''' Rows written as each sim finishes can be read back by column and partition '''
+    pytest.importorskip('pyarrow')
+    sims = make_sims()
+    with tempfile.TemporaryDirectory() as folder:
+        sink = cvsch.ResultsSink(folder, metrics=metrics, days={'d1':'2020-11-02'})
+        for sim in sims:
+            sink.add(sim)
+        sink.add(sims[0]) # Adding a sim again replaces its rows
+
+        df = cvsch.load_results(folder).sort_values('seed')
+        assert list(df['key2']) == [sim.key2 for sim in sims] # Partition values with "/" and "," are restored
+        assert list(df['key3']) == ['None', 'None']
+        assert list(df['seed']) == [0, 1]
+        assert np.allclose(df['cum_infections'], [sim.results['cum_infections'][-1] for sim in sims])
+
+        columns = ['key1', 'sid', 'in_person_students', 'in_person_students_d1']
+        schools = cvsch.load_results(folder, table='schools', columns=columns, filters=[('key1', '==', 'all_hybrid')])
+        expected = sims[1].school_stats.to_df()
+        assert list(schools.columns) == columns
+        assert sorted(schools['sid']) == sorted(expected['sid'])
+        assert np.isclose(schools['in_person_students'].sum(), expected['in_person_students'].sum())
+        assert np.isclose(schools['in_person_students_d1'].sum(), sims[1].school_stats.get('in_person', 'students')[:,sims[1].day('2020-11-02')].sum())
+    return
+
+
+def test_collect_results():
+    ''' Tables built from sims in memory, including older sims with dict school stats, match those read from the sink '''
+    pytest.importorskip('pyarrow')
+    sims = make_sims()
+    legacy = sc.dcp(sims[1])
+    legacy.school_stats = dict(legacy.school_stats.items()) # As saved before SchoolResults
+    with tempfile.TemporaryDirectory() as folder:
+        sink = cvsch.ResultsSink(folder, metrics=metrics, days={'d1':'2020-11-02'})
+        for sim in sims:
+            sink.add(sim)
+        filters = [('type', 'in', ['es', 'ms'])]
+        for table in ['summary', 'schools']:
+            kwargs = dict(table=table, filters=filters if table == 'schools' else None)
+            order = ['seed', 'sid'] if table == 'schools' else ['seed']
+            loaded = cvsch.load_results(folder, **kwargs).sort_values(order).reset_index(drop=True)
+            collected = cvsch.collect_results([sims[0], legacy], metrics=metrics, days=sink.days, **kwargs)
+            assert list(collected.columns) == list(loaded.columns)
+            pd.testing.assert_frame_equal(collected.sort_values(order).reset_index(drop=True), loaded, check_dtype=False)
+        assert set(collected['type']) <= {'es', 'ms'}
+        columns = ['seed', 'sid']
+        assert list(cvsch.collect_results(sims, table='schools', columns=columns).columns) == columns
+    return
+
+
+if __name__ == '__main__':
+    test_summary_row()
+    test_sink()
+    test_collect_results()
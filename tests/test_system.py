@@ -0,0 +1,154 @@
+'''
+Check that the vectorized SchoolSystem engine agrees with the per-school engine
+'''
+
+import pytest
+import numpy as np
+import sciris as sc
+import covasim as cv
+import covasim_schools as cvsch
+from testing_in_schools import create_sim as cs
+from testing_in_schools.testing_scenarios import generate_scenarios, generate_testing
+
+pop_size = 10e3
+params = dict(rand_seed=1, pop_infected=100, change_beta=1.0)
+
+
+def run_sim(scen_key, test_key, engine, **kwargs):
+    ''' Run a small sim with the given scenario, testing, and engine '''
+    scen = generate_scenarios()[scen_key]
+    for stype, spec in scen.items():
+        if spec is not None:
+            spec['testing'] = generate_testing()[test_key]
+    sim = cs.create_sim(sc.dcp(params), pop_size=pop_size, load_pop=False)
+    sim['interventions'] += [cvsch.schools_manager(scen, engine=engine, **kwargs)]
+    sim.run()
+    return sim
+
+
+def test_system():
+    ''' The two engines give results with the same structure, and the same schedules '''
+
+    sims = {engine:run_sim('as_normal', 'Antigen every 1w, PCR f/u', engine) for engine in ['schools', 'system']}
+    res = {engine:sim.school_results for engine,sim in sims.items()}
+
+    assert sims['schools'].school_stats.keys() == sims['system'].school_stats.keys()
+    for sid,stats in sims['schools'].school_stats.items():
+        assert stats.keys() == sims['system'].school_stats[sid].keys()
+        for engine in ['schools', 'system']:
+            series = sims[engine].school_stats[sid]['in_person']['students']
+            assert series.dtype == np.float32 and len(series) == sims[engine].npts
+
+    # Everything that does not depend on random draws must match exactly
+    assert res['schools'].n_schools == res['system'].n_schools
+    assert res['schools'].n_school_days == res['system'].n_school_days
+    for group in ['students', 'teachers', 'staff']:
+        assert res['schools'].num[group] == res['system'].num[group]
+        assert np.isclose(res['schools'].scheduled[group], res['system'].scheduled[group])
+
+    # Testing and attendance are random, but should be similar
+    assert res['system'].n_tested.Antigen > 0
+    assert np.isclose(res['schools'].n_tested.Antigen, res['system'].n_tested.Antigen, rtol=0.1)
+    assert np.isclose(res['schools'].in_person['all'], res['system'].in_person['all'], rtol=0.1)
+
+    return
+
+
+def test_system_hybrid():
+    ''' Hybrid schools attend on fewer days, in half-size cohorts '''
+
+    sims = {engine:run_sim('all_hybrid', 'PCR every 1w', engine) for engine in ['schools', 'system']}
+    res = {engine:sim.school_results for engine,sim in sims.items()}
+    assert res['schools'].n_school_days == res['system'].n_school_days
+    assert np.isclose(res['schools'].scheduled['all'], res['system'].scheduled['all'], rtol=0.1)
+    assert np.isclose(res['schools'].n_tested.PCR, res['system'].n_tested.PCR, rtol=0.1)
+
+    return
+
+
+def test_batch_testing():
+    ''' Testing all schools at once gives similar numbers of tests to testing each school separately '''
+
+    sims = {batch:run_sim('with_countermeasures', 'Antigen every 1w, PCR f/u', 'schools', batch_testing=batch) for batch in [False, True]}
+    res = {batch:sim.school_results for batch,sim in sims.items()}
+    assert res[True].n_tested.Antigen > 0
+    assert np.isclose(res[False].n_tested.Antigen, res[True].n_tested.Antigen, rtol=0.1)
+    for sid,stats in sims[True].school_stats.items():
+        assert stats['n_tested']['Antigen'] > 0 # Tests are attributed back to every school
+
+    return
+
+
+def test_stats_levels():
+    ''' District and weekly statistics are sums of the school-level daily statistics '''
+
+    for engine in ['schools', 'system']:
+        sims = {level:run_sim('with_countermeasures', 'PCR every 1w', engine, stats_level=level, stats_freq=freq) for level,freq in [['school', 'day'], ['district', 'week'], ['none', 'day']]}
+        schools = sims['school'].school_stats
+        district = sims['district'].school_stats
+        assert sims['none'].school_stats is None and sims['none'].school_results is None
+        assert district.keys() == ['district'] and district.data.shape[-1] == np.ceil(sims['school'].npts/7)
+
+        # Summing the schools, and the days of each week, gives the same statistics
+        daily = schools.data.sum(axis=0)
+        weekly = np.add.reduceat(daily, np.arange(0, daily.shape[-1], 7), axis=-1)
+        assert np.allclose(district.data[0], weekly)
+        for key in ['PCR', 'Antigen']:
+            assert district.meta[f'n_tested_{key}'][0] == schools.meta[f'n_tested_{key}'].sum()
+        for key in sims['school'].school_results.shared_keys:
+            assert np.isclose(sims['school'].school_results[key]['all'], sims['district'].school_results[key]['all'])
+
+    # Invalid options fail when the manager is made, rather than once the sim is running
+    for kwargs in [dict(stats_level='county'), dict(stats_freq='month')]:
+        with pytest.raises(ValueError):
+            cvsch.schools_manager(generate_scenarios()['with_countermeasures'], **kwargs)
+
+    return
+
+
+def test_calendar():
+    ''' The compiled calendar lists each test on exactly the days given by its start date and repeat '''
+
+    sim = cv.Sim(start_day='2020-09-01', end_day='2021-01-31')
+    weekly, once = generate_testing()['PCR every 1w'][0], sc.mergedicts(generate_testing()['PCR every 1w'][0], {'repeat':None})
+    calendar = cvsch.TestingCalendar({'es':[weekly, once], 'hs':[]}, sim)
+
+    start = sim.day(weekly['start_date'])
+    for t in range(sim.npts):
+        expected = [i for i,test in enumerate([weekly, once]) if t == start or (test['repeat'] and t > start and t < sim['n_days'] and (t-start) % test['repeat'] == 0)]
+        assert [i for i,_ in calendar.tests_due(t, 'es')] == expected
+        assert calendar.tests_due(t, 'hs') == []
+    assert calendar.tests['es'][0]['is_antigen'] == False
+
+    return
+
+
+def test_layer_modes():
+    ''' Merging the school layers by type, or into one layer, must give the same contacts on the first school day '''
+
+    weights = {}
+    for layer_mode in ['school', 'type', 'single']:
+        scen = generate_scenarios()['with_countermeasures']
+        sim = cs.create_sim(sc.dcp(params), pop_size=pop_size, load_pop=False)
+        sm = cvsch.schools_manager(scen, layer_mode=layer_mode)
+        sim['interventions'] += [sm]
+        sim.run(until='2020-11-02') # Schools open on this day
+        sm.apply(sim) # Build the layers for the day, without running transmission
+        lkeys = sorted(set(sm.layer_keys))
+        assert len(lkeys) == {'school':len(sm.sids), 'type':3, 'single':1}[layer_mode]
+        weights[layer_mode] = np.sort(np.concatenate([sim.people.contacts[lkey]['beta']*sim['beta_layer'][lkey] for lkey in lkeys]))
+
+    assert len(weights['school']) > 0
+    for layer_mode in ['type', 'single']:
+        assert np.allclose(weights['school'], weights[layer_mode])
+
+    return
+
+
+if __name__ == '__main__':
+    test_system()
+    test_system_hybrid()
+    test_batch_testing()
+    test_stats_levels()
+    test_calendar()
+    test_layer_modes()